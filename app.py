@@ -5,21 +5,108 @@ import json
 import os
 import threading
 import queue
+import collections
+import heapq
+import bisect
+import sys
+import itertools
+import multiprocessing
+import asyncio
+import concurrent.futures
+import ssl
+import urllib.parse
 from vosk import Model, KaldiRecognizer
-from thefuzz import fuzz
+from thefuzz import utils as fuzz_utils
+from rapidfuzz import fuzz as rf_fuzz, process as rf_process
 import subprocess
 from functools import wraps
 import time
-import audioop
+import atexit
+import io
+import struct
+import wave
+import zlib
+import gzip
+import numpy as np
+
+# --- Startup Timeline ---
+BOOT_T0 = time.monotonic()
+startup_timeline = {}
+startup_lock = threading.Lock()
+
+def seconds_since_process_start():
+    # Measured from when the interpreter was launched (Linux /proc), so imports count too.
+    try:
+        with open("/proc/self/stat") as f: start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f: uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError, AttributeError): return time.monotonic() - BOOT_T0
+
+def mark_startup(milestone):
+    # Claimed under the lock: concurrent first requests must record (and log) the milestone once.
+    with startup_lock:
+        if milestone in startup_timeline: return
+        startup_timeline[milestone] = round(seconds_since_process_start(), 3)
+    print(f"[STARTUP] {milestone} after {startup_timeline[milestone]:.2f}s")
 
 # --- VOSK Configuration ---
 VOSK_MODEL_PATH = "vosk-model-small-en-in-0.4"
-if not os.path.exists(VOSK_MODEL_PATH):
-    print(f"Vosk model not found at '{VOSK_MODEL_PATH}'.")
-    exit(1)
-model = Model(VOSK_MODEL_PATH)
 SAMPLE_RATE = 16000
 
+class VoiceModel:
+    """The Vosk model, loaded on a background thread so relays, MQTT and the dashboard never wait for it.
+
+    Voice is "warming_up" until the load finishes, then "ready" (or "unavailable" if it failed).
+    With decode workers the model is loaded in each worker process instead, and never in this one.
+    """
+    def __init__(self, path=VOSK_MODEL_PATH):
+        self.path = path
+        self.model = None
+        self.available = False
+        self.error = None
+        self.loaded = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._load, name="vosk-model", daemon=True)
+                self.thread.start()
+        return self
+
+    def _load(self):
+        started = time.perf_counter()
+        try:
+            if not os.path.exists(self.path): raise FileNotFoundError(f"Vosk model not found at '{self.path}'")
+            if decode_pool.size: decode_pool.start(self.path)
+            else: self.model = Model(self.path)
+            self.available = True
+        except Exception as e:
+            self.error = str(e)
+            print(f"[VOSK] Voice disabled: {e}")
+        self.loaded.set()
+        if not self.available: return
+        mark_startup("voice_ready")
+        log_command(f"[VOSK] Model loaded in {time.perf_counter() - started:.1f}s, voice ready.")
+        broadcast_update({"type": "voice_status", "state": "ready"})
+
+    @property
+    def state(self):
+        if not self.loaded.is_set(): return "warming_up"
+        return "ready" if self.available else "unavailable"
+
+    def is_ready(self): return self.available
+
+    def get(self, timeout=None):
+        # Blocks until loaded (starting the load if nobody has yet); raises if voice is unavailable.
+        # Returns None when the model lives in the decode workers.
+        self.start()
+        if not self.loaded.wait(timeout) or not self.available: raise RuntimeError(self.error or "Vosk model is still loading")
+        return self.model
+
+voice_model = VoiceModel()
+
 app = Flask(__name__)
 app.secret_key = "super_secret_session_key"
 
@@ -40,16 +127,16 @@ MQTT_TRIGGER_TOPIC = "home/motion_trigger"
 MQTT_STATUS_TOPIC = "home/status"
 
 # --- Global Variables ---
+client = None
 device_states = {}
-command_log = []
 unassigned_devices = {}
 device_room_map = {}
-sse_subscribers = [] 
 PRESET_DEVICES = ["Television","Air Conditioner","Internet","Home Theater","Cofee Maker","Main Light", "Fan","Speaker"]
 CONFIG_PATH = os.path.dirname(os.path.realpath(__file__))
 MOTION_TIMEOUT = datetime.timedelta(seconds=25)
-last_motion_time = {}
 vad_processors = {}
+config_version = 0
+config_version_lock = threading.Lock()
 
 # --- Decorator for Login Protection ---
 def login_required(f):
@@ -60,14 +147,245 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# --- Metrics ---
+METRICS_ENABLED = True
+METRICS_PREFIX = "smarthome_"
+METRICS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)   # seconds
+PROFILE_MAX_SECONDS = 60
+
+class _NullTimer:
+    def __enter__(self): return self
+    def __exit__(self, *exc): return False
+
+NULL_TIMER = _NullTimer()
+
+class _StageTimer:
+    __slots__ = ("series", "start")
+    def __init__(self, series): self.series = series
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.series.observe(time.perf_counter() - self.start)
+        return False
+
+class HistogramSeries:
+    """One labelled histogram; hot paths can hold on to it and skip the name/label lookup."""
+    __slots__ = ("metrics", "counts", "sum")
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.counts = [0] * (len(metrics.buckets) + 1)   # +Inf last
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        if not self.metrics.enabled: return
+        i = bisect.bisect_left(self.metrics.buckets, seconds)
+        with self.metrics.lock:
+            self.counts[i] += 1
+            self.sum += seconds
+
+class Metrics:
+    """Prometheus-style histograms and counters keyed by name + labels.
+
+    While disabled every call returns before touching a lock or building a key, and time() hands back
+    a shared no-op context manager, so instrumented paths cost one attribute check.
+    """
+    def __init__(self, enabled=METRICS_ENABLED, buckets=METRICS_BUCKETS):
+        self.enabled = enabled
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.histograms = {}   # (name, labels) -> HistogramSeries
+        self.counters = {}
+        self.collectors = []
+
+    def histogram(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        series = self.histograms.get(key)
+        if series is None:
+            with self.lock: series = self.histograms.setdefault(key, HistogramSeries(self))
+        return series
+
+    def observe(self, name, seconds, **labels):
+        if self.enabled: self.histogram(name, **labels).observe(seconds)
+
+    def inc(self, name, amount=1, **labels):
+        if not self.enabled: return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock: self.counters[key] = self.counters.get(key, 0) + amount
+
+    def time(self, name, **labels):
+        return _StageTimer(self.histogram(name, **labels)) if self.enabled else NULL_TIMER
+
+    def collector(self, fn):
+        # fn() yields (name, labels, value) gauges, read at scrape time.
+        self.collectors.append(fn)
+        return fn
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs: return ""
+        escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+    def render(self):
+        with self.lock:
+            histograms = {key: h.counts + [h.sum] for key, h in self.histograms.items()}
+            counters = dict(self.counters)
+        lines, typed = [], set()
+        for (name, labels), h in sorted(histograms.items()):
+            full = METRICS_PREFIX + name
+            if full not in typed:
+                typed.add(full)
+                lines.append(f"# TYPE {full} histogram")
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), h[:-1]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{full}_bucket{self._labels(labels, [('le', le)])} {cumulative}")
+            lines.append(f"{full}_sum{self._labels(labels)} {h[-1]:.6f}")
+            lines.append(f"{full}_count{self._labels(labels)} {cumulative}")
+        for (name, labels), value in sorted(counters.items()):
+            full = METRICS_PREFIX + name
+            if full not in typed:
+                typed.add(full)
+                lines.append(f"# TYPE {full} counter")
+            lines.append(f"{full}{self._labels(labels)} {value}")
+        for fn in self.collectors:
+            try:
+                for name, labels, value in fn():
+                    full = METRICS_PREFIX + name
+                    if full not in typed:
+                        typed.add(full)
+                        lines.append(f"# TYPE {full} gauge")
+                    lines.append(f"{full}{self._labels(sorted(labels.items()))} {value}")
+            except Exception as e: print(f"[METRICS] Collector {fn.__name__} failed: {e}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+class SamplingProfiler:
+    """On-demand wall-clock sampler over every thread's stack; output is folded stacks (flamegraph.pl, speedscope)."""
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def sample(self, seconds, interval=0.005):
+        if not self.lock.acquire(blocking=False): return None   # one profile at a time
+        try:
+            counts = collections.Counter()
+            names = {t.ident: t.name for t in threading.enumerate()}
+            me = threading.get_ident()
+            deadline = time.perf_counter() + min(seconds, PROFILE_MAX_SECONDS)
+            while time.perf_counter() < deadline:
+                for ident, frame in sys._current_frames().items():
+                    if ident == me: continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                        frame = frame.f_back
+                    stack.append(names.get(ident, f"thread-{ident}"))
+                    counts[";".join(reversed(stack))] += 1
+                time.sleep(interval)
+            return "".join(f"{stack} {n}\n" for stack, n in counts.most_common())
+        finally: self.lock.release()
+
+profiler = SamplingProfiler()
+
 # --- Helper: Broadcast ---
+SSE_RING_SIZE = 512        # encoded events kept for Last-Event-ID resume
+SSE_COALESCE_LAG = 64      # a client further behind than this gets status updates merged per room/relay
+SSE_KEEPALIVE_S = 15
+BOOT_ID = os.urandom(6).hex()      # changes on every hub start, so clients can tell a restart from a quiet stream
+
+def relay_status_snapshot():
+    return {room: {relay: data.get('status', 'OFF') for relay, data in devices.items() if relay.startswith('relay') and isinstance(data, dict)} for room, devices in list(device_states.items())}
+
+class BroadcastHub:
+    """Events are JSON-encoded once into a sequence-numbered ring buffer that every SSE client reads from."""
+    def __init__(self, ring_size=SSE_RING_SIZE, coalesce_lag=SSE_COALESCE_LAG):
+        self.cond = threading.Condition()
+        self.ring = collections.deque(maxlen=ring_size)
+        self.coalesce_lag = coalesce_lag
+        self.seq = 0
+        self.listeners = []     # called (from the publishing thread) after every event, e.g. to wake an event loop
+        self.stats = {"published": 0, "clients": 0, "max_lag": 0, "coalesced": 0, "resyncs": 0, "dropped": 0}
+
+    def publish(self, data):
+        with metrics.time("sse_enqueue_seconds", type=data.get("type")):
+            encoded = json.dumps(data)
+            with self.cond:
+                self.seq += 1
+                self.ring.append((self.seq, data.get("type"), self._key(data), f"id: {self.seq}\ndata: {encoded}\n\n"))
+                self.stats["published"] += 1
+                self.cond.notify_all()
+            for listener in self.listeners: listener()
+
+    @staticmethod
+    def _key(data):
+        if data.get("type") == "status_update": return ("status", data.get("room"), data.get("relay"))
+        if data.get("type") == "voice_partial": return ("partial", data.get("room"))
+        return None
+
+    def cursor_for(self, last_event_id=None):
+        with self.cond:
+            try: cursor = int(last_event_id)
+            except (TypeError, ValueError): return self.seq
+            return cursor if 0 <= cursor <= self.seq else self.seq
+
+    def open(self, last_event_id=None):
+        # (cursor, first chunk) for a new stream. The hello has no id, so the client's Last-Event-ID stays put;
+        # "resumed" is false when a resume point was asked for but does not exist here (the hub restarted).
+        cursor = self.cursor_for(last_event_id)
+        resumed = last_event_id is not None and str(cursor) == str(last_event_id).strip()
+        return cursor, f"data: {json.dumps({'type': 'hello', 'boot': BOOT_ID, 'event_id': cursor, 'resumed': resumed})}\n\n"
+
+    def read(self, cursor, timeout=SSE_KEEPALIVE_S):
+        # Blocks until there is something after `cursor`; returns (new_cursor, chunks).
+        with self.cond:
+            if self.seq <= cursor and not self.cond.wait_for(lambda: self.seq > cursor, timeout):
+                return cursor, [": keepalive\n\n"]
+        return self.poll(cursor)
+
+    def poll(self, cursor):
+        # Non-blocking read: (cursor, []) when nothing is new.
+        with self.cond:
+            if self.seq <= cursor: return cursor, []
+            oldest = self.ring[0][0]
+            if cursor < oldest - 1:
+                # Events this client never saw were evicted: send current state instead.
+                self.stats["resyncs"] += 1
+                self.stats["dropped"] += oldest - 1 - cursor
+                snapshot = json.dumps({"type": "snapshot", "states": relay_status_snapshot()})
+                return self.seq, [f"id: {self.seq}\ndata: {snapshot}\n\n"]
+            pending = list(itertools.islice(self.ring, cursor + 1 - oldest, None))
+            new_cursor = self.seq
+        lag = len(pending)
+        if lag > self.stats["max_lag"]: self.stats["max_lag"] = lag
+        if lag > self.coalesce_lag:
+            # Only the newest status per room/relay (and partial transcript per room) matters to a lagging client.
+            latest = {key: seq for seq, _, key, _ in pending if key}
+            merged = [chunk for seq, _, key, chunk in pending if not key or latest[key] == seq]
+            self.stats["coalesced"] += lag - len(merged)
+            return new_cursor, merged
+        return new_cursor, [chunk for _, _, _, chunk in pending]
+
+    def stream(self, cursor, hello=None):
+        with self.cond: self.stats["clients"] += 1
+        try:
+            if hello: yield hello
+            while True:
+                cursor, chunks = self.read(cursor)
+                for chunk in chunks: yield chunk
+        finally:
+            with self.cond: self.stats["clients"] -= 1
+
+broadcast_hub = BroadcastHub()
+
 def broadcast_update(data):
-    dead_subscribers = []
-    for q in sse_subscribers:
-        try: q.put_nowait(data)
-        except queue.Full: dead_subscribers.append(q)
-    for q in dead_subscribers:
-        if q in sse_subscribers: sse_subscribers.remove(q)
+    broadcast_hub.publish(data)
 
 def load_config(filename):
     filepath = os.path.join(CONFIG_PATH, filename)
@@ -78,16 +396,965 @@ def load_config(filename):
     return {}
 
 def save_config(data, filename):
+    # Write to a temp file and rename over the original so a power cut never leaves a torn config.
     filepath = os.path.join(CONFIG_PATH, filename)
-    with open(filepath, "w", encoding="utf-8") as f: json.dump(data, f, indent=4)
+    tmp_path = f"{filepath}.tmp"
+    with metrics.time("save_config_seconds", file=filename):
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, filepath)
+
+# --- Persistence: write-behind journal for device_states ---
+STATE_FILE = "device_config.json"
+JOURNAL_FILE = "device_config.journal"
+PERSIST_DEBOUNCE_S = 1.0            # changes inside this window are coalesced into one journal append
+SNAPSHOT_INTERVAL_S = 600           # compact the journal into a fresh snapshot at least this often
+SNAPSHOT_MAX_JOURNAL_ENTRIES = 500
+
+class StateJournal:
+    """Append-only change journal for device_states with periodic atomic snapshots.
+
+    Writers call record() / request_snapshot() and return immediately; a background
+    thread coalesces changes per (room, relay, field) and persists them.
+    """
+    def __init__(self, state_file=STATE_FILE, journal_file=JOURNAL_FILE, debounce=PERSIST_DEBOUNCE_S):
+        self.state_file = state_file
+        self.journal_file = journal_file
+        self.debounce = debounce
+        self.cond = threading.Condition()
+        self.write_lock = threading.Lock()
+        self.pending = {}
+        self.snapshot_requested = False
+        self.journal_entries = 0
+        self.last_snapshot = time.monotonic()
+        self.stats = {"records": 0, "coalesced": 0, "journal_appends": 0, "snapshots": 0}
+
+    def record(self, room, relay, **fields):
+        with self.cond:
+            for field, value in fields.items():
+                key = (room, relay, field)
+                if key in self.pending: self.stats["coalesced"] += 1
+                self.pending[key] = value
+                self.stats["records"] += 1
+            self.cond.notify()
+
+    def request_snapshot(self):
+        with self.cond:
+            self.snapshot_requested = True
+            self.cond.notify()
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+        return self
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.snapshot_requested:
+                    self.cond.wait(SNAPSHOT_INTERVAL_S)
+                    if not self.pending and self.journal_entries and time.monotonic() - self.last_snapshot >= SNAPSHOT_INTERVAL_S:
+                        self.snapshot_requested = True
+            time.sleep(self.debounce)
+            try: self.flush()
+            except Exception as e: print(f"[PERSIST] Error: {e}")
+
+    def flush(self):
+        with self.cond:
+            changes, self.pending = self.pending, {}
+            snapshot, self.snapshot_requested = self.snapshot_requested, False
+        with self.write_lock:
+            if changes: self._append(changes)
+            if snapshot or self.journal_entries >= SNAPSHOT_MAX_JOURNAL_ENTRIES or (self.journal_entries and time.monotonic() - self.last_snapshot >= SNAPSHOT_INTERVAL_S):
+                self._snapshot()
+
+    def _append(self, changes):
+        line = json.dumps({"ts": time.time(), "changes": [[room, relay, field, value] for (room, relay, field), value in changes.items()]})
+        with metrics.time("journal_append_seconds"), open(os.path.join(CONFIG_PATH, self.journal_file), "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.journal_entries += 1
+        self.stats["journal_appends"] += 1
+
+    def _snapshot(self):
+        save_config(state_store.snapshot(), self.state_file)
+        # Everything journalled so far is now in the snapshot.
+        open(os.path.join(CONFIG_PATH, self.journal_file), "w").close()
+        self.journal_entries = 0
+        self.last_snapshot = time.monotonic()
+        self.stats["snapshots"] += 1
+
+    def replay(self):
+        # Snapshot + journal -> state; a torn last line from a crash is skipped.
+        states = load_config(self.state_file)
+        journal_path = os.path.join(CONFIG_PATH, self.journal_file)
+        if os.path.exists(journal_path):
+            with open(journal_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try: entry = json.loads(line)
+                    except ValueError: continue
+                    for room, relay, field, value in entry.get("changes", []):
+                        if isinstance(states.get(room, {}).get(relay), dict): states[room][relay][field] = value
+                    self.journal_entries += 1
+        if self.journal_entries: self.snapshot_requested = True
+        return states
+
+state_journal = StateJournal()
+
+# --- Outgoing Node Commands ---
+NODE_COMMAND_INTERVAL_S = 0.05   # minimum gap between two messages to the same node
+node_features = {}               # device_id -> features announced in discovery, e.g. {"batch"}
+
+def node_supports_batch(room):
+    return "batch" in node_features.get(device_room_map.get(room), ())
+
+class CommandDispatcher:
+    """Per-room outgoing command queues, paced by one worker thread instead of sleeps in the caller.
+
+    Relay changes queued for a room are merged until they are sent. Nodes that announced the
+    "batch" feature get them as one "room:BATCH:relay1=ON,relay2=OFF" message; older firmware
+    gets one "room:relay:STATE" message per relay.
+    """
+    def __init__(self, interval=NODE_COMMAND_INTERVAL_S, publish=None, supports_batch=node_supports_batch, clock=time.monotonic):
+        self.interval = interval
+        self.publish = publish or (lambda topic, payload: client.publish(topic, payload))
+        self.supports_batch = supports_batch
+        self.clock = clock
+        self.cond = threading.Condition()
+        self.queues = {}
+        self.next_allowed = {}
+        self.stats = {"messages": 0, "relay_commands": 0, "discarded": 0}
+        self.thread = None
+
+    def send_relays(self, room, changes, on_sent=None):
+        if not changes: return
+        with self.cond:
+            q = self.queues.setdefault(room, collections.deque())
+            if q and q[-1][0] == "relays" and q[-1][2] <= self.clock():
+                q[-1][1].update(changes)
+                if on_sent: q[-1][3].append(on_sent)
+            else: q.append(["relays", dict(changes), 0, [on_sent] if on_sent else []])
+            self._wake()
+
+    def send_raw(self, room, payload, delay=0, on_sent=None):
+        # Returns the queued entry, which discard() takes back while it has not been sent.
+        entry = ["raw", payload, self.clock() + delay, [on_sent] if on_sent else []]
+        with self.cond:
+            self.queues.setdefault(room, collections.deque()).append(entry)
+            self._wake()
+        return entry
+
+    def discard(self, room, entry):
+        with self.cond:
+            q = self.queues.get(room)
+            if q is None or not any(item is entry for item in q): return False
+            q.remove(entry)
+            self.stats["discarded"] += 1
+            return True
+
+    def _wake(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        self.cond.notify()
+
+    def idle(self):
+        with self.cond: return not any(self.queues.values())
+
+    def _next_message(self, now):
+        # Must hold self.cond. Returns (room, payload, callbacks) or the seconds to wait.
+        wait = None
+        for room, q in self.queues.items():
+            if not q: continue
+            ready_at = max(self.next_allowed.get(room, 0), q[0][2])
+            if ready_at > now:
+                wait = ready_at - now if wait is None else min(wait, ready_at - now)
+                continue
+            kind, body, _, callbacks = q[0]
+            if kind == "raw":
+                q.popleft()
+                return room, body, callbacks, 0
+            if self.supports_batch(room):
+                q.popleft()
+                return room, f"{room}:BATCH:" + ",".join(f"{relay}={state}" for relay, state in body.items()), callbacks, len(body)
+            relay = next(iter(body))
+            state = body.pop(relay)
+            if not body: q.popleft()
+            return room, f"{room}:{relay}:{state}", callbacks, 1
+        return wait
+
+    def _run(self):
+        while True:
+            with self.cond:
+                nxt = self._next_message(self.clock())
+                if not isinstance(nxt, tuple):
+                    self.cond.wait(nxt)
+                    continue
+                room, payload, callbacks, relay_count = nxt
+                self.next_allowed[room] = self.clock() + self.interval
+                self.stats["messages"] += 1
+                self.stats["relay_commands"] += relay_count
+            try:
+                with metrics.time("mqtt_publish_seconds", room=room): self.publish(MQTT_PUB_TOPIC, payload)
+                metrics.inc("mqtt_relay_commands_total", relay_count, room=room)
+                for cb in callbacks: cb()
+                callbacks.clear()
+            except Exception as e: print(f"[MQTT] Publish error: {e}")
+
+command_dispatcher = CommandDispatcher()
+
+# --- Device State Store ---
+# Relay changes with these origins are sent to the node; "node" changes are the node's own status echoes.
+PUBLISHING_ORIGINS = ("user", "voice", "mode", "motion", "schedule", "rule")
+
+Change = collections.namedtuple("Change", "version room relay fields origin")   # relay is None for room-level edits
+
+class DeviceStateStore:
+    """device_states behind per-room locks, with a global version on every write and one change feed.
+
+    apply() is an atomic batch across rooms: it locks every room it touches (in sorted order, so two
+    batches never deadlock), checks optional expected versions (compare-and-set), writes only the
+    fields that actually change and hands the resulting Changes to every subscriber while still
+    holding the room locks, so each room's changes reach the feed in version order. Subscribers
+    (SSE, journal, MQTT) must only enqueue.
+    """
+    def __init__(self, rooms):
+        self.rooms = rooms
+        self.lock = threading.RLock()     # room structure and the lock table
+        self.room_locks = {}
+        self.counter = itertools.count(1)
+        self.version = 0
+        self.versions = {}                # (room, relay) -> version of its last write
+        self.room_versions = {}           # room -> version of its last write, relay or room-level
+        self.subscribers = []
+        self.stats = {"writes": 0, "noops": 0, "conflicts": 0, "batches": 0}
+
+    def load(self, states):
+        # In place: module code and templates hold on to the same dict.
+        with self.lock:
+            self.rooms.clear()
+            self.rooms.update(states)
+            self.versions.clear()
+            self.room_versions.clear()
+        return self.rooms
+
+    def subscribe(self, fn):
+        self.subscribers.append(fn)
+        return fn
+
+    def room_lock(self, room):
+        with self.lock: return self.room_locks.setdefault(room, threading.RLock())
+
+    def version_of(self, room, relay): return self.versions.get((room, relay), 0)
+
+    def room_version(self, room): return self.room_versions.get(room, 0)
+
+    def _emit(self, changes, on_sent=None):
+        for fn in self.subscribers:
+            try: fn(changes, on_sent)
+            except Exception as e: print(f"[STATE] Subscriber {fn.__name__} failed: {e}")
+
+    def _stamp(self, room, relay, fields, origin):
+        version = self.version = next(self.counter)
+        if relay is not None: self.versions[(room, relay)] = version
+        self.room_versions[room] = version
+        return Change(version, room, relay, fields, origin)
+
+    def update(self, room, relay, origin, expect_version=None, on_sent=None, **fields):
+        expect = None if expect_version is None else {(room, relay): expect_version}
+        return self.apply({room: {relay: fields}}, origin, expect=expect, on_sent=on_sent)
+
+    def apply(self, updates, origin, expect=None, on_sent=None):
+        # updates: {room: {relay: {field: value}}}. Returns the Changes made ([] if all were no-ops),
+        # or None, with nothing written, if any (room, relay) in `expect` has moved past its version.
+        rooms = sorted(room for room in updates if room in self.rooms)
+        locks = [self.room_lock(room) for room in rooms]
+        for lock in locks: lock.acquire()
+        try:
+            # A rename or remove may have got in before the locks were held: skip rooms that are gone or whose lock moved on.
+            rooms = [room for room, lock in zip(rooms, locks) if room in self.rooms and self.room_locks.get(room) is lock]
+            if expect and any(self.versions.get(key, 0) != version for key, version in expect.items()):
+                self.stats["conflicts"] += 1
+                return None
+            changes = []
+            for room in rooms:
+                for relay, fields in updates[room].items():
+                    data = self.rooms[room].get(relay)
+                    if not isinstance(data, dict): continue
+                    changed = {field: value for field, value in fields.items() if data.get(field) != value}
+                    if not changed:
+                        self.stats["noops"] += 1
+                        continue
+                    data.update(changed)
+                    changes.append(self._stamp(room, relay, changed, origin))
+            self.stats["writes"] += len(changes)
+            self.stats["batches"] += 1
+            if changes: self._emit(changes, on_sent)
+            return changes
+        finally:
+            for lock in reversed(locks): lock.release()
+
+    def put_room(self, room, data, origin="user"):
+        # Under the room's lock too, so an apply() in progress never writes into the dict being replaced.
+        with self.lock, self.room_lock(room):
+            self.rooms[room] = data
+            self._emit([self._stamp(room, None, {"room": "put"}, origin)])
+
+    def rename_room(self, old, new, origin="user"):
+        with self.lock, self.room_lock(old):
+            if old not in self.rooms or new in self.rooms: return False
+            self.rooms[new] = self.rooms.pop(old)
+            self.room_locks[new] = self.room_locks.pop(old)
+            for (room, relay) in [key for key in self.versions if key[0] == old]: self.versions[(new, relay)] = self.versions.pop((room, relay))
+            self.room_versions.pop(old, None)
+            self._emit([self._stamp(new, None, {"room": "rename", "from": old}, origin)])
+            return True
+
+    def remove_room(self, room, origin="user"):
+        with self.lock, self.room_lock(room):
+            if self.rooms.pop(room, None) is None: return False
+            for key in [key for key in self.versions if key[0] == room]: del self.versions[key]
+            self._emit([self._stamp(room, None, {"room": "remove"}, origin)])
+            self.room_versions.pop(room, None)
+        with self.lock: self.room_locks.pop(room, None)
+        return True
+
+    def edit_room(self, room, edit, origin="user"):
+        # edit(room_data) runs under the room's lock; labels, wake word and timeouts are room-level edits.
+        with self.lock, self.room_lock(room):
+            if room not in self.rooms: return False
+            edit(self.rooms[room])
+            self._emit([self._stamp(room, None, {"room": "edit"}, origin)])
+            return True
+
+    def view(self, fn, rooms=None):
+        # fn() with every room (or just `rooms`) locked: what it reads never mixes half-applied batches, and
+        # since changes are emitted under the same locks, it sees exactly the changes the feed has had.
+        with self.lock:
+            locks = [self.room_lock(room) for room in sorted(self.rooms if rooms is None else set(rooms) & set(self.rooms))]
+            for lock in locks: lock.acquire()
+            try: return fn()
+            finally:
+                for lock in reversed(locks): lock.release()
+
+    def snapshot(self):
+        # Deep copy, so the persisted file never mixes half-applied batches.
+        return self.view(lambda: json.loads(json.dumps(self.rooms)))
+
+state_store = DeviceStateStore(device_states)
+
+@state_store.subscribe
+def broadcast_changes(changes, on_sent):
+    # Tagged with the change's version, so a dashboard can skip what its /api/state snapshot already has.
+    for change in changes:
+        if change.relay is None:
+            broadcast_update({"type": "room_update", "room": change.room, "change": change.fields["room"], "from": change.fields.get("from"), "version": change.version})
+            continue
+        if "status" in change.fields:
+            broadcast_update({"type": "status_update", "room": change.room, "relay": change.relay, "status": change.fields["status"], "version": change.version})
+        if "motion_control" in change.fields:
+            broadcast_update({"type": "motion_update", "room": change.room, "relay": change.relay, "motion_control": change.fields["motion_control"], "version": change.version})
+
+@state_store.subscribe
+def persist_changes(changes, on_sent):
+    for change in changes:
+        if change.relay is None: state_journal.request_snapshot()
+        else: state_journal.record(change.room, change.relay, **change.fields)
+
+@state_store.subscribe
+def publish_changes(changes, on_sent):
+    per_room = {}
+    for change in changes:
+        if change.relay is not None and change.origin in PUBLISHING_ORIGINS and "status" in change.fields:
+            per_room.setdefault(change.room, {})[change.relay] = change.fields["status"]
+    for room, relays in per_room.items(): command_dispatcher.send_relays(room, relays, on_sent=on_sent)
+
+@state_store.subscribe
+def invalidate_grammar(changes, on_sent):
+    # Room-level edits can rename rooms or relabel relays: the voice grammar and matcher index go stale.
+    if any(change.relay is None for change in changes): bump_config_version()
+
+
+# --- Node Config Sync ---
+CONFIG_SYNC_DEBOUNCE_S = 0.5        # edits and status changes inside this window go out as one delta / one snapshot
+CONFIG_SYNC_HISTORY = 8             # versions remembered per node, so a node a few edits behind gets a delta
+CONFIG_SNAPSHOT_SUFFIX = "/snapshot"
+NODE_CONFIG_FIELDS = ("label", "motion_control", "motion_timeout")
+
+def node_config(room):
+    # What a node is versioned against, flattened ("relay3.label") so a delta is just the keys that differ.
+    # Relay status is not part of it: discovery carries the node's actual relays and those are reconciled directly.
+    data = device_states.get(room, {})
+    config = {"room": room, "wake_word": data.get("wake_word"), "motion_timeout": data.get("motion_timeout")}
+    for relay, value in data.items():
+        if isinstance(value, dict): config.update({f"{relay}.{field}": value[field] for field in NODE_CONFIG_FIELDS if field in value})
+    return config
+
+def node_config_version(config): return format(zlib.crc32(json.dumps(config, sort_keys=True).encode("utf-8")), "08x")
+
+def relay_states(room):
+    return {relay: value.get("status", "OFF") for relay, value in device_states.get(room, {}).items() if isinstance(value, dict)}
+
+class ConfigSync:
+    """Versioned config for every assigned node: deltas on change, a retained snapshot per node, quiet discovery.
+
+    - home/config/<id>/snapshot (retained) holds {"v", "config", "state"}; a node with no stored version
+      picks it up from the broker on subscribe, without the hub doing anything.
+    - home/config/<id> gets {"v", "base", "set"} when the node is known to hold `base`, else the full
+      snapshot; {"action": "reset"} stays as it was.
+    - Discovery carries the node's "config_version" and its relays as a bitmask ("relays": "10100000").
+      A current node gets no payload; relays that drifted (commands lost while it was offline) get one
+      relay command batch. Nodes that announce neither are left alone as before.
+    """
+    def __init__(self, debounce=CONFIG_SYNC_DEBOUNCE_S):
+        self.debounce = debounce
+        self.cond = threading.Condition()
+        self.dirty_config = set()        # rooms whose node config changed
+        self.dirty_state = set()         # rooms whose retained snapshot is behind on relay status
+        self.history = {}                # device_id -> OrderedDict(version -> config)
+        self.node_versions = {}          # device_id -> version the node is known (or assumed) to hold
+        self.retained = {}               # device_id -> (version, state) the broker holds
+        self.stats = {"discoveries": 0, "current": 0, "deltas": 0, "full": 0, "relay_fixes": 0, "snapshots": 0, "snapshots_skipped": 0, "bytes": 0}
+
+    def start(self):
+        threading.Thread(target=self._run, name="config-sync", daemon=True).start()
+        return self
+
+    def mark(self, room, config=True):
+        with self.cond:
+            (self.dirty_config if config else self.dirty_state).add(room)
+            self.cond.notify()
+
+    def mark_all(self):
+        # After (re)connecting: check every node's retained snapshot once the broker has replayed them.
+        with self.cond:
+            self.dirty_state.update(device_room_map)
+            self.cond.notify()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.dirty_config and not self.dirty_state: self.cond.wait()
+            time.sleep(self.debounce)
+            with self.cond:
+                config_rooms, state_rooms = self.dirty_config, self.dirty_state
+                self.dirty_config, self.dirty_state = set(), set()
+            try:
+                for room in config_rooms:
+                    if room in device_room_map: self.push(device_room_map[room], room)
+                for room in config_rooms | state_rooms:
+                    if room in device_room_map: self.publish_snapshot(device_room_map[room], room)
+            except Exception as e: print(f"[SYNC] Error: {e}")
+
+    def _publish(self, topic, doc, retain=False):
+        payload = json.dumps(doc, separators=(",", ":"))
+        self.stats["bytes"] += len(payload)
+        client.publish(topic, payload, retain=retain)
+
+    def _current(self, device_id, room):
+        config = node_config(room)
+        version = node_config_version(config)
+        with self.cond:
+            history = self.history.setdefault(device_id, collections.OrderedDict())
+            history[version] = config
+            history.move_to_end(version)
+            while len(history) > CONFIG_SYNC_HISTORY: history.popitem(last=False)
+        return version, config
+
+    def push(self, device_id, room, full=False):
+        # Returns "delta" or "full" (which carries relay state too), or None if the node is already current.
+        # Runs from requests, the sync thread and discovery: the base read, the publish and the new version are
+        # one step under the condition, so a delta always starts from a version the node was really sent.
+        with self.cond:
+            version, config = self._current(device_id, room)
+            base = self.node_versions.get(device_id)
+            if base == version and not full: return None
+            old = None if full else self.history.get(device_id, {}).get(base)
+            if old is not None:
+                self._publish(f"{MQTT_CONFIG_TOPIC_PREFIX}{device_id}", {"v": version, "base": base, "set": {k: config.get(k) for k in old.keys() | config.keys() if old.get(k) != config.get(k)}})
+                self.stats["deltas"] += 1
+                kind = "delta"
+            else:
+                self._publish(f"{MQTT_CONFIG_TOPIC_PREFIX}{device_id}", {"v": version, "config": config, "state": relay_states(room)})
+                self.stats["full"] += 1
+                kind = "full"
+            self.node_versions[device_id] = version
+            return kind
+
+    def publish_snapshot(self, device_id, room):
+        version, config = self._current(device_id, room)
+        state = relay_states(room)
+        with self.cond:
+            if self.retained.get(device_id) == (version, state):
+                self.stats["snapshots_skipped"] += 1
+                return
+            self.retained[device_id] = (version, state)
+        self._publish(f"{MQTT_CONFIG_TOPIC_PREFIX}{device_id}{CONFIG_SNAPSHOT_SUFFIX}", {"v": version, "config": config, "state": state}, retain=True)
+        self.stats["snapshots"] += 1
+
+    def note_retained(self, device_id, payload):
+        # The broker replaying (or echoing) a retained snapshot: remember it so an unchanged one is not republished.
+        try: doc = json.loads(payload) if payload else None
+        except ValueError: return
+        with self.cond:
+            if not doc:
+                self.retained.pop(device_id, None)
+                return
+            self.retained[device_id] = (doc.get("v"), doc.get("state"))
+            # After a restart this is the only copy of what the node was last sent, so nodes on it still get deltas.
+            if isinstance(doc.get("config"), dict): self.history.setdefault(device_id, collections.OrderedDict()).setdefault(doc.get("v"), doc["config"])
+
+    def discovered(self, device_id, room, info):
+        self.stats["discoveries"] += 1
+        if "config_version" not in info and "relays" not in info: return
+        with self.cond:
+            # What the node says it holds, and the push from it, in one step: no other push can land in between.
+            self.node_versions[device_id] = info.get("config_version")
+            version, _ = self._current(device_id, room)
+            if info.get("config_version") == version: self.stats["current"] += 1
+            elif self.push(device_id, room) == "full": return
+        mask = info.get("relays")
+        if mask:
+            drifted = {relay: status for relay, status in relay_states(room).items()
+                       if relay.startswith("relay") and relay[5:].isdigit() and int(relay[5:]) <= len(mask) and (mask[int(relay[5:]) - 1] == "1") != (status == "ON")}
+            if drifted:
+                self.stats["relay_fixes"] += 1
+                command_dispatcher.send_relays(room, drifted)
+
+    def forget(self, device_id):
+        # Unassigned or its room removed: clear the retained snapshot so a fresh node does not pick it up.
+        with self.cond:
+            self.history.pop(device_id, None)
+            self.node_versions.pop(device_id, None)
+            self.retained.pop(device_id, None)
+        client.publish(f"{MQTT_CONFIG_TOPIC_PREFIX}{device_id}{CONFIG_SNAPSHOT_SUFFIX}", b"", retain=True)
+
+config_sync = ConfigSync()
+
+@state_store.subscribe
+def sync_node_config(changes, on_sent):
+    for change in changes:
+        config = change.relay is None or any(field != "status" for field in change.fields)
+        if change.room in device_room_map: config_sync.mark(change.room, config=config)
+
+def bump_config_version():
+    # Rooms, labels or modes changed: invalidates the cached voice grammar.
+    global config_version
+    with config_version_lock: config_version += 1
+
+# --- Command Log ---
+LOG_DIR = "logs"
+LOG_RING_SIZE = 1000                # newest records kept in memory, answered without touching disk
+LOG_FLUSH_S = 2.0                   # records are appended to disk in batches at most this often
+LOG_SEGMENT_BYTES = 1024 * 1024     # rotate to a new segment file past this size
+LOG_MAX_SEGMENTS = 20
+LOG_INDEX_STRIDE = 16384            # bytes between (timestamp, offset) seek marks in a segment
+LOG_QUERY_MAX = 1000
+# Per-category (events per second, burst) for what reaches the console and the dashboards; disk gets everything.
+LOG_BROADCAST_LIMITS = {"VAD": (0.5, 3), "KWS": (0.5, 3), "SKIPPED": (1, 5), "LATENCY": (1, 5), "RULE": (2, 10)}
+LOG_BROADCAST_DEFAULT = (10, 30)
+
+LogRecord = collections.namedtuple("LogRecord", "seq ts room category message")
+
+class CommandLog:
+    """Structured command log: a bounded in-memory ring plus rotating JSON-lines segments on disk.
+
+    A small index (per segment: seq and time range, room and category counts, sparse time->offset
+    marks) lets /logs skip segments that cannot match and seek inside the ones that can.
+    """
+    def __init__(self, ring_size=LOG_RING_SIZE, flush_interval=LOG_FLUSH_S):
+        self.ring = collections.deque(maxlen=ring_size)
+        self.pending = collections.deque(maxlen=ring_size * 10)
+        self.flush_interval = flush_interval
+        self.cond = threading.Condition()
+        self.write_lock = threading.Lock()
+        self.seq = 0
+        self.segments = []
+        self.buckets = {}
+        self.thread = None
+        self.stats = {"records": 0, "flushes": 0, "rotations": 0, "broadcast": 0, "suppressed": 0, "disk_queries": 0}
+
+    def _path(self, name=""): return os.path.join(CONFIG_PATH, LOG_DIR, name)
+
+    def start(self):
+        # Picks up the on-disk index, refills the ring from the newest segment and starts the writer.
+        os.makedirs(self._path(), exist_ok=True)
+        index = load_config(os.path.join(LOG_DIR, "index.json"))
+        with self.write_lock:
+            self.segments = [s for s in index.get("segments", []) if os.path.exists(self._path(s["file"]))]
+            recent = self._read_segment(self.segments[-1], 0) if self.segments else []
+        with self.cond:
+            # Anything logged before start() is renumbered to follow what is already on disk.
+            offset = self.segments[-1]["last_seq"] if self.segments else 0
+            self.seq += offset
+            logged = [r._replace(seq=r.seq + offset) for r in self.ring]
+            self.pending = collections.deque((r._replace(seq=r.seq + offset) for r in self.pending), maxlen=self.pending.maxlen)
+            self.ring.clear()
+            self.ring.extend(recent[-self.ring.maxlen:])
+            self.ring.extend(logged)
+        self.thread = threading.Thread(target=self._run, name="command-log", daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+        return self
+
+    def append(self, message, room=None, category=None):
+        if category is None and message.startswith("[") and "]" in message:
+            category, message = message[1:message.index("]")], message[message.index("]") + 1:].strip()
+        with self.cond:
+            self.seq += 1
+            record = LogRecord(self.seq, time.time(), room, category or "INFO", message)
+            self.ring.append(record)
+            self.pending.append(record)
+            self.stats["records"] += 1
+        return record
 
-def log_command(message):
-    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    log_entry = f"{timestamp} - {message}"
-    command_log.insert(0, log_entry)
+    def allow_broadcast(self, category):
+        # Token bucket per category; returns how many records were held back since the last one let through, or None to hold this one.
+        rate, burst = LOG_BROADCAST_LIMITS.get(category, LOG_BROADCAST_DEFAULT)
+        now = time.monotonic()
+        with self.cond:
+            tokens, last, held = self.buckets.get(category, (burst, now, 0))
+            tokens = min(burst, tokens + (now - last) * rate)
+            if tokens < 1:
+                self.buckets[category] = (tokens, now, held + 1)
+                self.stats["suppressed"] += 1
+                return None
+            self.buckets[category] = (tokens - 1, now, 0)
+            self.stats["broadcast"] += 1
+            return held
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try: self.flush()
+            except Exception as e: print(f"[LOG] Error writing command log: {e}")
+
+    def flush(self):
+        with self.cond:
+            batch = list(self.pending)
+            self.pending.clear()
+        if not batch: return
+        with self.write_lock:
+            if not self.segments or self.segments[-1]["bytes"] >= LOG_SEGMENT_BYTES: self._rotate(batch[0])
+            segment = self.segments[-1]
+            lines = "".join(json.dumps(record._asdict()) + "\n" for record in batch).encode("utf-8")
+            if not segment["marks"] or segment["bytes"] - segment["marks"][-1][1] >= LOG_INDEX_STRIDE: segment["marks"].append([batch[0].ts, segment["bytes"]])
+            with open(self._path(segment["file"]), "ab") as f: f.write(lines)
+            segment["bytes"] += len(lines)
+            segment["last_seq"], segment["last_ts"] = batch[-1].seq, batch[-1].ts
+            for record in batch:
+                if record.room: segment["rooms"][record.room] = segment["rooms"].get(record.room, 0) + 1
+                segment["categories"][record.category] = segment["categories"].get(record.category, 0) + 1
+            save_config({"segments": self.segments}, os.path.join(LOG_DIR, "index.json"))
+            self.stats["flushes"] += 1
+
+    def _rotate(self, first):
+        name = f"commands-{first.seq:010d}.jsonl"
+        self.segments.append({"file": name, "first_seq": first.seq, "last_seq": first.seq, "first_ts": first.ts, "last_ts": first.ts,
+                              "bytes": 0, "rooms": {}, "categories": {}, "marks": []})
+        while len(self.segments) > LOG_MAX_SEGMENTS:
+            try: os.remove(self._path(self.segments.pop(0)["file"]))
+            except OSError: pass
+        self.stats["rotations"] += 1
+
+    def _read_segment(self, segment, since, needles=()):
+        # Seeks to the last mark at or before `since`; lines missing any of `needles` are skipped without
+        # parsing, and so is a torn last line from a crash.
+        marks = segment["marks"]
+        i = bisect.bisect_right([ts for ts, _ in marks], since) - 1
+        records = []
+        try:
+            with open(self._path(segment["file"]), "rb") as f:
+                f.seek(marks[i][1] if i >= 0 else 0)
+                for line in f:
+                    if needles and not all(needle in line for needle in needles): continue
+                    try: records.append(LogRecord(**json.loads(line)))
+                    except (ValueError, TypeError): continue
+        except OSError: pass
+        return records
+
+    def query(self, room=None, category=None, since=0, until=None, limit=100):
+        """Newest-first records matching every given filter; the ring first, then only the segments whose index can match."""
+        until = until or float("inf")
+        match = lambda r: (room is None or r.room == room) and (category is None or r.category == category) and since <= r.ts <= until
+        with self.cond: recent = list(self.ring)
+        results = [r for r in reversed(recent) if match(r)][:limit]
+        oldest_in_ring = recent[0].seq if recent else self.seq + 1
+        if len(results) >= limit or (recent and recent[0].ts <= since): return results
+        with self.write_lock: segments = [dict(s) for s in self.segments]
+        needles = [json.dumps({key: value})[1:-1].encode("utf-8") for key, value in (("room", room), ("category", category)) if value is not None]
+        for segment in reversed(segments):
+            if segment["first_seq"] >= oldest_in_ring or segment["last_ts"] < since or segment["first_ts"] > until: continue
+            if (room is not None and room not in segment["rooms"]) or (category is not None and category not in segment["categories"]): continue
+            self.stats["disk_queries"] += 1
+            older = [r for r in self._read_segment(segment, since, needles) if r.seq < oldest_in_ring and match(r)]
+            results.extend(reversed(older[-(limit - len(results)):]))
+            if len(results) >= limit: break
+        return results
+
+command_log = CommandLog()
+
+def log_command(message, room=None, category=None):
+    record = command_log.append(message, room, category)
+    held = command_log.allow_broadcast(record.category)
+    if held is None: return
+    log_entry = f"{datetime.datetime.fromtimestamp(record.ts):%Y-%m-%d %H:%M:%S} - [{record.category}] {record.message}"
+    if held: log_entry += f" (+{held} more {record.category} suppressed)"
     print(log_entry)
-    if len(command_log) > 100: command_log.pop()
-    broadcast_update({"type": "log", "log": log_entry})
+    broadcast_update({"type": "log", "log": log_entry, "room": record.room, "category": record.category})
+
+# --- History ---
+# Every relay status transition and motion trigger, kept three ways under history/:
+#   raw-YYYYMMDD.bin     fixed 9-byte records (epoch s, ms, series id, value), appended in batches
+#   hourly-YYYYMM.bin    per series and hour: events and seconds ON (10 bytes), only for hours with either
+#   daily-YYYY.bin       per series and local day: the same (14 bytes)
+#   series.json          series id -> "room/relay" (or "room/motion")
+# Raw files are dropped after HISTORY_RAW_DAYS and hourly ones after HISTORY_HOURLY_DAYS; daily rollups are kept.
+HISTORY_DIR = "history"
+HISTORY_FLUSH_S = 30                # raw records are appended to disk in batches at most this often
+HISTORY_RAW_DAYS = 14
+HISTORY_HOURLY_DAYS = 400
+HISTORY_QUERY_MAX_DAYS = 3660
+HISTORY_MOTION = "motion"           # the relay slot of a room's motion series, e.g. "hall/motion"
+HISTORY_RAW = np.dtype([("ts", "<u4"), ("ms", "<u2"), ("series", "<u2"), ("value", "u1")])
+HISTORY_HOURLY = np.dtype([("start", "<u4"), ("series", "<u2"), ("events", "<u2"), ("on_s", "<u2")])
+HISTORY_DAILY = np.dtype([("start", "<u4"), ("series", "<u2"), ("events", "<u4"), ("on_s", "<u4")])
+
+def local_day_start(ts):
+    return int(datetime.datetime.fromtimestamp(ts).replace(hour=0, minute=0, second=0, microsecond=0).timestamp())
+
+class HistoryStore:
+    """Append-only history of relay transitions and motion with hourly and daily rollups.
+
+    record_*() only queue; a background thread appends raw records in batches and, as hours and days
+    close, appends their rollups. Seconds ON are accounted as transitions arrive, so a rollup never
+    needs the raw records again. state.json (written as each hour closes) holds where the rollups
+    stop, which relays were ON since when and the open day's sums; on start the raw records after
+    that point are replayed to rebuild the open hour. Room renames start new series.
+    """
+    def __init__(self, clock=time.time, flush_interval=HISTORY_FLUSH_S, raw_days=HISTORY_RAW_DAYS, hourly_days=HISTORY_HOURLY_DAYS):
+        self.clock = clock
+        self.flush_interval = flush_interval
+        self.raw_days = raw_days
+        self.hourly_days = hourly_days
+        self.cond = threading.Condition()
+        self.write_lock = threading.Lock()
+        self.series = {}                # "room/relay" -> id
+        self.names = []                 # id -> "room/relay"
+        self.pending = []
+        self.hours = {}                 # open hour start -> {series id: [events, seconds ON]}
+        self.days = {}                  # open local day start -> {series id: [events, seconds ON]} of its closed hours
+        self.current = {}               # relay series id -> [value, since]
+        self.rolled_until = None        # hours before this are in the hourly files
+        self.saved_series = 0
+        self.thread = None
+        self.stats = {"records": 0, "flushes": 0, "raw_bytes": 0, "hourly_rows": 0, "daily_rows": 0, "queries": 0}
+
+    def _path(self, name=""): return os.path.join(CONFIG_PATH, HISTORY_DIR, name)
+
+    def _series_id(self, name):
+        # Must hold self.cond.
+        sid = self.series.get(name)
+        if sid is None:
+            sid = self.series[name] = len(self.names)
+            self.names.append(name)
+        return sid
+
+    def record_status(self, room, relay, status, ts=None): self._record(f"{room}/{relay}", 1 if status == "ON" else 0, ts, True)
+
+    def record_motion(self, room, ts=None): self._record(f"{room}/{HISTORY_MOTION}", 1, ts, False)
+
+    def _record(self, name, value, ts, relay):
+        ts = self.clock() if ts is None else ts
+        with self.cond:
+            sid = self._series_id(name)
+            self.pending.append((int(ts), int(ts * 1000) % 1000, sid, value))
+            self._account(sid, value, ts, relay)
+            self.stats["records"] += 1
+
+    def _bucket(self, hour, sid):
+        return self.hours.setdefault(max(hour, self.rolled_until or hour), {}).setdefault(sid, [0, 0.0])
+
+    def _add_on(self, sid, start, end):
+        while start < end:
+            hour = int(start) - int(start) % 3600
+            stop = min(end, hour + 3600)
+            self._bucket(hour, sid)[1] += stop - start
+            start = stop
+
+    def _account(self, sid, value, ts, relay):
+        # Must hold self.cond.
+        self._bucket(int(ts) - int(ts) % 3600, sid)[0] += 1
+        if not relay: return
+        prev = self.current.get(sid)
+        if prev and prev[0]: self._add_on(sid, prev[1], ts)
+        self.current[sid] = [value, ts]
+
+    def start(self, states=None):
+        os.makedirs(self._path(), exist_ok=True)
+        saved = load_config(os.path.join(HISTORY_DIR, "state.json"))
+        now = self.clock()
+        with self.cond:
+            for name in load_config(os.path.join(HISTORY_DIR, "series.json")).get("series", []): self._series_id(name)
+            self.saved_series = len(self.names)
+            self.rolled_until = saved.get("rolled_until") or int(now) - int(now) % 3600
+            self.current = {int(sid): entry for sid, entry in saved.get("current", {}).items()}
+            self.days = {int(day): {int(sid): sums for sid, sums in series.items()} for day, series in saved.get("days", {}).items()}
+            # The open hours are rebuilt from the raw records written after the last rollup.
+            for record in self._read_raw(self.rolled_until, now):
+                self._account(int(record["series"]), int(record["value"]), record["ts"] + record["ms"] / 1000, not self.names[record["series"]].endswith("/" + HISTORY_MOTION))
+            # Relays already ON that history has never seen count from now.
+            for room, data in (states or {}).items():
+                for relay, value in data.items():
+                    if isinstance(value, dict) and value.get("status") == "ON" and f"{room}/{relay}" not in self.series:
+                        self.current[self._series_id(f"{room}/{relay}")] = [1, now]
+        self.thread = threading.Thread(target=self._run, name="history", daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+        return self
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try: self.flush()
+            except Exception as e: print(f"[HISTORY] Error: {e}")
+
+    def flush(self, now=None):
+        now = self.clock() if now is None else now
+        with self.cond:
+            batch, self.pending = self.pending, []
+            names = list(self.names) if len(self.names) != self.saved_series else None
+        with self.write_lock:
+            # Before the records that use them, so a restart can always name what it replays.
+            if names:
+                save_config({"series": names}, os.path.join(HISTORY_DIR, "series.json"))
+                self.saved_series = len(names)
+            if batch:
+                records = np.array(batch, dtype=HISTORY_RAW)
+                # A batch can straddle midnight: one append per day file.
+                days = np.array([local_day_start(ts) for ts in range(int(records["ts"][0]), int(records["ts"][-1]) + 86400, 86400)] + [2 ** 32 - 1])
+                for start, end in zip(days[:-1], days[1:]):
+                    part = records[(records["ts"] >= start) & (records["ts"] < end)]
+                    if len(part): self._append(f"raw-{datetime.datetime.fromtimestamp(start):%Y%m%d}.bin", part)
+                self.stats["raw_bytes"] += records.nbytes
+                self.stats["flushes"] += 1
+            if self.rolled_until is not None and now >= self.rolled_until + 3600: self._roll(now)
+
+    def _append(self, name, rows):
+        with open(self._path(name), "ab") as f: f.write(rows.tobytes())
+
+    def _roll(self, now):
+        # Closes every hour that has ended: carries ON time up to its end, appends its rollup and folds it into its day.
+        with self.cond:
+            closed_days = []
+            while self.rolled_until + 3600 <= now:
+                hour = self.rolled_until
+                end = hour + 3600
+                for sid, entry in self.current.items():
+                    if entry[0] and entry[1] < end:
+                        self._add_on(sid, entry[1], end)
+                        entry[1] = end
+                sums = self.hours.pop(hour, {})
+                rows = [(hour, sid, min(events, 65535), min(round(on_s), 3600)) for sid, (events, on_s) in sums.items()]
+                if rows:
+                    self._append(f"hourly-{datetime.datetime.fromtimestamp(hour):%Y%m}.bin", np.array(rows, dtype=HISTORY_HOURLY))
+                    self.stats["hourly_rows"] += len(rows)
+                day = local_day_start(hour)
+                totals = self.days.setdefault(day, {})
+                for sid, (events, on_s) in sums.items():
+                    total = totals.setdefault(sid, [0, 0.0])
+                    total[0] += events
+                    total[1] += on_s
+                self.rolled_until = end
+                if local_day_start(end) != day: closed_days.append(day)
+            for day in closed_days:
+                rows = [(day, sid, events, round(on_s)) for sid, (events, on_s) in self.days.pop(day, {}).items()]
+                if rows:
+                    self._append(f"daily-{datetime.datetime.fromtimestamp(day):%Y}.bin", np.array(rows, dtype=HISTORY_DAILY))
+                    self.stats["daily_rows"] += len(rows)
+            state = {"rolled_until": self.rolled_until, "current": self.current,
+                     "days": {day: {sid: sums for sid, sums in series.items()} for day, series in self.days.items()}}
+            save_config(state, os.path.join(HISTORY_DIR, "state.json"))
+        if closed_days: self._expire(now)
+
+    def _expire(self, now):
+        raw_cutoff = f"raw-{datetime.datetime.fromtimestamp(now - self.raw_days * 86400):%Y%m%d}.bin"
+        hourly_cutoff = f"hourly-{datetime.datetime.fromtimestamp(now - self.hourly_days * 86400):%Y%m}.bin"
+        for name in os.listdir(self._path()):
+            if (name.startswith("raw-") and name < raw_cutoff) or (name.startswith("hourly-") and name < hourly_cutoff):
+                try: os.remove(self._path(name))
+                except OSError: pass
+
+    def _files(self, prefix, fmt, since, until, step):
+        # Names of the files that can hold [since, until): one per day, month or year.
+        names, t = [], since
+        while t < until + step:
+            name = f"{prefix}-{datetime.datetime.fromtimestamp(t):{fmt}}.bin"
+            if name not in names: names.append(name)
+            t += step
+        return [name for name in names if os.path.exists(self._path(name))]
+
+    def _load(self, names, dtype):
+        with self.write_lock: parts = [np.fromfile(self._path(name), dtype=dtype) for name in names]
+        return np.concatenate(parts) if parts else np.zeros(0, dtype=dtype)
+
+    def _read_raw(self, since, until):
+        rows = self._load(self._files("raw", "%Y%m%d", since, until, 43200), HISTORY_RAW)
+        return rows[(rows["ts"] >= since) & (rows["ts"] < until)]
+
+    def _open_rows(self, now, daily):
+        # What has not reached the rollup files yet, as rows in the daily layout: open hours (or days), with relays still ON counted up to now.
+        with self.cond:
+            hours = {hour: {sid: list(sums) for sid, sums in series.items()} for hour, series in self.hours.items()}
+            for sid, (value, since) in self.current.items():
+                while value and since < now:
+                    hour = int(since) - int(since) % 3600
+                    stop = min(now, hour + 3600)
+                    hours.setdefault(max(hour, self.rolled_until), {}).setdefault(sid, [0, 0.0])[1] += stop - since
+                    since = stop
+            if not daily: return np.array([(hour, sid, e, round(s)) for hour, series in hours.items() for sid, (e, s) in series.items()], dtype=HISTORY_DAILY)
+            days = {day: {sid: list(sums) for sid, sums in series.items()} for day, series in self.days.items()}
+        for hour, series in hours.items():
+            totals = days.setdefault(local_day_start(hour), {})
+            for sid, (events, on_s) in series.items():
+                total = totals.setdefault(sid, [0, 0.0])
+                total[0] += events
+                total[1] += on_s
+        return np.array([(day, sid, e, round(s)) for day, series in days.items() for sid, (e, s) in series.items()], dtype=HISTORY_DAILY)
+
+    def match_series(self, room=None, relay=None):
+        with self.cond: return {name: sid for name, sid in self.series.items() if (room is None or name.split("/", 1)[0] == room) and (relay is None or name.split("/", 1)[1] == relay)}
+
+    def query(self, series, since, until, resolution="hour"):
+        """Rollup rows (start, series, events, on_s) for the given series ids in [since, until), from the files plus what is still open.
+
+        Rows are whole buckets: an hour (or local day) is included if it starts inside the range.
+        """
+        self.stats["queries"] += 1
+        now = self.clock()
+        if resolution == "day":
+            since, rows = local_day_start(since), self._load(self._files("daily", "%Y", local_day_start(since), until, 86400 * 28), HISTORY_DAILY)
+        else:
+            since -= since % 3600
+            rows = self._load(self._files("hourly", "%Y%m", since, until, 86400 * 28), HISTORY_HOURLY).astype(HISTORY_DAILY)
+        rows = np.concatenate([rows, self._open_rows(now, resolution == "day")])
+        ids = np.fromiter(series, dtype=np.uint16)
+        return rows[(rows["start"] >= since) & (rows["start"] < until) & np.isin(rows["series"], ids)]
+
+    def transitions(self, series, since, until):
+        # Raw records, decoded: only for ranges still inside HISTORY_RAW_DAYS.
+        with self.cond: pending = np.array(self.pending, dtype=HISTORY_RAW)
+        rows = np.concatenate([self._read_raw(since, until), pending[(pending["ts"] >= since) & (pending["ts"] < until)]])
+        return rows[np.isin(rows["series"], np.fromiter(series, dtype=np.uint16))]
+
+history = HistoryStore()
+
+@state_store.subscribe
+def record_history(changes, on_sent):
+    for change in changes:
+        if change.relay is not None and "status" in change.fields: history.record_status(change.room, change.relay, change.fields["status"])
 
 # --- TIME SYNC ROUTE ---
 @app.route('/sync_time', methods=['POST'])
@@ -98,6 +1365,8 @@ def sync_time():
         try:
             subprocess.run(["sudo", "date", "-s", time_str], check=True)
             subprocess.run(["sudo", "hwclock", "-w"], check=False)
+            mode_scheduler.clock_changed()
+            rule_engine.scheduler.clock_changed()
             print(f"[TIME] Synced to {time_str}")
             return "Synced", 200
         except Exception as e:
@@ -106,173 +1375,1117 @@ def sync_time():
     return "Invalid", 400
 
 # --- SCHEDULER & MODE LOGIC ---
-def execute_mode(mode_name, mode_data, turn_off_mode=False):
-    action_text = "Deactivating" if turn_off_mode else "Activating"
-    log_command(f"[MODE] {action_text} '{mode_name}'...")
-    
-    # 1. EXECUTE RELAY ACTIONS
-    actions = mode_data.get("actions", {})
-    device_switched = False
-    
-    for room, relays in actions.items():
-        if room in device_states:
-            for relay, state in relays.items():
-                target_state = "OFF" if turn_off_mode else state
-                current = device_states[room].get(relay, {}).get('status', 'OFF')
-                
-                if current != target_state:
-                    device_states[room][relay]['status'] = target_state
-                    client.publish(MQTT_PUB_TOPIC, f"{room}:{relay}:{target_state}")
-                    broadcast_update({"type": "status_update", "room": room, "relay": relay, "status": target_state})
-                    device_switched = True
-                    time.sleep(0.1) 
-    
-    if device_switched:
-        save_config(device_states, "device_config.json")
-
-    # 2. PLAY MUSIC (Only if activating)
-    if not turn_off_mode:
-        song_id = mode_data.get("audio_id")
-        if song_id:
-            if device_switched:
-                log_command(f"[MODE] Waiting for system voice...")
-                time.sleep(3.5) 
-            
-            first_room = next(iter(mode_data.get("actions", {}))) if mode_data.get("actions") else None
-            if not first_room and device_room_map:
-                first_room = next(iter(device_room_map))
+MODE_AUDIO_DELAY_S = 3.5    # lets the nodes' relay confirmation sounds finish before a mode's song starts
 
-            if first_room:
-                client.publish(MQTT_PUB_TOPIC, f"{first_room}:AUDIO:{song_id}")
-                log_command(f"[MODE] Playing Song #{song_id} in {first_room}")
-    
-    feedback = f"Okay, {mode_name} mode deactivated" if turn_off_mode else f"Okay, switching to {mode_name} mode"
-    broadcast_update({"type": "voice_feedback", "text": feedback})
+ModePlan = collections.namedtuple("ModePlan", "updates audio noops")   # audio is (room, song_id) or None
 
-def scheduler_loop():
-    last_checked_minute = -1
-    while True:
-        now = datetime.datetime.now()
-        current_time_str = now.strftime("%H:%M") 
-        
-        if now.minute != last_checked_minute:
-            last_checked_minute = now.minute
-            current_modes = load_config("modes.json")
-            
-            for name, data in current_modes.items():
-                start_time = data.get("start_time")
-                if start_time == current_time_str:
-                    today_short = now.strftime("%a") 
-                    if today_short in data.get("days", []):
-                        execute_mode(name, data)
-        time.sleep(1)
+def compile_mode_plan(mode_data, turn_off_mode=False, pending=None):
+    # The diff against current state (overlaid with `pending`, {(room, relay): status} from earlier plans
+    # in the same batch): only relays not already in the target state end up in `updates`.
+    updates, noops = {}, 0
+    pending = pending or {}
+    for room, relays in mode_data.get("actions", {}).items():
+        current = device_states.get(room, {})
+        for relay, state in relays.items():
+            target = "OFF" if turn_off_mode else state
+            if not isinstance(current.get(relay), dict): continue
+            if pending.get((room, relay), current[relay].get("status")) == target: noops += 1
+            else: updates.setdefault(room, {})[relay] = {"status": target}
+    audio = None
+    song_id = None if turn_off_mode else mode_data.get("audio_id")
+    if song_id:
+        first_room = next(iter(mode_data.get("actions") or {}), None) or next(iter(device_room_map), None)
+        if first_room: audio = (first_room, song_id)
+    return ModePlan(updates, audio, noops)
+
+def mode_rooms(run):
+    # Rooms a run claims: every room its mode targets (even where the relays were already set) and its song's room.
+    rooms = set(run.data.get("actions") or {})
+    if run.plan and run.plan.audio: rooms.add(run.plan.audio[0])
+    return rooms
+
+class ModeRun:
+    """Handle for one triggered mode: wait() for its commands to go out, cancel() it, or read its outcome."""
+    def __init__(self, executor, name, data, turn_off_mode, origin, on_publish):
+        self.executor = executor
+        self.name = name
+        self.data = data
+        self.turn_off_mode = turn_off_mode
+        self.origin = origin
+        self.on_publish = on_publish
+        self.plan = None
+        self.state = "queued"           # queued -> running -> done | cancelled | superseded | merged
+        self.pending = 0                # rooms (and songs) not yet sent to the nodes
+        self.songs = []                 # (room, dispatcher entry) of the songs queued for this run
+        self.submitted = time.perf_counter()
+        self.applied = self.finished_at = None
+        self.finished = threading.Event()
+
+    def wait(self, timeout=None):
+        self.finished.wait(timeout)
+        return self.state
+
+    def cancel(self): return self.executor.cancel(self)
+
+    def elapsed(self): return (self.finished_at or time.perf_counter()) - self.submitted
+
+class ModeExecutor:
+    """Runs modes off the caller's thread, one at a time and in trigger order.
+
+    Each mode is compiled into a diff plan against current state and applied as one state store batch;
+    the command dispatcher then sends every room's share in parallel, paced per node. Modes triggered
+    while the worker is busy are merged into one batch (newest target wins per relay). A newer mode
+    supersedes runs still in flight that share a room with it: their queued relay commands merge with its
+    own and their song is dropped. Runs in other rooms, and their songs, carry on.
+    """
+    def __init__(self, audio_delay=MODE_AUDIO_DELAY_S):
+        self.audio_delay = audio_delay
+        self.cond = threading.Condition()
+        self.queue = collections.deque()
+        self.active = []                # applied runs whose commands are still going out
+        self.thread = None
+        self.stats = {"submitted": 0, "batches": 0, "done": 0, "cancelled": 0, "superseded": 0, "merged": 0, "relay_changes": 0, "noop_relays": 0}
+
+    def submit(self, name, data, turn_off_mode=False, on_publish=None, origin="mode"):
+        run = ModeRun(self, name, data, turn_off_mode, origin, on_publish)
+        with self.cond:
+            self.queue.append(run)
+            self.stats["submitted"] += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="mode-executor", daemon=True)
+                self.thread.start()
+            self.cond.notify()
+        return run
+
+    def cancel(self, run):
+        # Relay changes already applied stay (they are the current state); a queued run and a pending song are dropped.
+        with self.cond:
+            if run.finished.is_set(): return False
+            if run in self.queue: self.queue.remove(run)
+            self._finish(run, "cancelled")
+        return True
+
+    def _finish(self, run, state):
+        # Must hold self.cond.
+        if run.finished.is_set(): return
+        if run in self.active: self.active.remove(run)
+        if state != "done":
+            for room, entry in run.songs: command_dispatcher.discard(room, entry)
+        run.state, run.finished_at = state, time.perf_counter()
+        self.stats[state] += 1
+        # Labelled by origin, not mode name: user-defined names would grow the series without bound.
+        metrics.observe("mode_run_seconds", run.finished_at - run.submitted, origin=run.origin, outcome=state)
+        run.finished.set()
+
+    def _sent_callback(self, run, publishers):
+        def sent():
+            while publishers: publishers.pop(0)()
+            with self.cond:
+                run.pending -= 1
+                if run.pending <= 0: self._finish(run, "done")
+        return sent
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.queue: self.cond.wait()
+                runs = list(self.queue)
+                self.queue.clear()
+            try: self._execute(runs)
+            except Exception as e: print(f"[MODE] Error: {e}")
+
+    def _execute(self, runs):
+        # Compiled in trigger order against the state each earlier run leaves behind, then applied as one batch.
+        with self.cond: runs = [run for run in runs if not run.finished.is_set()]
+        if not runs: return
+        merged, pending = {}, {}
+        for run in runs:
+            run.plan = compile_mode_plan(run.data, run.turn_off_mode, pending)
+            for room, relays in run.plan.updates.items():
+                for relay, fields in relays.items():
+                    merged.setdefault(room, {})[relay] = fields
+                    pending[(room, relay)] = fields["status"]
+            action_text = "Deactivating" if run.turn_off_mode else "Activating"
+            log_command(f"[MODE] {action_text} '{run.name}'...")
+            self.stats["noop_relays"] += run.plan.noops
+        last = runs[-1]
+        # A run is superseded by later ones that share a room with it. Earlier runs in this batch that no later
+        # one overlaps are merged: their relays go out with the batch and their songs are queued under `last`.
+        claimed, songs = set(), []
+        with self.cond:
+            for run in reversed(runs):
+                rooms = mode_rooms(run)
+                if run.finished.is_set(): continue
+                if run is not last:
+                    overlapped = rooms & claimed
+                    if not overlapped and run.plan.audio: songs.append(run.plan.audio)
+                    self._finish(run, "superseded" if overlapped else "merged")
+                claimed |= rooms
+            songs.reverse()
+            for old in list(self.active):
+                if mode_rooms(old) & claimed: self._finish(old, "superseded")
+            if last.finished.is_set(): return
+            last.state, last.applied = "running", time.perf_counter()
+            self.active.append(last)
+        self.stats["batches"] += 1
+        # Rooms are counted before the apply so the dispatcher's callbacks cannot finish the run early.
+        rooms = {room for room, relays in merged.items() if room in device_states}
+        if last.plan.audio: songs.append(last.plan.audio)
+        last.pending = len(rooms) + len(songs)
+        # Merged runs still hear when their commands went out (voice latency hangs off on_publish).
+        on_sent = self._sent_callback(last, [run.on_publish for run in runs if run.on_publish])
+        changes = state_store.apply(merged, last.origin, on_sent=on_sent) or []
+        self.stats["relay_changes"] += len(changes)
+        sent_rooms = {change.room for change in changes}
+        with self.cond:
+            # Rooms whose changes turned out to be no-ops will never call back.
+            last.pending -= len(rooms - sent_rooms)
+            if songs and not last.finished.is_set():
+                delay = self.audio_delay if changes else 0
+                if delay: log_command(f"[MODE] Waiting for system voice...")
+                for room, song_id in songs:
+                    last.songs.append((room, command_dispatcher.send_raw(room, f"{room}:AUDIO:{song_id}", delay=delay, on_sent=on_sent)))
+                    log_command(f"[MODE] Playing Song #{song_id} in {room}", room=room)
+            if last.pending <= 0: self._finish(last, "done")
+        feedback = f"Okay, {last.name} mode deactivated" if last.turn_off_mode else f"Okay, switching to {last.name} mode"
+        broadcast_update({"type": "voice_feedback", "text": feedback})
+
+mode_executor = ModeExecutor()
+
+def execute_mode(mode_name, mode_data, turn_off_mode=False, on_publish=None, origin="mode"):
+    # Returns at once with a ModeRun; the mode is applied on the executor's thread.
+    return mode_executor.submit(mode_name, mode_data, turn_off_mode=turn_off_mode, on_publish=on_publish, origin=origin)
+
+MODE_CATCHUP_WINDOW = datetime.timedelta(minutes=10)   # fires missed by a clock jump within this window still run
+SCHEDULER_MAX_SLEEP_S = 60                               # re-check the wall clock at least this often
+
+def next_fire_time(mode_data, after):
+    start_time, days = mode_data.get("start_time"), mode_data.get("days") or []
+    if not start_time or not days: return None
+    try: hour, minute = (int(x) for x in start_time.split(":")[:2])
+    except ValueError: return None
+    candidate = after.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if candidate <= after: candidate += datetime.timedelta(days=1)
+    for _ in range(7):
+        if candidate.strftime("%a") in days: return candidate
+        candidate += datetime.timedelta(days=1)
+    return None
+
+class ModeScheduler:
+    """Min-heap of next-fire datetimes; sleeps until the earliest one instead of polling."""
+    def __init__(self, clock=datetime.datetime.now, dispatch=None):
+        self.clock = clock
+        self.dispatch = dispatch or (lambda name, data: execute_mode(name, data, origin="schedule"))
+        self.cond = threading.Condition()
+        self.heap = []
+        self.modes = {}
+        self.seq = itertools.count()
+        self.cursor = None
+        self.dirty = True
+
+    def reload(self, modes=None):
+        with self.cond:
+            self.modes = load_config("modes.json") if modes is None else dict(modes)
+            self.dirty = True
+            self.cond.notify()
+
+    def clock_changed(self):
+        with self.cond: self.cond.notify()
+
+    def _rebuild(self, after):
+        self.heap = []
+        for name, data in self.modes.items():
+            fire_at = next_fire_time(data, after)
+            if fire_at: self.heap.append((fire_at, next(self.seq), name))
+        heapq.heapify(self.heap)
+        self.dirty = False
+
+    def run_due(self, now):
+        # Must hold self.cond. Returns the modes dispatched for `now`.
+        if self.cursor is None or now < self.cursor - datetime.timedelta(minutes=1):
+            self.cursor = now  # first run or the clock went backwards: don't refire the past
+            self.dirty = True
+        if self.dirty: self._rebuild(self.cursor)
+        fired = []
+        while self.heap and self.heap[0][0] <= now:
+            fire_at, _, name = heapq.heappop(self.heap)
+            data = self.modes.get(name)
+            if data is None: continue
+            if now - fire_at <= MODE_CATCHUP_WINDOW:
+                fired.append(name)
+                self.dispatch(name, data)
+            else: log_command(f"[SCHEDULER] Skipped '{name}' (missed at {fire_at:%Y-%m-%d %H:%M})")
+            nxt = next_fire_time(data, max(fire_at, now - MODE_CATCHUP_WINDOW))
+            if nxt: heapq.heappush(self.heap, (nxt, next(self.seq), name))
+        self.cursor = now
+        return fired
+
+    def run(self):
+        while True:
+            with self.cond:
+                try: self.run_due(self.clock())
+                except Exception as e: print(f"[SCHEDULER] Error: {e}")
+                timeout = SCHEDULER_MAX_SLEEP_S
+                if self.heap: timeout = min(timeout, max((self.heap[0][0] - self.clock()).total_seconds(), 0.05))
+                self.cond.wait(timeout)
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+        return self
+
+mode_scheduler = ModeScheduler()
 
 # --- Voice Logic ---
 VOICE_COMMAND_STOP_WORDS = ['turn', 'set', 'the', 'to', 'a', 'is', 'in', 'on', 'off', 'open', 'close','start', 'stop', 'activate', 'deactivate', 'enable', 'disable', 'please','would', 'you', 'can', 'jarvis', 'and', 'of', 'it', 'for','yeah', "i'm", 'i', 'kill', 'my', 'device', 'switch']
 FUZZY_MATCH_CONFIDENCE_THRESHOLD = 70 
 
+VOICE_STREAMING = True       # feed the recognizer while the user is still talking
+VAD_PRE_ROLL_MS = 300        # audio kept from before speech onset so word starts aren't clipped
+VAD_HANGOVER_MS = 240        # trailing silence tolerated before the segment is closed
+MIN_SPEECH_BYTES = 3200
+voice_latency_ms = {"batch": collections.deque(maxlen=50), "streaming": collections.deque(maxlen=50)}
+
+def record_voice_latency(room_id, decode_mode, speech_end, source="esp32"):
+    elapsed = (time.perf_counter() - speech_end) * 1000
+    voice_latency_ms[decode_mode].append(elapsed)
+    metrics.observe("voice_end_to_publish_seconds", elapsed / 1000, room=room_id, source=source, decode_mode=decode_mode)
+    log_command(f"[LATENCY] {room_id}: end of speech -> publish {elapsed:.0f} ms ({decode_mode})", room=room_id)
+
+def voice_latency_summary():
+    summary = {}
+    for decode_mode, samples in voice_latency_ms.items():
+        ordered = sorted(samples)
+        if ordered: summary[decode_mode] = {"count": len(ordered), "p50_ms": ordered[len(ordered) // 2], "max_ms": ordered[-1]}
+    return summary
+
+# --- Wake Word Pre-filter ---
+WAKE_WORD_FILTER = True          # ESP32 segments must start with their room's wake word before the full decode runs
+WAKE_WORD_WINDOW_S = 1.5         # how much of the start of a segment the spotter listens to
+WAKE_WORD_SENSITIVITY = 0.5      # default for a room's "wake_word_sensitivity"; higher lets less confident hits through
+wake_word_stats = {"checked": 0, "passed": 0, "rejected": 0, "spotter_cpu_s": 0.0}
+
+WakeWordSpec = collections.namedtuple("WakeWordSpec", "words grammar threshold window_bytes")
+
+def parse_wake_word_sensitivity(value):
+    try: sensitivity = float(value)
+    except (TypeError, ValueError): return None
+    return min(max(sensitivity, 0.0), 1.0)
+
+def wake_word_spec(room_id, source="esp32"):
+    # None sends the segment straight to the full decode: browser microphone, filter off, or no wake word set.
+    if not WAKE_WORD_FILTER or source == "browser": return None
+    room = device_states.get(room_id, {})
+    words = tuple(str(room.get("wake_word") or "").lower().split())
+    if not words: return None
+    sensitivity = parse_wake_word_sensitivity(room.get("wake_word_sensitivity", WAKE_WORD_SENSITIVITY))
+    if sensitivity is None: sensitivity = WAKE_WORD_SENSITIVITY
+    return WakeWordSpec(words, json.dumps([" ".join(words), "[unk]"]), 1.0 - sensitivity, int(WAKE_WORD_WINDOW_S * SAMPLE_RATE) * 2)
+
+class WakeWordSpotter:
+    """Decodes the start of a segment against a two-entry grammar (wake word, [unk]) and decides pass/reject.
+
+    Audio is held while it listens; on a pass the caller replays `held` into the full decoder.
+    """
+    def __init__(self, rec, spec):
+        self.rec = rec
+        self.spec = spec
+        rec.SetWords(True)
+        self.held = bytearray()
+        self.verdict = None
+        self.cpu_s = 0.0
+
+    def feed(self, data):
+        # True once the wake word is heard, False when the window ran out without it, None while still listening.
+        if self.verdict is not None: return self.verdict
+        started = time.thread_time()
+        take = data[:max(self.spec.window_bytes - len(self.held), 0)]
+        self.held.extend(data)
+        if take and self.rec.AcceptWaveform(bytes(take)) and self._heard(self.rec.Result()): self.verdict = True
+        elif len(self.held) >= self.spec.window_bytes: self.verdict = self._heard(self.rec.FinalResult())
+        self.cpu_s += time.thread_time() - started
+        return self.verdict
+
+    def finish(self):
+        # The segment ended inside the window.
+        if self.verdict is None:
+            started = time.thread_time()
+            self.verdict = self._heard(self.rec.FinalResult())
+            self.cpu_s += time.thread_time() - started
+        return self.verdict
+
+    def _heard(self, result):
+        words = [(w.get("word"), w.get("conf", 1.0)) for w in json.loads(result).get("result", [])]
+        n = len(self.spec.words)
+        return any(tuple(w for w, _ in words[i:i + n]) == self.spec.words and min(c for _, c in words[i:i + n]) >= self.spec.threshold
+                   for i in range(len(words) - n + 1))
+
+def record_wake_word(room_id, heard, cpu_s):
+    wake_word_stats["checked"] += 1
+    wake_word_stats["passed" if heard else "rejected"] += 1
+    wake_word_stats["spotter_cpu_s"] += cpu_s
+    metrics.inc("wake_word_segments_total", room=room_id, result="passed" if heard else "rejected")
+    if not heard: log_command(f"[KWS] No wake word in {room_id}, segment dropped before decoding.", room=room_id)
+
+class StreamingDecoder:
+    """Live recognizer for one utterance; frames are decoded as they arrive so only FinalResult runs at end of speech."""
+    def __init__(self, room_id, source="esp32", wake_word=None):
+        self.room_id = room_id
+        self.source = source
+        self.grammar, _ = get_voice_grammar()
+        self.rec = recognizer_pool.acquire(self.grammar)
+        self.spotter = WakeWordSpotter(wake_word_recognizers.acquire(wake_word.grammar), wake_word) if wake_word else None
+        self.frames = queue.Queue()
+        self.segments = []
+        self.partial_text = ""
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def feed(self, frame): self.frames.put(bytes(frame))
+
+    def finish(self, speech_end): self.frames.put(("END", speech_end))
+
+    def cancel(self): self.frames.put(("CANCEL", None))
+
+    def _run(self):
+        try:
+            while True:
+                item = self.frames.get()
+                if isinstance(item, tuple):
+                    if item[0] == "END":
+                        if self.spotter:
+                            held = self.spotter.held
+                            if not self._spotted(self.spotter.finish()): return
+                            if self.rec.AcceptWaveform(bytes(held)): self.segments.append(json.loads(self.rec.Result()).get('text', ''))
+                        with metrics.time("vosk_final_result_seconds", room=self.room_id, source=self.source):
+                            self.segments.append(json.loads(self.rec.FinalResult()).get('text', ''))
+                        text = " ".join(t for t in self.segments if t)
+                        handle_voice_text(self.room_id, text, speech_end=item[1], decode_mode="streaming", source=self.source)
+                    return
+                # Drain whatever queued up behind this frame and decode it in one call.
+                chunk = bytearray(item)
+                while True:
+                    try: nxt = self.frames.get_nowait()
+                    except queue.Empty: break
+                    if isinstance(nxt, tuple):
+                        self.frames.put(nxt)
+                        break
+                    chunk.extend(nxt)
+                if self.spotter:
+                    heard = self.spotter.feed(chunk)
+                    if heard is None: continue
+                    held = self.spotter.held
+                    if not self._spotted(heard): return
+                    chunk = held
+                with metrics.time("vosk_accept_waveform_seconds", room=self.room_id, source=self.source):
+                    complete = self.rec.AcceptWaveform(bytes(chunk))
+                if complete:
+                    self.segments.append(json.loads(self.rec.Result()).get('text', ''))
+                else:
+                    partial = json.loads(self.rec.PartialResult()).get('partial', '')
+                    if partial and partial != self.partial_text:
+                        self.partial_text = partial
+                        broadcast_update({"type": "voice_partial", "room": self.room_id, "text": " ".join(t for t in self.segments + [partial] if t)})
+        except Exception as e: print(f"[VOSK] Streaming decode error in {self.room_id}: {e}")
+        finally:
+            recognizer_pool.release(self.grammar, self.rec)
+            if self.spotter: wake_word_recognizers.release(self.spotter.spec.grammar, self.spotter.rec)
+
+    def _spotted(self, heard):
+        # On a pass the held audio goes to the full recognizer; either way the spotter is done.
+        spotter, self.spotter = self.spotter, None
+        record_wake_word(self.room_id, heard, spotter.cpu_s)
+        wake_word_recognizers.release(spotter.spec.grammar, spotter.rec)
+        return heard
+
+# --- Decode Pool ---
+VOICE_DECODE_WORKERS = 2     # Vosk worker processes, each loading the model once; 0 decodes in this process, a thread per utterance
+VOICE_ROOM_QUEUE = 2         # utterances a room may have waiting for a worker; past this its oldest is dropped
+VOICE_QUEUE_MAX = 12         # waiting across all rooms; past this new utterances are refused
+VOICE_STALE_S = 5.0          # an utterance that ended longer ago than this is dropped instead of being acted on late
+
+def decode_worker(index, model_path, sample_rate, inbox, outbox):
+    # Worker process: one Model for its lifetime, recognizers cached per grammar and reset between utterances.
+    # Gets start/audio/end/cancel messages for one utterance at a time; sends back only partials and the final text.
+    try: model = Model(model_path)
+    except Exception as e:
+        outbox.put((index, "failed", None, str(e)))
+        return
+    outbox.put((index, "ready", None, None))
+    recognizers, rec, spotter, job_id = {}, None, None, None
+    def recognizer(grammar):
+        rec = recognizers.get(grammar)
+        if rec is None:
+            if len(recognizers) >= 4: recognizers.clear()
+            rec = recognizers[grammar] = KaldiRecognizer(model, sample_rate, grammar)
+        return rec
+    while True:
+        kind, msg_job, data = inbox.get()
+        if kind == "stop": return
+        try:
+            if kind == "start":
+                grammar, partials, wake_word = data
+                job_id, segments, partial_text, busy, spotter_cpu = msg_job, [], "", 0.0, None
+                rec = recognizer(grammar)
+                spotter = WakeWordSpotter(recognizer(wake_word[1]), WakeWordSpec(*wake_word)) if wake_word else None
+                continue
+            if msg_job != job_id: continue
+            if spotter is not None and kind != "cancel":
+                # Nothing reaches the full recognizer until the spotter has heard the wake word.
+                heard = spotter.feed(data) if kind == "audio" else spotter.finish()
+                if heard is None: continue
+                spotter.rec.Reset()
+                spotter, spotter_cpu, held = None, spotter.cpu_s, bytes(spotter.held)
+                if not heard:
+                    outbox.put((index, "rejected", job_id, spotter_cpu))
+                    job_id = None
+                    continue
+                if kind == "audio": data = held
+                elif rec.AcceptWaveform(held): segments.append(json.loads(rec.Result()).get("text", ""))
+            started = time.perf_counter()
+            if kind == "audio":
+                if rec.AcceptWaveform(data): segments.append(json.loads(rec.Result()).get("text", ""))
+                elif partials:
+                    partial = json.loads(rec.PartialResult()).get("partial", "")
+                    if partial and partial != partial_text:
+                        partial_text = partial
+                        outbox.put((index, "partial", job_id, " ".join(t for t in segments + [partial] if t)))
+                busy += time.perf_counter() - started
+            elif kind == "end":
+                segments.append(json.loads(rec.FinalResult()).get("text", ""))
+                busy += time.perf_counter() - started
+                outbox.put((index, "text", job_id, (" ".join(t for t in segments if t), busy, spotter_cpu)))
+                job_id = None
+            elif kind == "cancel":
+                rec.Reset()
+                if spotter is not None: spotter.rec.Reset()
+                spotter = None
+                outbox.put((index, "cancelled", job_id, None))
+                job_id = None
+        except Exception as e:
+            outbox.put((index, "error", job_id, str(e)))
+            for r in (rec, spotter and spotter.rec):
+                if r is not None: r.Reset()
+            spotter, job_id = None, None
+
+class DecodeJob:
+    """One utterance's place in the decode pool; has the StreamingDecoder interface (feed/finish/cancel)."""
+    def __init__(self, pool, job_id, room_id, source, grammar, streaming, wake_word=None):
+        self.pool = pool
+        self.job_id = job_id
+        self.room_id = room_id
+        self.source = source
+        self.grammar = grammar
+        self.streaming = streaming
+        self.wake_word = wake_word
+        self.buffer = bytearray()    # audio held while no worker is free
+        self.worker = None
+        self.finished = False
+        self.dropped = False
+        self.speech_end = None
+
+    def feed(self, frame): self.pool._feed(self, bytes(frame))
+
+    def finish(self, speech_end): self.pool._finish(self, speech_end)
+
+    def cancel(self): self.pool._cancel(self)
+
+class DecodePool:
+    """Vosk worker processes fed from bounded per-room queues, served round-robin across rooms.
+
+    An utterance is handed to a worker as soon as one is idle, and from then on its audio streams
+    straight to that worker. Until then it waits in its room's queue, where a newer utterance from
+    the same room supersedes it, and it is dropped outright if it ended more than VOICE_STALE_S
+    ago by the time a worker frees up.
+    """
+    def __init__(self, size=VOICE_DECODE_WORKERS, room_queue=VOICE_ROOM_QUEUE, max_queued=VOICE_QUEUE_MAX, stale_s=VOICE_STALE_S):
+        self.size = size
+        self.room_queue = room_queue
+        self.max_queued = max_queued
+        self.stale_s = stale_s
+        self.ctx = multiprocessing.get_context("spawn")   # no fork of a process already running MQTT and server threads
+        self.cond = threading.Condition()
+        self.model_path = None
+        self.outbox = None
+        self.workers = []            # {"process", "inbox", "job"}
+        self.idle = []
+        self.waiting = collections.OrderedDict()   # room -> deque of DecodeJob, rotated for round-robin
+        self.running = {}
+        self.job_ids = itertools.count(1)
+        self.ready = threading.Event()
+        self.error = None
+        self.stats = {"submitted": 0, "decoded": 0, "queued": 0, "dropped_stale": 0, "dropped_superseded": 0,
+                      "dropped_full": 0, "cancelled": 0, "rejected": 0, "errors": 0, "worker_restarts": 0}
+
+    def start(self, model_path):
+        # Blocks until the first worker has loaded the model; raises if the workers cannot load it.
+        self.model_path = model_path
+        self.outbox = self.ctx.Queue()
+        with self.cond:
+            for index in range(self.size): self.workers.append(self._spawn(index))
+        threading.Thread(target=self._collect, name="decode-pool", daemon=True).start()
+        self.ready.wait()
+        if self.error: raise RuntimeError(self.error)
+
+    def _spawn(self, index):
+        inbox = self.ctx.Queue()
+        process = self.ctx.Process(target=decode_worker, args=(index, self.model_path, SAMPLE_RATE, inbox, self.outbox), name=f"vosk-decoder-{index}", daemon=True)
+        process.start()
+        return {"process": process, "inbox": inbox, "job": None}
+
+    def open(self, room_id, source="esp32", streaming=True, wake_word=None):
+        grammar, _ = get_voice_grammar()
+        with self.cond:
+            job = DecodeJob(self, next(self.job_ids), room_id, source, grammar, streaming, wake_word)
+            self.stats["submitted"] += 1
+            waiting = self.waiting.setdefault(room_id, collections.deque())
+            # The room spoke again: whatever it said before and is still waiting for a worker is moot.
+            for old in [j for j in waiting if j.finished]:
+                self._drop_locked(old, "dropped_superseded")
+            if len(waiting) >= self.room_queue: self._drop_locked(waiting[0], "dropped_full")
+            if sum(len(q) for q in self.waiting.values()) >= self.max_queued:
+                job.dropped = True
+                self.stats["dropped_full"] += 1
+                return job
+            waiting.append(job)
+            self._dispatch_locked()
+            self.stats["queued"] = sum(len(q) for q in self.waiting.values())
+        return job
+
+    def submit(self, room_id, audio, speech_end=None, source="esp32", wake_word=None):
+        job = self.open(room_id, source, streaming=False, wake_word=wake_word)
+        job.feed(audio)
+        job.finish(speech_end if speech_end is not None else time.perf_counter())
+        return job
+
+    def _drop_locked(self, job, reason):
+        self.waiting[job.room_id].remove(job)
+        job.dropped = True
+        self.stats[reason] += 1
+        log_command(f"[VOICE] Dropped a queued utterance from {job.room_id} ({reason.split('_', 1)[1]}).", room=job.room_id)
+
+    def _dispatch_locked(self):
+        # Round-robin over rooms, so one chatty room cannot starve the others.
+        while self.idle:
+            for room_id, waiting in self.waiting.items():
+                if not waiting: continue
+                job = waiting.popleft()
+                self.waiting.move_to_end(room_id)
+                if job.finished and time.perf_counter() - job.speech_end > self.stale_s:
+                    job.dropped = True
+                    self.stats["dropped_stale"] += 1
+                    log_command(f"[VOICE] Dropped a stale utterance from {room_id}.", room=room_id)
+                    break
+                worker = self.workers[self.idle.pop()]
+                worker["job"], job.worker = job, worker
+                self.running[job.job_id] = job
+                worker["inbox"].put(("start", job.job_id, (job.grammar, job.streaming, tuple(job.wake_word) if job.wake_word else None)))
+                if job.buffer: worker["inbox"].put(("audio", job.job_id, bytes(job.buffer)))
+                job.buffer = bytearray()
+                if job.finished: worker["inbox"].put(("end", job.job_id, None))
+                break
+            else: return
+
+    def _feed(self, job, data):
+        with self.cond:
+            if job.dropped: return
+            if job.worker: job.worker["inbox"].put(("audio", job.job_id, data))
+            else: job.buffer.extend(data)
+
+    def _finish(self, job, speech_end):
+        with self.cond:
+            if job.dropped: return
+            job.finished, job.speech_end = True, speech_end
+            if job.worker: job.worker["inbox"].put(("end", job.job_id, None))
+
+    def _cancel(self, job):
+        with self.cond:
+            if job.dropped: return
+            job.dropped = True
+            self.stats["cancelled"] += 1
+            if job.worker: job.worker["inbox"].put(("cancel", job.job_id, None))
+            else: self.waiting[job.room_id].remove(job)
+
+    def _collect(self):
+        while True:
+            try: index, kind, job_id, data = self.outbox.get(timeout=1)
+            except queue.Empty:
+                self._restart_dead()
+                continue
+            if kind == "failed":
+                self.error = data
+                self.ready.set()
+                continue
+            if kind == "partial":
+                job = self.running.get(job_id)
+                if job: broadcast_update({"type": "voice_partial", "room": job.room_id, "text": data})
+                continue
+            with self.cond:
+                job = self.running.pop(job_id, None) if kind != "ready" else None
+                self.workers[index]["job"] = None
+                self.idle.append(index)
+                self._dispatch_locked()
+                self.stats["queued"] = sum(len(q) for q in self.waiting.values())
+            if kind == "ready": self.ready.set()
+            elif kind == "error":
+                self.stats["errors"] += 1
+                print(f"[VOSK] Decode error in worker {index}: {data}")
+            elif kind == "rejected" and job:
+                job.dropped = True   # the rest of the segment is not worth shipping to a worker
+                self.stats["rejected"] += 1
+                record_wake_word(job.room_id, False, data)
+            elif kind == "text" and job and not job.dropped:
+                text, busy, spotter_cpu = data
+                if spotter_cpu is not None: record_wake_word(job.room_id, True, spotter_cpu)
+                self.stats["decoded"] += 1
+                metrics.observe("vosk_worker_decode_seconds", busy, room=job.room_id, source=job.source)
+                handle_voice_text(job.room_id, text, speech_end=job.speech_end, decode_mode="streaming" if job.streaming else "batch", source=job.source)
+
+    def _restart_dead(self):
+        if self.error: return   # the model itself cannot be loaded; respawning would just fail again
+        with self.cond:
+            for index, worker in enumerate(self.workers):
+                if worker["process"].is_alive() or worker["process"].exitcode is None: continue
+                job = worker["job"]
+                if job:
+                    self.running.pop(job.job_id, None)
+                    job.dropped = True
+                if index in self.idle: self.idle.remove(index)
+                print(f"[VOSK] Decode worker {index} exited ({worker['process'].exitcode}), restarting.")
+                self.stats["worker_restarts"] += 1
+                self.workers[index] = self._spawn(index)
+
+decode_pool = DecodePool()
+
+def open_decoder(room_id, source="esp32"):
+    wake_word = wake_word_spec(room_id, source)
+    return decode_pool.open(room_id, source, wake_word=wake_word) if decode_pool.size else StreamingDecoder(room_id, source=source, wake_word=wake_word)
+
+def decode_utterance(room_id, audio_data, speech_end=None, source="esp32"):
+    wake_word = wake_word_spec(room_id, source)
+    if decode_pool.size: decode_pool.submit(room_id, audio_data, speech_end, source, wake_word=wake_word)
+    else: threading.Thread(target=process_voice_command, args=(room_id, audio_data, speech_end, source, wake_word)).start()
+
+# --- Audio Transport ---
+# Nodes that open a session with "START:<codec>" send every chunk as an 8-byte header (codec, reserved,
+# seq uint16, timestamp uint32 = index of its first sample in the session) plus the payload. A bare
+# "START" means raw 16-bit PCM chunks, as older firmware sends them.
+AUDIO_HEADER = struct.Struct("<BBHI")
+AUDIO_CODECS = {"pcm": 0, "mulaw": 1}
+AUDIO_CONCEAL_MAX_MS = 120       # gaps up to this long are filled by fading out the last audio heard
+AUDIO_GAP_MAX_MS = 500           # longer gaps are filled with silence up to this, then the stream resyncs
+
+def mulaw_decode_table():
+    # G.711 mu-law byte -> 16-bit sample, for a single vectorized lookup per chunk.
+    u = ~np.arange(256, dtype=np.uint8)
+    exponent, mantissa = (u >> 4) & 0x07, (u & 0x0F).astype(np.int32)
+    magnitude = (((mantissa << 3) + 0x84) << exponent) - 0x84
+    return np.where(u & 0x80, -magnitude, magnitude).astype(np.int16)
+
+MULAW_TABLE = mulaw_decode_table()
+
+class AudioStreamDecoder:
+    """One node session's sequenced packets -> int16 samples in order, with lost audio concealed.
+
+    Gaps are found from the timestamps, so the samples handed on stay aligned with real time however
+    many bytes each chunk carried; seq only counts the packets that went missing. Late or duplicate
+    packets (already concealed) are dropped.
+    """
+    def __init__(self, stats, conceal_ms=AUDIO_CONCEAL_MAX_MS, gap_ms=AUDIO_GAP_MAX_MS):
+        self.stats = stats
+        self.conceal_max = SAMPLE_RATE * conceal_ms // 1000
+        self.gap_max = SAMPLE_RATE * gap_ms // 1000
+        self.expected_ts = self.expected_seq = None
+        self.repeat = SAMPLE_RATE * 30 // 1000
+        self.tail = np.zeros(0, dtype=np.int16)   # the last frame heard, repeated to fill short gaps
+        for key in ("packets", "packets_lost", "packets_late", "packets_bad", "concealed_ms"): stats.setdefault(key, 0)
+
+    def decode(self, packet):
+        # Returns the int16 arrays to feed, in order (concealment first, then the packet's own audio).
+        if len(packet) < AUDIO_HEADER.size:
+            self.stats["packets_bad"] += 1
+            return []
+        codec, _, seq, ts = AUDIO_HEADER.unpack_from(packet)
+        payload = memoryview(packet)[AUDIO_HEADER.size:]
+        if codec == AUDIO_CODECS["mulaw"]: samples = MULAW_TABLE[np.frombuffer(payload, dtype=np.uint8)]
+        elif codec == AUDIO_CODECS["pcm"]: samples = np.frombuffer(payload[:len(payload) & ~1], dtype=np.int16)
+        else:
+            self.stats["packets_bad"] += 1
+            return []
+        self.stats["packets"] += 1
+        if self.expected_ts is None: self.expected_ts, self.expected_seq = ts, seq
+        out = []
+        delta = (ts - self.expected_ts + 2 ** 31) % 2 ** 32 - 2 ** 31   # uint32 wrap-around
+        if delta < 0:
+            if delta + len(samples) <= 0:
+                self.stats["packets_late"] += 1
+                return []
+            samples, ts = samples[-delta:], self.expected_ts     # the overlap was already concealed
+        elif delta > 0:
+            self.stats["packets_lost"] += max((seq - self.expected_seq) % 65536, 1)
+            out.append(self._conceal(min(delta, self.gap_max)))
+        self.expected_ts, self.expected_seq = (ts + len(samples)) % 2 ** 32, (seq + 1) % 65536
+        if len(samples):
+            self.tail = samples[-self.repeat:]
+            out.append(samples)
+        return out
+
+    def _conceal(self, n):
+        self.stats["concealed_ms"] += n * 1000 // SAMPLE_RATE
+        fill = np.zeros(n, dtype=np.int16)
+        m = min(n, self.conceal_max) if len(self.tail) else 0
+        # The last frame heard, repeated with a linear fade and then silence: no click, no invented speech.
+        if m: fill[:m] = np.resize(self.tail, m) * np.linspace(1.0, 0.0, m, dtype=np.float32)
+        return fill
+
+MQTT_AUDIO_GAIN = 4              # same boost the old audioop.mul(chunk, 2, 4) applied
+VAD_ENERGY_GATE_MIN = 100        # batches quieter than this (RMS, after gain) never reach webrtcvad
+VAD_ENERGY_GATE_FACTOR = 2.0     # ...nor do batches under this multiple of the room's noise floor
+VAD_RING_FRAMES = 64
+VAD_BATCH_FRAMES = 3             # frames gained, gated and classified together (adds up to 90 ms to VAD decisions)
+VAD_NOISE_FLOOR_STEP = 0.15      # per batch: the floor follows a quiet room over ~0.6 s
+
 class VadAudio:
-    def __init__(self, room_id, aggressiveness=1):
+    """Per-room framing engine: raw chunks into a preallocated ring, gained and gated a batch of frames
+    at a time, zero-copy frames to webrtcvad.
+
+    With a codec ("START:<codec>" sessions) chunks are sequenced packets, unpacked by an AudioStreamDecoder.
+    """
+    def __init__(self, room_id, aggressiveness=1, streaming=None, codec=None):
         self.room_id = room_id
         try:
             import webrtcvad
             self.vad = webrtcvad.Vad(aggressiveness)
         except ImportError: self.vad = None
-        self.buffer = bytearray()
+        self.streaming = VOICE_STREAMING if streaming is None else streaming
         self.speech_buffer = bytearray()
         self.is_speaking = False
         self.frame_duration_ms = 30 
-        self.frame_size = int(SAMPLE_RATE * (self.frame_duration_ms / 1000.0) * 2)
+        self.frame_samples = SAMPLE_RATE * self.frame_duration_ms // 1000
+        self.frame_size = self.frame_samples * 2
+        pre_roll_frames = max(VAD_PRE_ROLL_MS // self.frame_duration_ms, 0)
+        # Capacity is a whole number of frames, so a frame never straddles the wrap-around.
+        # Pre-roll frames stay in the ring until speech starts, so writes never reach their slots.
+        self.ring = np.zeros(self.frame_samples * VAD_RING_FRAMES, dtype=np.int16)
+        self.ring_bytes = self.ring.data.cast('B')
+        self.batch_samples = VAD_BATCH_FRAMES * self.frame_samples
+        self.max_write = len(self.ring) - (pre_roll_frames + VAD_BATCH_FRAMES) * self.frame_samples
+        self.scratch = np.zeros(self.batch_samples, dtype=np.float32)
+        self.gain, self.clip_lo, self.clip_hi = np.float32(MQTT_AUDIO_GAIN), np.float32(-32768), np.float32(32767)
+        self.read_pos = 0
+        self.write_pos = 0
+        self.fill = 0
+        self.odd_byte = b""
+        self.noise_floor = float(VAD_ENERGY_GATE_MIN)
+        self.pre_roll = collections.deque(maxlen=pre_roll_frames)   # ring offsets, not copies
+        self.hangover_frames = VAD_HANGOVER_MS // self.frame_duration_ms
+        self.silent_frames = 0
+        self.voiced_bytes = 0
+        self.decoder = None
+        self.segment_start = 0.0
+        self.chunk_seconds = metrics.histogram("vad_chunk_seconds", room=room_id, source="esp32")
+        self.stats = {"frames": 0, "gated": 0, "vad_errors": 0, "bytes_in": 0}
+        self.stream = AudioStreamDecoder(self.stats) if codec else None
 
-    def process_chunk(self, chunk):
-        try:
-            chunk = audioop.mul(chunk, 2, 4) 
-        except Exception: pass
+    def _start_segment(self):
+        self.is_speaking = True
+        self.silent_frames = 0
+        self.voiced_bytes = 0
+        log_command(f"[VAD] Speech detected in {self.room_id}.", room=self.room_id)
+        metrics.inc("vad_events_total", room=self.room_id, source="esp32", event="onset")
+        self.segment_start = time.perf_counter()
+        self.speech_buffer = bytearray()
+        if self.streaming: self.decoder = open_decoder(self.room_id)
+        for offset in self.pre_roll: self._append(self.ring[offset:offset + self.frame_samples])
+        self.pre_roll.clear()
+
+    def _append(self, frame):
+        # Both paths copy out of the ring (feed() takes bytes()), since the slot gets reused.
+        frame = frame.data.cast('B')
+        if self.decoder: self.decoder.feed(frame)
+        else: self.speech_buffer.extend(frame)
+
+    def _end_segment(self):
+        speech_end = time.perf_counter()
+        self.is_speaking = False
+        metrics.inc("vad_events_total", room=self.room_id, source="esp32", event="end")
+        metrics.observe("vad_segment_seconds", speech_end - self.segment_start, room=self.room_id, source="esp32")
+        decoder, self.decoder = self.decoder, None
+        if self.voiced_bytes > MIN_SPEECH_BYTES:
+            log_command(f"[VAD] Processing command from {self.room_id}...", room=self.room_id)
+            if decoder: decoder.finish(speech_end)
+            else: decode_utterance(self.room_id, self.speech_buffer, speech_end)
+        elif decoder: decoder.cancel()
+        self.speech_buffer = bytearray()
 
+    def close(self):
+        if self.decoder:
+            self.decoder.cancel()
+            self.decoder = None
+
+    def process_chunk(self, chunk):
         if not self.vad: return
-        self.buffer.extend(chunk)
-        while len(self.buffer) >= self.frame_size:
-            frame = self.buffer[:self.frame_size]
-            del self.buffer[:self.frame_size]
-            try:
-                if self.vad.is_speech(frame, SAMPLE_RATE):
-                    if not self.is_speaking:
-                        self.is_speaking = True
-                        log_command(f"[VAD] Speech detected in {self.room_id}.")
-                    self.speech_buffer.extend(frame)
-                elif self.is_speaking:
-                    if len(self.speech_buffer) > 3200:
-                        self.is_speaking = False
-                        log_command(f"[VAD] Processing command from {self.room_id}...")
-                        threading.Thread(target=process_voice_command, args=(self.room_id, self.speech_buffer)).start()
-                    else:
-                        self.is_speaking = False
-                    self.speech_buffer = bytearray()
-            except: pass
-
-def find_matching_devices_fuzzy(text, room_devices):
-    text_lower = text.lower()
-    cleaned_words = [word for word in text_lower.split() if word not in VOICE_COMMAND_STOP_WORDS]
-    cleaned_text = " ".join(cleaned_words)
-    if not cleaned_text: return []
-    matching_devices = []
-    for relay, info in room_devices.items():
-        if relay.startswith("relay") and "label" in info:
-            label_lower = info["label"].lower()
-            current_score = 0
-            is_short = len(cleaned_text) <= 3
-            if cleaned_text.replace(" ", "") == label_lower.replace(" ", ""): current_score = 100
-            elif not is_short:
-                current_score = max(fuzz.token_set_ratio(cleaned_text, label_lower), fuzz.token_sort_ratio(cleaned_text, label_lower))
-            elif is_short:
-                 if cleaned_text in label_lower.split(): current_score = 100
-                 else: current_score = fuzz.token_sort_ratio(cleaned_text, label_lower)
-            if current_score >= FUZZY_MATCH_CONFIDENCE_THRESHOLD: matching_devices.append((relay, current_score))
-    if matching_devices: matching_devices.sort(key=lambda x: x[1], reverse=True)
-    return matching_devices
-
-def process_voice_command(room_id, audio_data):
-    if not audio_data or room_id not in device_states: return
-    
-    current_modes = load_config("modes.json")
-    mode_names = [m.lower() for m in current_modes.keys()]
+        self.stats["bytes_in"] += len(chunk)
+        if self.stream:
+            for samples in self.stream.decode(chunk): self.process_samples(samples)
+            return
+        if self.odd_byte:
+            chunk = self.odd_byte + bytes(chunk)
+            self.odd_byte = b""
+        if len(chunk) % 2:
+            chunk, self.odd_byte = chunk[:-1], chunk[-1:]
+        self._feed(chunk)
 
-    vocabulary = set(["turn", "switch", "on", "off", "party", "mode", "shutdown", "stop", "activate", "start", "execute", "set", "enable", "disable", "[unk]"])
+    def process_samples(self, samples):
+        self._feed(np.ascontiguousarray(samples, dtype=np.int16).data.cast('B'))
+
+    def _feed(self, data):
+        # Raw little-endian PCM bytes straight into the ring; gain and gate wait for a batch in _drain.
+        n, step = len(data), self.max_write * 2
+        if n > step:
+            data = memoryview(data)
+            for start in range(0, n, step): self._feed(data[start:start + step])
+            return
+        pos, size = self.write_pos * 2, len(self.ring_bytes)
+        if n <= size - pos: self.ring_bytes[pos:pos + n] = data
+        else:
+            data, first = memoryview(data), size - pos
+            self.ring_bytes[pos:] = data[:first]
+            self.ring_bytes[:n - first] = data[first:]
+        self.write_pos = (pos + n) % size // 2
+        self.fill += n // 2
+        if self.fill >= self.batch_samples: self._drain()
+
+    def _drain(self):
+        # NumPy's fixed cost per call outweighs a 1024-byte chunk, so a batch of frames shares one
+        # gain, one clip check and one energy gate.
+        fs = self.frame_samples
+        while self.fill >= fs:
+            start = self.read_pos
+            n = min(self.fill, len(self.ring) - start, self.batch_samples) // fs * fs
+            block, boosted = self.ring[start:start + n], self.scratch[:n]
+            # NumPy scalars keep the ufuncs off the slow Python-int conversion path.
+            np.multiply(block, self.gain, out=boosted)
+            power = float(np.dot(boosted, boosted))
+            # No single sample can exceed the batch's total power, so quiet batches skip the clip entirely.
+            if power > 32767.0 ** 2:
+                np.minimum(boosted, self.clip_hi, out=boosted)
+                np.maximum(boosted, self.clip_lo, out=boosted)
+            block[:] = boosted
+            self.read_pos = (start + n) % len(self.ring)
+            self.fill -= n
+            self.stats["frames"] += n // fs
+            energy = (power / n) ** 0.5
+            gated = energy < max(VAD_ENERGY_GATE_MIN, self.noise_floor * VAD_ENERGY_GATE_FACTOR)
+            offsets = range(start, start + n, fs)
+            if gated and not self.is_speaking:
+                # The common case, a quiet room: the whole batch only becomes pre-roll.
+                self.noise_floor += VAD_NOISE_FLOOR_STEP * (energy - self.noise_floor)
+                self.stats["gated"] += len(offsets)
+                self.pre_roll.extend(offsets)
+                continue
+            for offset in offsets: self._handle_frame(offset, gated)
+
+    def _handle_frame(self, offset, gated):
+        frame = self.ring[offset:offset + self.frame_samples]
+        if gated:
+            self.stats["gated"] += 1
+            is_speech = False
+        else:
+            try: is_speech = self.vad.is_speech(frame.data.cast('B'), SAMPLE_RATE)
+            except Exception as e:
+                self.stats["vad_errors"] += 1
+                if self.stats["vad_errors"] == 1: print(f"[VAD] Error in {self.room_id}: {e}")
+                return
+        if is_speech:
+            if not self.is_speaking: self._start_segment()
+            self.silent_frames = 0
+            self.voiced_bytes += self.frame_size
+            self._append(frame)
+        elif self.is_speaking:
+            self.silent_frames += 1
+            if self.silent_frames > self.hangover_frames: self._end_segment()
+            else: self._append(frame)
+        else: self.pre_roll.append(offset)
+
+# --- Grammar Cache & Recognizer Pool ---
+BASE_VOCABULARY = ["turn", "switch", "on", "off", "party", "mode", "shutdown", "stop", "activate", "start", "execute", "set", "enable", "disable", "[unk]"]
+RECOGNIZER_POOL_SIZE = 3
+grammar_cache = {"version": None, "grammar": None, "modes": {}}
+grammar_cache_lock = threading.Lock()
+
+def build_voice_grammar(modes):
+    vocabulary = set(BASE_VOCABULARY)
     vocabulary.update(VOICE_COMMAND_STOP_WORDS)
-    vocabulary.update(mode_names) 
-    
+    vocabulary.update(m.lower() for m in modes.keys())
     for r_id, devices in device_states.items():
         vocabulary.update(r_id.lower().replace("_", " ").split())
         for dev_data in devices.values():
             if isinstance(dev_data, dict) and "label" in dev_data:
                 vocabulary.update(dev_data["label"].lower().split())
+    # Sorted so an unchanged config always yields the same grammar string (the pool key).
+    return json.dumps(sorted(vocabulary))
+
+def get_voice_grammar():
+    with grammar_cache_lock:
+        if grammar_cache["version"] != config_version:
+            version = config_version
+            modes = load_config("modes.json")
+            with metrics.time("grammar_build_seconds"): grammar = build_voice_grammar(modes)
+            grammar_cache.update(version=version, grammar=grammar, modes=modes)
+            voice_matcher.rebuild(modes)
+            if not decode_pool.size: recognizer_pool.warm(grammar_cache["grammar"])
+        return grammar_cache["grammar"], grammar_cache["modes"]
+
+class RecognizerPool:
+    """Idle KaldiRecognizers for the current grammar, reset and reused between utterances."""
+    def __init__(self, max_idle=RECOGNIZER_POOL_SIZE):
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        self.grammar = None
+        self.idle = []
+
+    def acquire(self, grammar):
+        with self.lock:
+            if grammar != self.grammar:
+                self.grammar, self.idle = grammar, []
+            if self.idle: return self.idle.pop()
+        return KaldiRecognizer(voice_model.get(), SAMPLE_RATE, grammar)
+
+    def release(self, grammar, rec):
+        try: rec.Reset()
+        except Exception: return
+        with self.lock:
+            if grammar == self.grammar and len(self.idle) < self.max_idle: self.idle.append(rec)
+
+    def warm(self, grammar):
+        # Pre-build recognizers off the voice path so the next command only pays for decoding.
+        with self.lock:
+            if grammar != self.grammar: self.grammar, self.idle = grammar, []
+            missing = self.max_idle - len(self.idle)
+        def build():
+            for _ in range(missing):
+                try: rec = KaldiRecognizer(voice_model.get(), SAMPLE_RATE, grammar)
+                except RuntimeError: return
+                with self.lock:
+                    if grammar != self.grammar or len(self.idle) >= self.max_idle: return
+                    self.idle.append(rec)
+        if missing > 0: threading.Thread(target=build, daemon=True).start()
 
-    grammar = json.dumps(list(vocabulary))
-    rec = KaldiRecognizer(model, SAMPLE_RATE, grammar)
-    rec.AcceptWaveform(bytes(audio_data))
-    result = json.loads(rec.FinalResult())
-    text = result.get('text', '')
+recognizer_pool = RecognizerPool()
+wake_word_recognizers = RecognizerPool(max_idle=2)   # spotter recognizers, keyed by the wake word grammar
+
+# --- Voice Matching Index ---
+MODE_MATCH_THRESHOLD = 85
+
+class VoiceMatcher:
+    """Pre-normalized relay labels per room and mode names, rebuilt with the grammar cache.
+
+    Scores every candidate of a room in one rapidfuzz call with the same scorers, rounding and
+    thresholds the per-pair thefuzz loop used, so match results are unchanged.
+    """
+    def __init__(self):
+        self.rooms = {}
+        self.room_words = []
+        self.modes = ([], [])
+
+    def rebuild(self, modes):
+        rooms = {}
+        for room_id, devices in device_states.items():
+            entries = []
+            for relay, info in devices.items():
+                if relay.startswith("relay") and isinstance(info, dict) and "label" in info:
+                    label_lower = info["label"].lower()
+                    entries.append((relay, label_lower.replace(" ", ""), label_lower.split(), fuzz_utils.full_process(label_lower, force_ascii=True)))
+            rooms[room_id] = (entries, [e[3] for e in entries])
+        # Longest room names first so "guest bedroom" wins over "bedroom".
+        room_words = sorted(((room_id, room_id.lower().replace("_", " ").split()) for room_id in device_states), key=lambda r: -len(r[1]))
+        self.rooms, self.room_words = rooms, room_words
+        self.modes = (list(modes), [name.lower() for name in modes])
+
+    def match_mode(self, command_text):
+        mode_keys, mode_names = self.modes
+        if not mode_names: return None
+        best_mode, best_score = None, 0
+        scores = [0] * len(mode_names)
+        for _, score, idx in rf_process.extract(command_text, mode_names, scorer=rf_fuzz.partial_ratio, processor=None, limit=None):
+            scores[idx] = int(round(score))
+        for name, score in zip(mode_keys, scores):
+            if score > MODE_MATCH_THRESHOLD and score > best_score: best_mode, best_score = name, score
+        return best_mode
+
+    def match_room(self, text, room_id):
+        # Returns [(relay, score)] above FUZZY_MATCH_CONFIDENCE_THRESHOLD, best first.
+        entries, choices = self.rooms.get(room_id, ([], []))
+        cleaned_text = " ".join(word for word in text.lower().split() if word not in VOICE_COMMAND_STOP_WORDS)
+        if not cleaned_text or not entries: return []
+        is_short = len(cleaned_text) <= 3
+        compact = cleaned_text.replace(" ", "")
+        processed = fuzz_utils.full_process(cleaned_text, force_ascii=True)
+        scores = [0] * len(entries)
+        for _, score, idx in rf_process.extract(processed, choices, scorer=rf_fuzz.token_sort_ratio, processor=None, limit=None):
+            scores[idx] = int(round(score))
+        if not is_short:
+            for _, score, idx in rf_process.extract(processed, choices, scorer=rf_fuzz.token_set_ratio, processor=None, limit=None):
+                scores[idx] = max(scores[idx], int(round(score)))
+        matching_devices = []
+        for (relay, label_compact, label_tokens, _), score in zip(entries, scores):
+            if compact == label_compact or (is_short and cleaned_text in label_tokens): score = 100
+            if score >= FUZZY_MATCH_CONFIDENCE_THRESHOLD: matching_devices.append((relay, score))
+        matching_devices.sort(key=lambda x: x[1], reverse=True)
+        return matching_devices
+
+    def match_devices(self, text, room_id):
+        # "kitchen fan" said in the bedroom targets the kitchen; otherwise the speaker's room.
+        words = text.lower().split()
+        for other_room, room_tokens in self.room_words:
+            if other_room != room_id and room_tokens and all(t in words for t in room_tokens):
+                remaining = " ".join(w for w in words if w not in room_tokens)
+                matches = self.match_room(remaining, other_room)
+                if matches: return other_room, matches
+        return room_id, self.match_room(text, room_id)
+
+voice_matcher = VoiceMatcher()
+
+def process_voice_command(room_id, audio_data, speech_end=None, source="esp32", wake_word=None):
+    if not audio_data or room_id not in device_states: return
+    if wake_word:
+        spotter = WakeWordSpotter(wake_word_recognizers.acquire(wake_word.grammar), wake_word)
+        try:
+            heard = spotter.feed(bytes(audio_data[:wake_word.window_bytes]))
+            if heard is None: heard = spotter.finish()
+        finally: wake_word_recognizers.release(wake_word.grammar, spotter.rec)
+        record_wake_word(room_id, heard, spotter.cpu_s)
+        if not heard: return
     
-    if not text: return
-    log_command(f'[VOSK] Heard in {room_id}: "{text}"')
+    grammar, _ = get_voice_grammar()
+    rec = recognizer_pool.acquire(grammar)
+    try:
+        with metrics.time("vosk_accept_waveform_seconds", room=room_id, source=source): rec.AcceptWaveform(bytes(audio_data))
+        with metrics.time("vosk_final_result_seconds", room=room_id, source=source): result = json.loads(rec.FinalResult())
+    finally:
+        recognizer_pool.release(grammar, rec)
+    handle_voice_text(room_id, result.get('text', ''), speech_end=speech_end, decode_mode="batch", source=source)
+
+def handle_voice_text(room_id, text, speech_end=None, decode_mode="batch", source="esp32"):
+    if not text or room_id not in device_states: return
+    log_command(f'[VOSK] Heard in {room_id}: "{text}"', room=room_id)
     
+    def mark_published():
+        nonlocal speech_end
+        if speech_end is not None:
+            record_voice_latency(room_id, decode_mode, speech_end, source)
+            speech_end = None
+
     command_text = text.lower()
 
     # --- MODE MATCHING ---
-    best_mode = None
-    best_score = 0
-    for name in current_modes:
-        score = fuzz.partial_ratio(name.lower(), command_text)
-        if score > 85: 
-            if score > best_score:
-                best_score = score
-                best_mode = name
+    _, current_modes = get_voice_grammar()  # also keeps voice_matcher current with the config version
+    with metrics.time("voice_match_seconds", room=room_id, source=source, kind="mode"): best_mode = voice_matcher.match_mode(command_text)
     
     if best_mode:
         negatives = ["off", "stop", "deactivate", "disable", "kill", "end", "shutdown"]
         is_negative = any(word in command_text.split() for word in negatives)
-        log_command(f"[VOICE] Matched Mode: '{best_mode}' (Negative: {is_negative})")
-        execute_mode(best_mode, current_modes[best_mode], turn_off_mode=is_negative)
+        log_command(f"[VOICE] Matched Mode: '{best_mode}' (Negative: {is_negative})", room=room_id)
+        execute_mode(best_mode, current_modes[best_mode], turn_off_mode=is_negative, on_publish=mark_published)
         return 
 
     # --- DEVICE MATCHING (FIXED TOGGLING) ---
@@ -280,46 +2493,53 @@ def process_voice_command(room_id, audio_data):
     if any(x in command_text.split() for x in ["on", "open", "start", "enable", "activate"]): action = "ON"
     elif any(x in command_text.split() for x in ["off", "close", "stop", "kill", "shutdown", "disable"]): action = "OFF"
     
-    matching_devices = find_matching_devices_fuzzy(command_text, device_states[room_id])
+    with metrics.time("voice_match_seconds", room=room_id, source=source, kind="device"):
+        target_room, matching_devices = voice_matcher.match_devices(command_text, room_id)
+    if target_room != room_id: log_command(f"[VOICE] Targeting room '{target_room}' from {room_id}", room=room_id)
     if matching_devices:
         top_score = matching_devices[0][1]
         cutoff_score = 99 if top_score == 100 else 70
         final_targets = [d for d in matching_devices if d[1] >= cutoff_score]
         
-        executed_relays = set()
-        switched_labels = [] 
-        
-        for relay, score in final_targets:
-            if relay in executed_relays: continue 
-            target_relay = relay
+        # Toggles read the current state, so the batch is a compare-and-set against the versions read;
+        # if a node echo or another request lands in between, re-read and decide again.
+        for attempt in range(3):
+            executed_relays = set()
+            switched_labels = [] 
+            skipped = []
+            updates, expect = {}, {}
             
-            # --- INTELLIGENT STATE CHECK ---
-            current_status = device_states[room_id][target_relay].get('status', 'OFF')
-            
-            # If explicit command ("Turn ON") used, respect it. If ambiguous ("Fan"), toggle it.
-            final_action = action
-            if not final_action:
-                final_action = "OFF" if current_status == "ON" else "ON"
-            
-            # SKIP if already in requested state
-            if final_action == current_status:
-                log_command(f"[SKIPPED] {device_states[room_id][target_relay]['label']} is already {final_action}")
-                continue 
-            # -------------------------------
-
-            device_states[room_id][target_relay]['status'] = final_action
-            label = device_states[room_id][target_relay]['label']
-            
-            log_command(f"[EXECUTE] {label} -> {final_action}")
-            client.publish(MQTT_PUB_TOPIC, f"{room_id}:{target_relay}:{final_action}")
-            broadcast_update({"type": "status_update", "room": room_id, "relay": target_relay, "status": final_action})
+            for relay, score in final_targets:
+                if relay in executed_relays: continue 
+                target_relay = relay
+                expect[(target_room, target_relay)] = state_store.version_of(target_room, target_relay)
+                
+                # --- INTELLIGENT STATE CHECK ---
+                current_status = device_states[target_room][target_relay].get('status', 'OFF')
+                
+                # If explicit command ("Turn ON") used, respect it. If ambiguous ("Fan"), toggle it.
+                final_action = action
+                if not final_action:
+                    final_action = "OFF" if current_status == "ON" else "ON"
+                
+                # SKIP if already in requested state
+                if final_action == current_status:
+                    skipped.append(f"[SKIPPED] {device_states[target_room][target_relay]['label']} is already {final_action}")
+                    continue 
+                # -------------------------------
+
+                updates[target_relay] = {"status": final_action}
+                executed_relays.add(relay)
+                switched_labels.append(device_states[target_room][target_relay]['label'])
             
-            executed_relays.add(relay)
-            switched_labels.append(label)
-            time.sleep(0.05) 
+            if state_store.apply({target_room: updates}, "voice", expect=expect, on_sent=mark_published) is not None: break
+        else:
+            log_command(f"[VOICE] '{command_text}' lost the race against concurrent changes, ignoring.", room=target_room)
+            return
+        for line in skipped: log_command(line, room=target_room)
+        for label, relay in zip(switched_labels, updates): log_command(f"[EXECUTE] {label} -> {updates[relay]['status']}", room=target_room)
         
         if executed_relays:
-            save_config(device_states, "device_config.json")
             if len(executed_relays) > 1:
                  first_label = switched_labels[0]
                  if all(l == first_label for l in switched_labels): feedback_text = f"Okay, {first_label}s turned {final_action.lower()}"
@@ -327,69 +2547,665 @@ def process_voice_command(room_id, audio_data):
             else:
                 feedback_text = f"Okay, {switched_labels[0]} turned {final_action.lower()}"
             broadcast_update({"type": "voice_feedback", "text": feedback_text})
-    else: log_command(f"[IGNORED] No matching device for '{command_text}'.")
+    else: log_command(f"[IGNORED] No matching device for '{command_text}'.", room=room_id)
 
-def check_motion_timeouts():
-    while True:
-        now = datetime.datetime.now()
-        updated = False
-        for room_id, last_seen in list(last_motion_time.items()):
-            if now - last_seen > MOTION_TIMEOUT:
-                log_command(f"[MOTION] No motion in '{room_id}' for 25s.")
-                if room_id in device_states:
-                    for relay, data in device_states[room_id].items():
-                        if relay.startswith('relay') and data.get('motion_control') and data.get('status') == 'ON':
-                            device_states[room_id][relay]['status'] = 'OFF'
-                            client.publish(MQTT_PUB_TOPIC, f"{room_id}:{relay}:OFF")
-                            broadcast_update({"type": "status_update", "room": room_id, "relay": relay, "status": "OFF"})
-                            updated = True
-                            time.sleep(0.05)
-                del last_motion_time[room_id]
-        if updated: save_config(device_states, "device_config.json")
-        threading.Event().wait(1.0)
+# --- Motion Timeouts ---
+def motion_timeout_for(room_id, relay):
+    # Per-relay "motion_timeout" (seconds) wins over the room's, which wins over MOTION_TIMEOUT.
+    room = device_states.get(room_id, {})
+    for value in (room.get(relay, {}).get("motion_timeout"), room.get("motion_timeout")):
+        try:
+            if value and float(value) > 0: return float(value)
+        except (TypeError, ValueError): pass
+    return MOTION_TIMEOUT.total_seconds()
+
+def turn_off_motion_relays(room_id, relays, timers):
+    # relays: {relay: its version when the deadline expired}. Checked and written under the room's lock (taken
+    # after the store's, as room edits do) and the timers' condition: a manual switch since then (a newer version)
+    # or motion re-arming the relay both win.
+    for relay, version in relays.items():
+        with state_store.lock, state_store.room_lock(room_id), timers.cond:
+            data = device_states.get(room_id, {}).get(relay)
+            if (room_id, relay) in timers.deadlines or not isinstance(data, dict): continue
+            if not (data.get('motion_control') and data.get('status') == 'ON'): continue
+            changed = state_store.update(room_id, relay, "motion", expect_version=version, status='OFF')
+        if changed: log_command(f"[MOTION] No motion in '{room_id}' for {motion_timeout_for(room_id, relay):g}s, turning off {data.get('label', relay)}.", room=room_id)
+
+def parse_motion_timeout(value):
+    try: seconds = float(value)
+    except (TypeError, ValueError): return None
+    return seconds if seconds > 0 else None
+
+class MotionTimerService:
+    """Per-relay motion deadlines in a min-heap; the thread sleeps until the earliest one expires.
+
+    on_expire(room, relays, timers) runs off the condition; a relay touched again since is back in `deadlines`.
+    """
+    def __init__(self, clock=time.monotonic, on_expire=turn_off_motion_relays):
+        self.clock = clock
+        self.on_expire = on_expire
+        self.cond = threading.Condition()
+        self.heap = []
+        self.deadlines = {}
+        self.seq = itertools.count()
+
+    def touch(self, room_id):
+        # Re-arm every motion-controlled relay in the room; superseded heap entries are skipped lazily.
+        now = self.clock()
+        with self.cond:
+            for relay, data in device_states.get(room_id, {}).items():
+                if relay.startswith('relay') and isinstance(data, dict) and data.get('motion_control'):
+                    deadline = now + motion_timeout_for(room_id, relay)
+                    self.deadlines[(room_id, relay)] = deadline
+                    heapq.heappush(self.heap, (deadline, next(self.seq), room_id, relay))
+            if len(self.heap) > 4 * len(self.deadlines) + 64: self._compact()
+            self.cond.notify()
+
+    def _compact(self):
+        self.heap = [(d, next(self.seq), room, relay) for (room, relay), d in self.deadlines.items()]
+        heapq.heapify(self.heap)
+
+    def pop_expired(self, now):
+        # Must hold self.cond. Returns {room: {relay: version}} for relays whose deadline has passed.
+        expired = {}
+        while self.heap and self.heap[0][0] <= now:
+            deadline, _, room_id, relay = heapq.heappop(self.heap)
+            if self.deadlines.get((room_id, relay)) != deadline: continue
+            del self.deadlines[(room_id, relay)]
+            expired.setdefault(room_id, {})[relay] = state_store.version_of(room_id, relay)
+        return expired
+
+    def run_due(self, now=None):
+        with self.cond: expired = self.pop_expired(self.clock() if now is None else now)
+        for room_id, relays in expired.items(): self.on_expire(room_id, relays, self)
+        return expired
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.heap: self.cond.wait()
+                timeout = self.heap[0][0] - self.clock()
+                if timeout > 0:
+                    self.cond.wait(timeout)
+                    continue
+            try: self.run_due()
+            except Exception as e: print(f"[MOTION] Error: {e}")
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+        return self
+
+motion_timers = MotionTimerService()
+
+# --- Automation Rules ---
+# rules.json: {name: {"trigger": {...}, "conditions": [...], "actions": [...], "debounce_s": 0, "cooldown_s": 0, "enabled": true}}
+#   trigger     {"event": "motion", "room": R}
+#               {"event": "status", "room": R, "relay": "relay1", "status": "ON", "origin": "node"}   (relay, status, origin optional)
+#               {"event": "time", "at": "HH:MM", "days": ["Mon", ...]}
+#               a missing room (or "*") matches every room
+#   conditions  {"type": "time", "after": "HH:MM", "before": "HH:MM", "days": [...]}   (the window may wrap midnight)
+#               {"type": "relay", "room": R, "relay": "relay1", "status": "ON"}
+#   actions     {"type": "mode", "mode": name, "turn_off": false}
+#               {"type": "relay", "room": R, "relay": "relay1", "status": "ON"}
+#   A relay condition or action without a room means the room the event came from.
+RULE_EVENTS = ("motion", "status", "time")
+RULE_QUEUE_MAX = 4096           # events waiting for the rule thread; past this the oldest are dropped
+RULE_ORIGIN = "rule"            # state changes made by rules, which are not fed back in as events
+ALL_DAYS = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+
+RuleEvent = collections.namedtuple("RuleEvent", "kind room relay status origin rule at")   # rule is set for time events
+Rule = collections.namedtuple("Rule", "name trigger conditions actions debounce cooldown")
+
+def parse_clock(value, default=None):
+    # "HH:MM" -> minutes since midnight.
+    if value in (None, "") and default is not None: return default
+    hour, minute = (int(x) for x in str(value).split(":")[:2])
+    if not (0 <= hour < 24 and 0 <= minute < 60): raise ValueError(f"bad time {value!r}")
+    return hour * 60 + minute
+
+def compile_condition(cond, any_room):
+    # -> check(event, now), now being the wall clock datetime.
+    kind = cond.get("type")
+    if kind == "time":
+        after, before, days = parse_clock(cond.get("after"), 0), parse_clock(cond.get("before"), 24 * 60), set(cond.get("days") or ())
+        def check(event, now):
+            minute = now.hour * 60 + now.minute
+            inside = after <= minute < before if after <= before else minute >= after or minute < before
+            return inside and (not days or now.strftime("%a") in days)
+        return check
+    if kind == "relay":
+        room, relay, status = cond.get("room"), cond.get("relay"), cond.get("status", "ON")
+        if not relay or (not room and not any_room): raise ValueError("relay condition needs a relay (and a room for time rules)")
+        return lambda event, now: (device_states.get(room or event.room) or {}).get(relay, {}).get("status") == status
+    raise ValueError(f"unknown condition {kind!r}")
+
+def compile_action(action, any_room):
+    # -> run(event)
+    kind = action.get("type")
+    if kind == "mode":
+        mode, turn_off = action.get("mode"), bool(action.get("turn_off"))
+        if not mode: raise ValueError("mode action needs a mode")
+        def run(event):
+            data = mode_scheduler.modes.get(mode)
+            if data is None: log_command(f"[RULE] Mode '{mode}' no longer exists.", room=event.room)
+            else: execute_mode(mode, data, turn_off_mode=turn_off, origin=RULE_ORIGIN)
+        return run
+    if kind == "relay":
+        room, relay, status = action.get("room"), action.get("relay"), action.get("status")
+        if not relay or status not in ("ON", "OFF") or (not room and not any_room): raise ValueError("relay action needs a relay, ON/OFF (and a room for time rules)")
+        return lambda event: state_store.update(room or event.room, relay, RULE_ORIGIN, status=status)
+    raise ValueError(f"unknown action {kind!r}")
+
+def compile_rule(name, data):
+    # Raises ValueError (or TypeError for the wrong JSON shapes) for a rule the engine could not run.
+    trigger = dict(data.get("trigger") or {})
+    if trigger.get("event") not in RULE_EVENTS: raise ValueError(f"unknown trigger event {trigger.get('event')!r}")
+    if trigger["event"] == "time":
+        parse_clock(trigger.get("at"))
+        if not set(trigger.get("days") or ALL_DAYS) <= set(ALL_DAYS): raise ValueError("days must be Mon..Sun")
+    elif trigger.get("room") in (None, "", "*"): trigger["room"] = "*"
+    if not data.get("actions"): raise ValueError("rule has no actions")
+    any_room = trigger["event"] != "time"
+    conditions = tuple(compile_condition(cond, any_room) for cond in data.get("conditions") or ())
+    actions = tuple(compile_action(action, any_room) for action in data["actions"])
+    return Rule(name, trigger, conditions, actions, max(float(data.get("debounce_s") or 0), 0.0), max(float(data.get("cooldown_s") or 0), 0.0))
+
+def rule_triggered(trigger, event):
+    if event.kind != "status": return True
+    return all(trigger.get(key) in (None, value) for key, value in (("relay", event.relay), ("status", event.status), ("origin", event.origin)))
+
+class RuleEngine:
+    """Automation rules compiled into an index by (event, room), so an event is only checked against
+    its own room's rules and the any-room ones, never the whole rule set.
+
+    Handlers and the state store feed only enqueue; matching and actions run on the engine's thread.
+    A rule with debounce_s fires once its trigger has been quiet that long, with the last event; one
+    with cooldown_s does not fire again within that long of its last firing. Time triggers come from
+    a ModeScheduler of their own. State changes made by rules are not fed back in, so rules cannot
+    trigger each other in a loop.
+    """
+    def __init__(self, clock=time.monotonic, wall_clock=datetime.datetime.now):
+        self.clock = clock
+        self.wall_clock = wall_clock
+        self.cond = threading.Condition()
+        self.events = collections.deque()
+        self.rules = {}
+        self.index = {}                 # (event, room or "*") -> [Rule]
+        self.heap = []                  # (deadline, seq, rule name) of debounced rules; superseded entries are skipped lazily
+        self.debouncing = {}            # rule name -> (deadline, last event)
+        self.last_fired = {}
+        self.seq = itertools.count()
+        self.thread = None
+        self.scheduler = ModeScheduler(dispatch=lambda name, data: self.emit("time", rule=name))
+        self.stats = {"rules": 0, "invalid": 0, "events": 0, "candidates": 0, "fired": 0, "debounced": 0, "cooling_down": 0, "conditions_false": 0, "action_errors": 0, "dropped": 0}
+
+    def reload(self, rules=None):
+        rules = load_config("rules.json") if rules is None else rules
+        compiled, index, times, invalid = {}, {}, {}, 0
+        for name, data in rules.items():
+            if not data.get("enabled", True): continue
+            try: rule = compile_rule(name, data)
+            except (ValueError, TypeError) as e:
+                log_command(f"[RULE] Skipping '{name}': {e}")
+                invalid += 1
+                continue
+            compiled[name] = rule
+            if rule.trigger["event"] == "time": times[name] = {"start_time": rule.trigger["at"], "days": rule.trigger.get("days") or ALL_DAYS}
+            else: index.setdefault((rule.trigger["event"], rule.trigger["room"]), []).append(rule)
+        with self.cond: self.rules, self.index = compiled, index
+        self.stats["rules"], self.stats["invalid"] = len(compiled), invalid
+        self.scheduler.reload(times)
+        return compiled
+
+    def emit(self, kind, room=None, relay=None, status=None, origin=None, rule=None):
+        # Events no rule listens for stop here, on the caller's thread.
+        if rule is None and (kind, room) not in self.index and (kind, "*") not in self.index: return
+        with self.cond:
+            if len(self.events) >= RULE_QUEUE_MAX:
+                self.events.popleft()
+                self.stats["dropped"] += 1
+            self.events.append(RuleEvent(kind, room, relay, status, origin, rule, self.clock()))
+            self.cond.notify()
+
+    def candidates(self, event):
+        # The room's own rules, then the any-room ones, each in the order they were defined.
+        if event.rule is not None:
+            rule = self.rules.get(event.rule)
+            return (rule,) if rule else ()
+        return self.index.get((event.kind, event.room), []) + self.index.get((event.kind, "*"), [])
+
+    def process(self, event):
+        self.stats["events"] += 1
+        for rule in self.candidates(event):
+            self.stats["candidates"] += 1
+            if not rule_triggered(rule.trigger, event): continue
+            if rule.debounce:
+                deadline = event.at + rule.debounce
+                self.debouncing[rule.name] = (deadline, event)
+                heapq.heappush(self.heap, (deadline, next(self.seq), rule.name))
+                self.stats["debounced"] += 1
+            else: self.fire(rule, event, event.at)
+
+    def run_due(self, now):
+        # Debounced rules whose trigger has been quiet long enough.
+        while self.heap and self.heap[0][0] <= now:
+            deadline, _, name = heapq.heappop(self.heap)
+            pending = self.debouncing.get(name)
+            if not pending or pending[0] != deadline: continue
+            del self.debouncing[name]
+            rule = self.rules.get(name)
+            if rule: self.fire(rule, pending[1], deadline)
+
+    def fire(self, rule, event, now):
+        last = self.last_fired.get(rule.name)
+        if last is not None and now - last < rule.cooldown:
+            self.stats["cooling_down"] += 1
+            return False
+        wall = self.wall_clock()
+        if not all(check(event, wall) for check in rule.conditions):
+            self.stats["conditions_false"] += 1
+            return False
+        self.last_fired[rule.name] = now
+        self.stats["fired"] += 1
+        log_command(f"[RULE] '{rule.name}' fired on {event.kind}" + (f" in {event.room}." if event.room else "."), room=event.room)
+        for action in rule.actions:
+            try: action(event)
+            except Exception as e:
+                self.stats["action_errors"] += 1
+                print(f"[RULE] '{rule.name}' action failed: {e}")
+        return True
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.events:
+                    if self.heap and self.heap[0][0] <= self.clock(): break
+                    self.cond.wait(self.heap[0][0] - self.clock() if self.heap else None)
+                events = list(self.events)
+                self.events.clear()
+            for event in events:
+                # Debounces that ran out before this event happened fire first, however late the thread got to it.
+                try:
+                    self.run_due(event.at)
+                    self.process(event)
+                except Exception as e: print(f"[RULE] Error: {e}")
+            self.run_due(self.clock())
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="rule-engine", daemon=True)
+            self.thread.start()
+            self.scheduler.start()
+        return self
+
+rule_engine = RuleEngine()
+
+@state_store.subscribe
+def feed_rules(changes, on_sent):
+    for change in changes:
+        if change.relay is not None and "status" in change.fields and change.origin != RULE_ORIGIN:
+            rule_engine.emit("status", change.room, change.relay, change.fields["status"], change.origin)
+
+def handle_audio_message(topic, payload):
+    vad = vad_processors.get(topic.split('/')[-1].strip())
+    if not vad: return
+    if not metrics.enabled: return vad.process_chunk(payload)
+    # ~30 chunks/s per room: time it against the series VadAudio holds instead of via metrics.time().
+    start = time.perf_counter()
+    vad.process_chunk(payload)
+    vad.chunk_seconds.observe(time.perf_counter() - start)
+
+def handle_voice_session(topic, payload):
+    room_id = topic.split('/')[-1].strip()
+    command, _, codec = payload.decode('utf-8').partition(":")
+    if command == "START":
+        if not voice_model.is_ready():
+            log_command(f"[VOICE] Ignoring {room_id}: voice is {voice_model.state.replace('_', ' ')}.", room=room_id)
+            return
+        if codec and codec not in AUDIO_CODECS:
+            log_command(f"[VOICE] Ignoring {room_id}: unknown audio format '{codec}'.", room=room_id)
+            return
+        if room_id in vad_processors: vad_processors[room_id].close()
+        vad_processors[room_id] = VadAudio(room_id, aggressiveness=1, codec=codec or None)
+    elif command == "END": 
+        if room_id in vad_processors: vad_processors.pop(room_id).close()
+
+def handle_status_message(topic, payload):
+    room, relay, status = payload.decode('utf-8').split(':')
+    state_store.update(room, relay, "node", status=status)
+
+def handle_motion_trigger(topic, payload):
+    room_id = payload.decode('utf-8').strip()
+    motion_timers.touch(room_id)
+    history.record_motion(room_id)
+    rule_engine.emit("motion", room_id)
+
+def handle_discovery(topic, payload):
+    device_info = json.loads(payload.decode('utf-8'))
+    device_id = device_info["device_id"]
+    node_features[device_id] = set(device_info.get("features", []))
+    room = next((room for room, assigned in device_room_map.items() if assigned == device_id), None)
+    if room is None:
+        unassigned_devices[device_id] = {"device_id": device_id, "type": "esp32_relay", "last_seen": datetime.datetime.now().isoformat()}
+    elif room in device_states: config_sync.discovered(device_id, room, device_info)
+
+def handle_config_snapshot(topic, payload):
+    config_sync.note_retained(topic[len(MQTT_CONFIG_TOPIC_PREFIX):-len(CONFIG_SNAPSHOT_SUFFIX)], payload)
+
+# --- MQTT Topic Router ---
+# lane class -> (queue size, overflow policy). Audio keeps the freshest chunks and discovery sheds new
+# announcements (nodes re-announce). Status and motion have no lane: their handlers only take a lock and
+# enqueue, so they run inline on the network thread, where a queue hop would only add latency.
+ROUTER_LANES = {"audio": (256, "drop_oldest"), "slow": (64, "drop_new")}
+ROUTER_BLOCK_TIMEOUT_S = 0.5
+ROUTER_LATENCY_SAMPLES = 256
+
+class Lane:
+    """Bounded queue drained by its own worker thread, so a slow handler only delays its own lane."""
+    def __init__(self, name, maxsize, policy, on_done):
+        self.name = name
+        self.policy = policy
+        self.queue = queue.Queue(maxsize)
+        self.on_done = on_done
+        self.stats = {"enqueued": 0, "processed": 0, "dropped": 0, "max_depth": 0}
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def put(self, handler, topic, payload):
+        item = (time.perf_counter(), handler, topic, payload)
+        try:
+            if self.policy == "block": self.queue.put(item, timeout=ROUTER_BLOCK_TIMEOUT_S)
+            else: self.queue.put_nowait(item)
+        except queue.Full:
+            if self.policy != "drop_oldest":
+                self.stats["dropped"] += 1
+                return False
+            # Only the network thread produces, so one eviction always makes room.
+            try: self.queue.get_nowait()
+            except queue.Empty: pass
+            self.stats["dropped"] += 1
+            self.queue.put_nowait(item)
+        self.stats["enqueued"] += 1
+        depth = self.queue.qsize()
+        if depth > self.stats["max_depth"]: self.stats["max_depth"] = depth
+        return True
+
+    def _run(self):
+        while True:
+            queued_at, handler, topic, payload = self.queue.get()
+            try: handler(topic, payload)
+            except Exception as e: print(f"[MQTT] Error on {topic}: {e}")
+            self.stats["processed"] += 1
+            self.on_done(topic, queued_at)
+
+class TopicRouter:
+    """Hands each MQTT message to a lane by topic: audio per room, discovery slow; status/motion run inline.
+
+    Voice START/END share their room's audio lane so a session is always opened before its audio
+    and closed after it.
+    """
+    def __init__(self, lanes=ROUTER_LANES):
+        self.lane_config = lanes
+        self.lanes = {}
+        self.lock = threading.Lock()
+        self.latency_ms = collections.defaultdict(lambda: collections.deque(maxlen=ROUTER_LATENCY_SAMPLES))
+        self.stats = {"inline": 0, "inline_errors": 0}
+
+    def classify(self, topic):
+        # Returns (lane name, lane class, handler), or None for topics the hub doesn't consume; lane None is inline.
+        if topic.startswith(MQTT_VOICE_AUDIO_TOPIC): return f"audio:{topic.split('/')[-1].strip()}", "audio", handle_audio_message
+        if topic.startswith(MQTT_VOICE_COMMAND_TOPIC): return f"audio:{topic.split('/')[-1].strip()}", "audio", handle_voice_session
+        if topic == MQTT_STATUS_TOPIC: return None, "inline", handle_status_message
+        if topic == MQTT_TRIGGER_TOPIC: return None, "inline", handle_motion_trigger
+        if topic == MQTT_DISCOVERY_TOPIC: return "slow", "slow", handle_discovery
+        if topic.startswith(MQTT_CONFIG_TOPIC_PREFIX) and topic.endswith(CONFIG_SNAPSHOT_SUFFIX): return "slow", "slow", handle_config_snapshot
+        return None
+
+    def lane(self, name, lane_class):
+        lane = self.lanes.get(name)
+        if lane is None:
+            with self.lock:
+                lane = self.lanes.get(name)
+                if lane is None:
+                    maxsize, policy = self.lane_config[lane_class]
+                    lane = self.lanes[name] = Lane(name, maxsize, policy, self.record)
+        return lane
+
+    def route(self, topic, payload):
+        route = self.classify(topic)
+        if route is None: return False
+        name, lane_class, handler = route
+        if name is None:
+            start = time.perf_counter()
+            try: handler(topic, payload)
+            except Exception as e:
+                self.stats["inline_errors"] += 1
+                print(f"[MQTT] Error on {topic}: {e}")
+            self.stats["inline"] += 1
+            self.record(topic, start)
+            return True
+        return self.lane(name, lane_class).put(handler, topic, payload)
+
+    def record(self, topic, queued_at):
+        self.latency_ms[topic].append((time.perf_counter() - queued_at) * 1000)
+
+    def summary(self):
+        lanes = {name: dict(lane.stats, depth=lane.queue.qsize(), policy=lane.policy) for name, lane in list(self.lanes.items())}
+        latency = {}
+        for topic, samples in list(self.latency_ms.items()):
+            ordered = sorted(samples)
+            if ordered: latency[topic] = {"count": len(ordered), "p50_ms": ordered[len(ordered) // 2], "p99_ms": ordered[int(len(ordered) * 0.99)], "max_ms": ordered[-1]}
+        return {"lanes": lanes, "latency": latency, **self.stats}
+
+topic_router = TopicRouter()
 
 def on_connect(client, userdata, flags, rc, properties=None):
     print(f"Connected to MQTT Broker with code {rc}")
+    mark_startup("mqtt_connected")
     client.subscribe(f"{MQTT_VOICE_AUDIO_TOPIC}#")
     client.subscribe(f"{MQTT_VOICE_COMMAND_TOPIC}#")
     client.subscribe(MQTT_DISCOVERY_TOPIC)
     client.subscribe(MQTT_ASSIGNMENT_TOPIC)
     client.subscribe(MQTT_TRIGGER_TOPIC)
     client.subscribe(MQTT_STATUS_TOPIC)
+    client.subscribe(f"{MQTT_CONFIG_TOPIC_PREFIX}+{CONFIG_SNAPSHOT_SUFFIX}")
+    config_sync.mark_all()
 
 def on_message(client, userdata, msg):
-    try:
-        topic = msg.topic
-        if topic.startswith(MQTT_VOICE_AUDIO_TOPIC):
-            room_id = topic.split('/')[-1].strip()
-            if room_id in vad_processors: vad_processors[room_id].process_chunk(msg.payload)
-            return
-        try: payload_str = msg.payload.decode('utf-8')
-        except: return
-
-        if topic == MQTT_STATUS_TOPIC:
-            room, relay, status = payload_str.split(':')
-            if room in device_states and relay in device_states[room]:
-                device_states[room][relay]['status'] = status
-                broadcast_update({"type": "status_update", "room": room, "relay": relay, "status": status})
-                save_config(device_states, "device_config.json")
-            return
-        if topic.startswith(MQTT_VOICE_COMMAND_TOPIC):
-            room_id = topic.split('/')[-1].strip()
-            if payload_str == "START": vad_processors[room_id] = VadAudio(room_id, aggressiveness=1)
-            elif payload_str == "END": 
-                if room_id in vad_processors: del vad_processors[room_id]
-            return
-        if topic == MQTT_TRIGGER_TOPIC:
-            last_motion_time[payload_str.strip()] = datetime.datetime.now()
-            return
-        if topic == MQTT_DISCOVERY_TOPIC:
-            device_info = json.loads(payload_str)
-            device_id = device_info["device_id"]
-            if device_id not in device_room_map.values():
-                unassigned_devices[device_id] = {"device_id": device_id, "type": "esp32_relay", "last_seen": datetime.datetime.now().isoformat()}
+    # Runs on paho's network thread: status and motion are handled here, everything else is enqueued.
+    try: topic_router.route(msg.topic, msg.payload)
     except Exception as e: print(f"Error: {e}")
 
+# --- Browser Audio Decoding ---
+BROWSER_AUDIO_GAIN = 3.0
+FFMPEG_POOL_SIZE = 2
+BROWSER_STREAM_IDLE_S = 30
+FFMPEG_COMMAND = ['ffmpeg', '-loglevel', 'error', '-i', 'pipe:0', '-f', 's16le', '-ar', str(SAMPLE_RATE), '-ac', '1', 'pipe:1']
+
+def apply_gain(pcm, gain=BROWSER_AUDIO_GAIN):
+    samples = np.frombuffer(pcm, dtype=np.int16).astype(np.float32) * gain
+    return np.clip(samples, -32768, 32767).astype(np.int16).tobytes()
+
+class Resampler:
+    """Linear interpolation to SAMPLE_RATE that carries its position and last sample from chunk to chunk,
+    so a stream resampled in pieces lines up with the same stream resampled whole."""
+    def __init__(self, rate):
+        self.step = rate / SAMPLE_RATE
+        self.pos = 0.0      # next output position, in input samples from `last`
+        self.last = None
+
+    def __call__(self, samples):
+        if self.last is not None: samples = np.concatenate(([self.last], samples))
+        if not len(samples): return samples
+        positions = np.arange(self.pos, len(samples) - 1, self.step)
+        out = np.interp(positions, np.arange(len(samples)), samples)
+        self.pos += len(positions) * self.step - (len(samples) - 1)
+        self.last = samples[-1]
+        return out
+
+def pcm_to_mono_16k(samples, rate, channels, resampler=None):
+    # samples: int16 array as read from the upload; pass the stream's Resampler when converting it chunk by chunk.
+    if channels > 1: samples = samples.reshape(-1, channels).mean(axis=1)
+    if rate != SAMPLE_RATE and len(samples): samples = (resampler or Resampler(rate))(samples)
+    return samples.astype(np.int16)
+
+def pcm_format(content_type):
+    # (dtype, rate, channels) for the raw PCM types we decode in-process, or None.
+    mimetype, _, params = (content_type or "").lower().partition(";")
+    options = dict(p.strip().split("=", 1) for p in params.split(";") if "=" in p)
+    if mimetype.strip() not in ("audio/pcm", "audio/l16"): return None
+    # audio/L16 is big-endian per RFC 2586; our own audio/pcm is little-endian like the room nodes.
+    return ">i2" if mimetype.strip() == "audio/l16" else "<i2", int(options.get("rate", SAMPLE_RATE)), max(int(options.get("channels", 1)), 1)
+
+def decode_direct(data, content_type):
+    # WAV and raw PCM are decoded in-process; returns None for formats that need ffmpeg.
+    if data[:4] == b"RIFF" and data[8:12] == b"WAVE":
+        try:
+            with wave.open(io.BytesIO(data), "rb") as w:
+                if w.getsampwidth() != 2 or w.getcomptype() != "NONE": return None
+                samples = np.frombuffer(w.readframes(w.getnframes()), dtype="<i2")
+                return apply_gain(pcm_to_mono_16k(samples, w.getframerate(), w.getnchannels()).tobytes())
+        except (wave.Error, EOFError): return None
+    pcm = pcm_format(content_type)
+    if pcm:
+        dtype, rate, channels = pcm
+        samples = np.frombuffer(data[:len(data) - len(data) % (2 * channels)], dtype=dtype)
+        return apply_gain(pcm_to_mono_16k(samples, rate, channels).tobytes())
+    return None
+
+class FfmpegPool:
+    """Keeps ffmpeg processes forked ahead and waiting on stdin, so a request never waits for fork+exec.
+
+    Each decode still uses up one process (ffmpeg reads one container per run); its replacement is
+    spawned on a background thread.
+    """
+    def __init__(self, size=FFMPEG_POOL_SIZE, command=FFMPEG_COMMAND):
+        self.size = size
+        self.command = command
+        self.lock = threading.Lock()
+        self.spares = []
+        self.stats = {"decodes": 0, "cold_starts": 0}
+
+    def _spawn(self):
+        return subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    def refill(self):
+        def fill():
+            while True:
+                with self.lock:
+                    if len(self.spares) >= self.size: return
+                try: proc = self._spawn()
+                except OSError as e:
+                    print(f"[AUDIO] ffmpeg unavailable: {e}")
+                    return
+                with self.lock: self.spares.append(proc)
+        threading.Thread(target=fill, daemon=True).start()
+
+    def acquire(self):
+        with self.lock:
+            while self.spares:
+                proc = self.spares.pop()
+                if proc.poll() is None: break
+            else: proc = None
+        if proc is None:
+            self.stats["cold_starts"] += 1
+            proc = self._spawn()
+        self.refill()
+        self.stats["decodes"] += 1
+        return proc
+
+    def decode(self, data):
+        out, _ = self.acquire().communicate(input=data)
+        return out
+
+ffmpeg_pool = FfmpegPool()
+
+class BrowserAudioStream:
+    """One chunked browser upload: chunks are decoded and fed to a StreamingDecoder as they arrive."""
+    def __init__(self, room_id, content_type):
+        self.room_id = room_id
+        self.content_type = content_type
+        self.decoder = open_decoder(room_id, source="browser")
+        self.proc = None
+        self.pcm = None
+        self.resampler = None
+        self.pending = bytearray()
+        self.started = False
+        self.requests = 0
+        self.last_seen = time.monotonic()
+        self.reader = None
+
+    def feed(self, chunk):
+        self.last_seen = time.monotonic()
+        if not self.started:
+            self.started = True
+            chunk = self._start(chunk)
+        if self.proc:
+            self.proc.stdin.write(chunk)
+            return
+        self.pending.extend(chunk)
+        # Whole frames only: half a stereo frame would not reshape, and would shift the channels after it.
+        dtype, rate, channels = self.pcm
+        usable = len(self.pending) - len(self.pending) % (2 * channels)
+        if usable:
+            samples = np.frombuffer(bytes(self.pending[:usable]), dtype=dtype)
+            self.decoder.feed(apply_gain(pcm_to_mono_16k(samples, rate, channels, self.resampler).tobytes()))
+            del self.pending[:usable]
+
+    def _start(self, first):
+        # Decide from the first chunk whether we can decode in-process or need ffmpeg.
+        mimetype = (self.content_type or "").lower().partition(";")[0].strip()
+        if first[:4] == b"RIFF" and first[8:12] == b"WAVE" and len(first) >= 44:
+            channels, rate = struct.unpack_from("<HI", first, 22)
+            bits, = struct.unpack_from("<H", first, 34)
+            if bits == 16 and first[36:40] == b"data":
+                self.content_type = f"audio/pcm;rate={rate};channels={channels}"
+                self.pcm = pcm_format(self.content_type)
+                self.resampler = Resampler(rate)
+                return first[44:]
+        elif mimetype in ("audio/pcm", "audio/l16"):
+            self.pcm = pcm_format(self.content_type)
+            self.resampler = Resampler(self.pcm[1])
+            return first
+        # Compressed container (webm/ogg/mp4): pipe through a warm ffmpeg and decode its output as it comes.
+        self.proc = ffmpeg_pool.acquire()
+        self.reader = threading.Thread(target=self._read_ffmpeg, daemon=True)
+        self.reader.start()
+        return first
+
+    def _read_ffmpeg(self):
+        while True:
+            out = self.proc.stdout.read(4096)
+            if not out: return
+            self.decoder.feed(apply_gain(out[:len(out) - len(out) % 2]))
+
+    def finish(self):
+        if self.proc:
+            self.proc.stdin.close()
+            self.reader.join(timeout=10)
+            self.proc.wait(timeout=10)
+        self.decoder.finish(time.perf_counter())
+
+    def cancel(self):
+        if self.proc: self.proc.kill()
+        self.decoder.cancel()
+
+browser_streams = {}
+browser_streams_lock = threading.Lock()
+
+def expire_browser_streams():
+    now = time.monotonic()
+    with browser_streams_lock:
+        for key in [k for k, st in browser_streams.items() if now - st.last_seen > BROWSER_STREAM_IDLE_S]:
+            browser_streams.pop(key).cancel()
+
+def reap_browser_streams():
+    # An upload abandoned mid-stream (tab closed, network gone) holds a recognizer and maybe an ffmpeg
+    # until it is expired, and with no further stream requests nothing else would expire it.
+    while True:
+        time.sleep(BROWSER_STREAM_IDLE_S / 2)
+        try: expire_browser_streams()
+        except Exception as e: print(f"[AUDIO] Error: {e}")
+
 # --- Routes ---
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -411,7 +3227,42 @@ def logout():
 @app.route("/")
 @login_required
 def index():
-    return render_template("index.html", device_states=device_states, device_room_map=device_room_map)
+    # A shell: the dashboard hydrates from /api/state and keeps itself current from /status-stream.
+    return render_template("index.html", voice_state=voice_model.state)
+
+# --- State Snapshot API ---
+STATE_GZIP_MIN_BYTES = 1024
+
+def state_etag(rooms):
+    # Must run under state_store.view(): covers every relay and room-level write in `rooms` and their hardware binding.
+    key = json.dumps([[room, state_store.room_version(room), room in device_room_map] for room in rooms])
+    return f"{BOOT_ID}-{zlib.crc32(key.encode('utf-8')):08x}"
+
+def state_slice(rooms):
+    # The dashboard's view of each room: relay labels, statuses and motion flags, and whether a node is bound.
+    return {room: {"bound": room in device_room_map,
+                   "relays": {relay: {"label": data.get("label"), "status": data.get("status", "OFF"), "motion_control": bool(data.get("motion_control"))}
+                              for relay, data in device_states[room].items() if relay.startswith("relay") and isinstance(data, dict)}}
+            for room in rooms if room in device_states}
+
+@app.route("/api/state")
+@login_required
+def api_state():
+    # ?room= (repeatable) for a slice. ETag + If-None-Match; X-State-Version / X-Event-Id on 200 and 304 alike:
+    # resume /status-stream from the event id and ignore events tagged with a version at or below the state version.
+    wanted = request.args.getlist("room")
+    def read():
+        rooms = wanted or list(device_states)
+        version, event_id, etag = state_store.version, broadcast_hub.seq, state_etag(rooms)
+        return version, event_id, etag, None if request.if_none_match.contains(etag) else state_slice(rooms)
+    version, event_id, etag, rooms = state_store.view(read, wanted or None)
+    headers = {"ETag": f'"{etag}"', "Cache-Control": "no-cache", "Vary": "Accept-Encoding", "X-State-Version": str(version), "X-Event-Id": str(event_id)}
+    if rooms is None: return Response(status=304, headers=headers)
+    body = json.dumps({"boot": BOOT_ID, "version": version, "event_id": event_id, "rooms": rooms}, separators=(",", ":")).encode("utf-8")
+    if len(body) >= STATE_GZIP_MIN_BYTES and "gzip" in request.accept_encodings:
+        body = gzip.compress(body, 6)
+        headers["Content-Encoding"] = "gzip"
+    return Response(body, mimetype="application/json", headers=headers)
 
 # --- MODE MANAGEMENT ROUTES ---
 @app.route("/modes")
@@ -448,6 +3299,8 @@ def save_mode():
     
     current_modes[mode_name] = new_mode
     save_config(current_modes, "modes.json")
+    bump_config_version()
+    mode_scheduler.reload(current_modes)
     return redirect(url_for('modes'))
 
 @app.route("/delete_mode", methods=["POST"])
@@ -458,8 +3311,40 @@ def delete_mode():
     if mode_name in current_modes:
         del current_modes[mode_name]
         save_config(current_modes, "modes.json")
+        bump_config_version()
+        mode_scheduler.reload(current_modes)
     return redirect(url_for('modes'))
 
+# --- RULE ROUTES ---
+@app.route("/rules")
+@login_required
+def rules():
+    return {"rules": load_config("rules.json"), "stats": rule_engine.stats}
+
+@app.route("/save_rule", methods=["POST"])
+@login_required
+def save_rule():
+    data = request.get_json(silent=True)
+    if not data or not data.get("name") or not isinstance(data.get("rule"), dict): return "Invalid JSON", 400
+    try: compile_rule(data["name"], data["rule"])
+    except (ValueError, TypeError) as e: return f"Invalid rule: {e}", 400
+    current_rules = load_config("rules.json")
+    current_rules[data["name"]] = data["rule"]
+    save_config(current_rules, "rules.json")
+    rule_engine.reload(current_rules)
+    return "OK", 200
+
+@app.route("/delete_rule", methods=["POST"])
+@login_required
+def delete_rule():
+    rule_name = (request.get_json(silent=True) or request.form).get("name")
+    current_rules = load_config("rules.json")
+    if rule_name in current_rules:
+        del current_rules[rule_name]
+        save_config(current_rules, "rules.json")
+        rule_engine.reload(current_rules)
+    return "OK", 200
+
 @app.route("/control", methods=["POST"])
 @login_required
 def control():
@@ -469,15 +3354,11 @@ def control():
     motion_ctrl = data.get("motion_control")
     
     if room in device_states and relay in device_states[room]:
-        if motion_ctrl is not None:
-            device_states[room][relay]['motion_control'] = motion_ctrl
-            broadcast_update({"type": "motion_update", "room": room, "relay": relay, "motion_control": motion_ctrl})
-        
-        if action:
-            device_states[room][relay]['status'] = action
-            client.publish(MQTT_PUB_TOPIC, f"{room}:{relay}:{action}")
-            
-        save_config(device_states, "device_config.json")
+        fields = {}
+        if motion_ctrl is not None: fields['motion_control'] = motion_ctrl
+        if "motion_timeout" in data: fields['motion_timeout'] = parse_motion_timeout(data["motion_timeout"])
+        if action: fields['status'] = action
+        state_store.update(room, relay, "user", **fields)
     return "OK", 200
 
 # Management routes
@@ -493,7 +3374,9 @@ def assign_device():
     device_room_map[room_name] = device_id
     save_config(device_room_map, "device_room_map.json")
     if device_id in unassigned_devices: unassigned_devices.pop(device_id)
-    client.publish(f"{MQTT_CONFIG_TOPIC_PREFIX}{device_id}", json.dumps(device_states.get(room_name, {})))
+    if room_name in device_states:
+        config_sync.push(device_id, room_name, full=True)
+        config_sync.publish_snapshot(device_id, room_name)
     return redirect(url_for("device_management"))
 
 @app.route("/unbind_device")
@@ -509,27 +3392,32 @@ def unassign_device():
         save_config(device_room_map, "device_room_map.json")
         client.publish(MQTT_ASSIGNMENT_TOPIC, json.dumps({"device_id": device_id, "room_name": "unassigned"}))
         client.publish(f"{MQTT_CONFIG_TOPIC_PREFIX}{device_id}", json.dumps({"action": "reset"}))
+        config_sync.forget(device_id)
     return redirect(url_for("device_management"))
 
 @app.route("/add_room")
 @login_required
 def add_room_form():
     if "Other" not in PRESET_DEVICES: PRESET_DEVICES.append("Other")
-    return render_template("add_room.html", preset_devices=PRESET_DEVICES)
+    return render_template("add_room.html", preset_devices=PRESET_DEVICES, default_motion_timeout=int(MOTION_TIMEOUT.total_seconds()), default_wake_word_sensitivity=WAKE_WORD_SENSITIVITY)
 
 @app.route("/add_room", methods=["POST"])
 @login_required
 def add_room():
     new_room = request.form.get("new_room", "").lower().strip().replace(" ", "_")
     if new_room and new_room not in device_states:
-        device_states[new_room] = {'wake_word': request.form.get("wake_word", "jarvis")}
+        room_data = {'wake_word': request.form.get("wake_word", "jarvis").strip().lower()}
+        sensitivity = parse_wake_word_sensitivity(request.form.get("wake_word_sensitivity"))
+        if sensitivity is not None: room_data['wake_word_sensitivity'] = sensitivity
+        timeout = parse_motion_timeout(request.form.get("motion_timeout"))
+        if timeout: room_data['motion_timeout'] = timeout
         for i in range(1, 9):
             relay_key = f"relay{i}"
             selection = request.form.get(f"relay{i}_select")
             label = request.form.get(f"relay{i}_custom") if selection == "Other" else selection
             motion = request.form.get(f'relay{i}_motion') == 'on'
-            device_states[new_room][relay_key] = {"label": label or f"Device {i}", "status": "OFF", "motion_control": motion}
-        save_config(device_states, "device_config.json")
+            room_data[relay_key] = {"label": label or f"Device {i}", "status": "OFF", "motion_control": motion}
+        state_store.put_room(new_room, room_data)
     return redirect(url_for("device_management"))
 
 @app.route("/edit_room")
@@ -537,7 +3425,7 @@ def add_room():
 def edit_room_form():
     selected_room = request.args.get('room')
     if "Other" not in PRESET_DEVICES: PRESET_DEVICES.append("Other")
-    return render_template("edit_room.html", device_states=device_states, selected_room=selected_room, preset_devices=PRESET_DEVICES)
+    return render_template("edit_room.html", device_states=device_states, selected_room=selected_room, preset_devices=PRESET_DEVICES, default_motion_timeout=int(MOTION_TIMEOUT.total_seconds()), default_wake_word_sensitivity=WAKE_WORD_SENSITIVITY)
 
 @app.route("/edit_room", methods=["POST"])
 @login_required
@@ -545,29 +3433,35 @@ def edit_room():
     original_room_name = request.form.get("original_room_name")
     if original_room_name not in device_states: return "Original room not found", 404
     new_room_name = request.form.get("new_room_name", original_room_name).lower().strip().replace(" ", "_")
-    room_data = device_states.get(original_room_name, {})
-    room_data['wake_word'] = request.form.get('wake_word', room_data.get('wake_word', 'jarvis'))
-    for i in range(1, 9):
-        relay_key = f'relay{i}'
-        selection = request.form.get(f"relay{i}_select")
-        label = request.form.get(f"relay{i}_custom") if selection == "Other" else selection
-        motion = request.form.get(f'relay{i}_motion') == 'on'
-        if relay_key in room_data:
-            room_data[relay_key]["label"] = label or f"Device {i}"
-            room_data[relay_key]["motion_control"] = motion
+    if original_room_name != new_room_name and new_room_name in device_states: return f"Room name '{new_room_name}' already exists.", 400
+    def edit(room_data):
+        room_data['wake_word'] = request.form.get('wake_word', room_data.get('wake_word', 'jarvis')).strip().lower()
+        if "wake_word_sensitivity" in request.form:
+            sensitivity = parse_wake_word_sensitivity(request.form.get("wake_word_sensitivity"))
+            if sensitivity is not None: room_data['wake_word_sensitivity'] = sensitivity
+            else: room_data.pop('wake_word_sensitivity', None)
+        if "motion_timeout" in request.form:
+            timeout = parse_motion_timeout(request.form.get("motion_timeout"))
+            if timeout: room_data['motion_timeout'] = timeout
+            else: room_data.pop('motion_timeout', None)
+        for i in range(1, 9):
+            relay_key = f'relay{i}'
+            selection = request.form.get(f"relay{i}_select")
+            label = request.form.get(f"relay{i}_custom") if selection == "Other" else selection
+            motion = request.form.get(f'relay{i}_motion') == 'on'
+            if relay_key in room_data:
+                room_data[relay_key]["label"] = label or f"Device {i}"
+                room_data[relay_key]["motion_control"] = motion
+    state_store.edit_room(original_room_name, edit)
     if original_room_name != new_room_name:
-        if new_room_name in device_states: return f"Room name '{new_room_name}' already exists.", 400
-        device_states[new_room_name] = device_states.pop(original_room_name)
+        if not state_store.rename_room(original_room_name, new_room_name): return f"Room name '{new_room_name}' already exists.", 400
         if original_room_name in device_room_map:
             device_id = device_room_map.pop(original_room_name)
             device_room_map[new_room_name] = device_id
             save_config(device_room_map, "device_room_map.json")
             client.publish(MQTT_ASSIGNMENT_TOPIC, json.dumps({"device_id": device_id, "room_name": new_room_name}))
-    save_config(device_states, "device_config.json")
-    current_room_name = new_room_name or original_room_name
-    if current_room_name in device_room_map:
-        device_id = device_room_map[current_room_name]
-        client.publish(f"{MQTT_CONFIG_TOPIC_PREFIX}{device_id}", json.dumps(device_states[current_room_name]))
+    # The node gets the edit as a config delta; a rename lands in device_room_map after the store's change event.
+    config_sync.mark(new_room_name or original_room_name)
     return redirect(url_for("device_management"))
 
 @app.route("/remove_room")
@@ -585,8 +3479,8 @@ def remove_room():
             save_config(device_room_map, "device_room_map.json")
             client.publish(MQTT_ASSIGNMENT_TOPIC, json.dumps({"device_id": device_id, "room_name": "unassigned"}))
             client.publish(f"{MQTT_CONFIG_TOPIC_PREFIX}{device_id}", json.dumps({"action": "reset"}))
-        del device_states[room_to_remove]
-        save_config(device_states, "device_config.json")
+            config_sync.forget(device_id)
+        state_store.remove_room(room_to_remove)
     return redirect(url_for("device_management"))
 
 @app.route("/process_browser_audio", methods=['POST'])
@@ -594,50 +3488,346 @@ def remove_room():
 def process_browser_audio():
     target_room = request.args.get('room') or next(iter(device_states), None)
     if not target_room or target_room not in device_states: return "Invalid room", 400
+    if not voice_model.is_ready(): return f"Voice is {voice_model.state.replace('_', ' ')}", 503
     try:
-        # --- ADDED: Volume Boost (3x) for GUI Mic ---
-        ffmpeg_command = ['ffmpeg', '-i', 'pipe:0', '-af', 'volume=3.0', '-f', 's16le', '-ar', str(SAMPLE_RATE), '-ac', '1', 'pipe:1']
-        
-        process = subprocess.run(ffmpeg_command, input=request.data, capture_output=True, check=True)
-        threading.Thread(target=process_voice_command, args=(target_room, process.stdout)).start()
+        # --- Volume Boost (3x) for GUI Mic ---
+        audio = decode_direct(request.data, request.content_type)
+        if audio is None: audio = apply_gain(ffmpeg_pool.decode(request.data))
+        decode_utterance(target_room, audio, None, "browser")
         return "OK", 200
     except Exception as e: return "Error", 500
 
+@app.route("/process_browser_audio_stream", methods=['POST'])
+@login_required
+def process_browser_audio_stream():
+    # Chunked upload: the dashboard posts each MediaRecorder slice with the same session id and
+    # final=1 on the last one, so decoding and recognition run while the user is still talking.
+    target_room = request.args.get('room') or next(iter(device_states), None)
+    session_id = request.args.get('session')
+    if not voice_model.is_ready(): return f"Voice is {voice_model.state.replace('_', ' ')}", 503
+    if not target_room or target_room not in device_states or not session_id: return "Invalid room", 400
+    expire_browser_streams()
+    key = (session_id, target_room)
+    with browser_streams_lock:
+        stream = browser_streams.get(key)
+        if stream is None: stream = browser_streams[key] = BrowserAudioStream(target_room, request.content_type)
+    try:
+        seq = request.args.get('seq')
+        if seq is not None and int(seq) != stream.requests: return "Out of order", 409
+        while True:
+            block = request.stream.read(8192)
+            if not block: break
+            stream.feed(block)
+        stream.requests += 1
+        if request.args.get('final') == '1':
+            with browser_streams_lock: browser_streams.pop(key, None)
+            stream.finish()
+        return "OK", 200
+    except Exception as e:
+        print(f"[AUDIO] Stream error: {e}")
+        with browser_streams_lock: browser_streams.pop(key, None)
+        stream.cancel()
+        return "Error", 500
+
+@metrics.collector
+def component_stats():
+    # The stats dicts the pipeline components already keep, exported as-is at scrape time.
+    for component, stats in (("sse", broadcast_hub.stats), ("journal", state_journal.stats), ("dispatcher", command_dispatcher.stats), ("ffmpeg", ffmpeg_pool.stats), ("log", command_log.stats), ("decode", decode_pool.stats), ("config_sync", config_sync.stats), ("modes", mode_executor.stats), ("wake_word", wake_word_stats), ("rules", rule_engine.stats), ("history", history.stats), ("router", topic_router.stats)):
+        for key, value in list(stats.items()): yield f"{component}_{key}", {}, value
+    for lane, stats in topic_router.summary()["lanes"].items():
+        for key in ("depth", "max_depth", "enqueued", "processed", "dropped"): yield f"router_{key}", {"lane": lane}, stats[key]
+    for room_id, vad in list(vad_processors.items()):
+        for key, value in vad.stats.items(): yield f"vad_{key}", {"room": room_id}, value
+        yield "vad_noise_floor", {"room": room_id}, round(vad.noise_floor, 1)
+
+METRICS_LOCAL_ADDRS = ("127.0.0.1", "::1")
+
+@app.route("/metrics")
+def metrics_endpoint():
+    # For logged-in sessions, and for a scraper running on the hub itself (loopback only).
+    if 'logged_in' not in session and request.remote_addr not in METRICS_LOCAL_ADDRS: return redirect(url_for('login'))
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/metrics/enabled", methods=["POST"])
+@login_required
+def metrics_enabled():
+    data = request.get_json(silent=True) or request.form
+    metrics.enabled = str(data.get("enabled", "")).lower() in ("1", "true", "on", "yes")
+    return {"enabled": metrics.enabled}
+
+@app.route("/metrics/profile")
+@login_required
+def metrics_profile():
+    # Blocks for ?seconds= while sampling; returns folded stacks.
+    try: seconds, interval_ms = float(request.args.get("seconds", 10)), float(request.args.get("interval_ms", 5))
+    except ValueError: return "Invalid seconds/interval_ms", 400
+    folded = profiler.sample(seconds, max(interval_ms, 1) / 1000)
+    if folded is None: return "A profile is already running", 409
+    return Response(folded, mimetype="text/plain")
+
+@app.route("/logs")
+@login_required
+def logs():
+    # ?room=&category=&since=&until= (epoch seconds or ISO time) &limit=; newest first.
+    def when(name):
+        value = request.args.get(name)
+        if not value: return None
+        try: return float(value)
+        except ValueError: return datetime.datetime.fromisoformat(value).timestamp()
+    try: since, until, limit = when("since") or 0, when("until"), min(int(request.args.get("limit", 100)), LOG_QUERY_MAX)
+    except ValueError: return "Invalid since/until/limit", 400
+    records = command_log.query(request.args.get("room") or None, request.args.get("category") or None, since, until, limit)
+    return {"records": [record._asdict() for record in records]}
+
+@app.route("/history")
+@login_required
+def history_query():
+    # ?room=&relay= (a relay key or "motion") &since=&until= (epoch seconds or ISO time, default the last 7 days)
+    # &resolution=hour|day|raw (default: hour, or day past a month or beyond the hourly rollups) &group=hour_of_day|weekday
+    def when(name, default):
+        value = request.args.get(name)
+        if not value: return default
+        try: return float(value)
+        except ValueError: return datetime.datetime.fromisoformat(value).timestamp()
+    now = time.time()
+    try: since, until = when("since", now - 7 * 86400), when("until", now)
+    except ValueError: return "Invalid since/until", 400
+    if until <= since or until - since > HISTORY_QUERY_MAX_DAYS * 86400: return "Invalid range", 400
+    resolution, group = request.args.get("resolution"), request.args.get("group")
+    if not resolution: resolution = "day" if until - since > 31 * 86400 or since < now - history.hourly_days * 86400 else "hour"
+    if resolution not in ("hour", "day", "raw") or group not in (None, "hour_of_day", "weekday"): return "Invalid resolution/group", 400
+    if group == "hour_of_day" and resolution != "hour": return "hour_of_day needs resolution=hour", 400
+    series = history.match_series(request.args.get("room") or None, request.args.get("relay") or None)
+    result = {"since": since, "until": until, "resolution": resolution, "series": {}}
+    if resolution == "raw":
+        if since < now - history.raw_days * 86400: return f"Raw history only covers the last {history.raw_days} days", 400
+        rows = history.transitions(series.values(), since, until)
+        for name, sid in series.items():
+            mine = rows[rows["series"] == sid]
+            result["series"][name] = {"transitions": [[int(ts) + ms / 1000, int(value)] for ts, ms, value in zip(mine["ts"], mine["ms"], mine["value"])]}
+        return result
+    rows = history.query(series.values(), since, until, resolution)
+    offset = datetime.datetime.now().astimezone().utcoffset().total_seconds()
+    for name, sid in series.items():
+        mine = np.sort(rows[rows["series"] == sid], order="start")
+        entry = result["series"][name] = {"events": int(mine["events"].sum()), "on_seconds": int(mine["on_s"].sum())}
+        if group:
+            local = mine["start"].astype(np.int64) + int(offset)
+            slots, size = ((local // 3600) % 24, 24) if group == "hour_of_day" else ((local // 86400 + 3) % 7, 7)    # epoch day 0 was a Thursday
+            entry[group] = {"events": np.bincount(slots, mine["events"], size).astype(int).tolist(), "on_seconds": np.bincount(slots, mine["on_s"], size).astype(int).tolist()}
+        else: entry["buckets"] = mine[["start", "events", "on_s"]].tolist()
+    return result
+
 @app.route("/status-stream")
 def status_stream():
-    q = queue.Queue(maxsize=100) 
-    sse_subscribers.append(q)
-    def event_stream():
+    # EventSource resends Last-Event-ID on its own reconnects; the dashboard passes it as a query arg when it reconnects itself.
+    cursor, hello = broadcast_hub.open(request.headers.get("Last-Event-ID") or request.args.get("last_event_id"))
+    return Response(broadcast_hub.stream(cursor, hello), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+# --- Async Server ---
+ASYNC_WSGI_WORKERS = 16        # threads for the Flask routes; event streams never hold one
+ASYNC_MAX_HEADER_BYTES = 16384
+ASYNC_MAX_BODY_BYTES = 16 * 1024 * 1024
+
+class AsyncHubServer:
+    """One asyncio event loop serving every /status-stream client, in front of the unchanged Flask app.
+
+    An idle dashboard costs a coroutine and a socket instead of a thread blocked in BroadcastHub.read().
+    BroadcastHub listeners (called from MQTT and worker threads) wake the loop; every other route,
+    the JSON control API included, runs through Flask on a small thread pool, so routes, sessions
+    and templates behave exactly as under Werkzeug.
+    """
+    def __init__(self, wsgi_app, hub, workers=ASYNC_WSGI_WORKERS):
+        self.wsgi_app = wsgi_app
+        self.hub = hub
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="wsgi")
+        self.loop = None
+        self.changed = None
+        self.wake_pending = False
+        self.stats = {"connections": 0, "open": 0, "streams": 0, "requests": 0, "errors": 0}
+
+    def run(self, host="0.0.0.0", port=5000, ssl_context=None):
+        asyncio.run(self.serve(host, port, ssl_context))
+
+    async def serve(self, host, port, ssl_context=None, started=None):
+        self.loop = asyncio.get_running_loop()
+        self.changed = asyncio.Event()
+        self.hub.listeners.append(self._on_publish)
+        if isinstance(ssl_context, tuple):
+            cert, key = ssl_context
+            ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            ssl_context.load_cert_chain(cert, key)
+        server = await asyncio.start_server(self._handle, host, port, ssl=ssl_context, limit=ASYNC_MAX_HEADER_BYTES, backlog=1024)
+        if started: started(server)
+        try:
+            async with server: await server.serve_forever()
+        finally: self.hub.listeners.remove(self._on_publish)
+
+    def _on_publish(self):
+        # Publishing thread: one loop wakeup per burst, not per event.
+        if self.wake_pending or self.loop is None: return
+        self.wake_pending = True
+        self.loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self):
+        self.wake_pending = False
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    async def _handle(self, reader, writer):
+        self.stats["connections"] += 1
+        self.stats["open"] += 1
         try:
             while True:
-                data = q.get()
-                yield f"data: {json.dumps(data)}\n\n"
-        except GeneratorExit:
-            if q in sse_subscribers: sse_subscribers.remove(q)
-        except Exception:
-            if q in sse_subscribers: sse_subscribers.remove(q)
-    return Response(event_stream(), mimetype="text/event-stream")
+                request_line = await reader.readline()
+                if not request_line.strip(): break
+                method, target, version = request_line.decode("latin-1").split()
+                headers = []
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""): break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers.append((name.strip().lower(), value.strip()))
+                fields = dict(headers)
+                path, _, query = target.partition("?")
+                if method == "GET" and path == "/status-stream":
+                    await self._stream(writer, fields, query)
+                    break
+                body = await self._read_body(reader, fields)
+                if body is None:
+                    writer.write(b"HTTP/1.1 413 Payload Too Large\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                    break
+                keep_alive = version == "HTTP/1.1" and fields.get("connection", "").lower() != "close"
+                environ = self._environ(writer, method, path, query, version, headers, fields, body)
+                self.stats["requests"] += 1
+                writer.write(await self.loop.run_in_executor(self.pool, self._call_wsgi, environ, keep_alive))
+                await writer.drain()
+                if not keep_alive: break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError): self.stats["errors"] += 1
+        finally:
+            self.stats["open"] -= 1
+            writer.close()
 
-if __name__ == "__main__":
-    device_states = load_config("device_config.json")
+    async def _read_body(self, reader, fields):
+        if fields.get("transfer-encoding", "").lower() == "chunked":
+            body = bytearray()
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size == 0: break
+                body += await reader.readexactly(size + 2)
+                del body[-2:]
+                if len(body) > ASYNC_MAX_BODY_BYTES: return None
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""): pass
+            return bytes(body)
+        length = int(fields.get("content-length") or 0)
+        if length > ASYNC_MAX_BODY_BYTES: return None
+        return await reader.readexactly(length) if length else b""
+
+    def _environ(self, writer, method, path, query, version, headers, fields, body):
+        host, port = (writer.get_extra_info("sockname") or ("0.0.0.0", 0))[:2]
+        peer = writer.get_extra_info("peername") or ("", 0)
+        environ = {"REQUEST_METHOD": method, "SCRIPT_NAME": "", "PATH_INFO": urllib.parse.unquote(path, "latin-1"), "QUERY_STRING": query,
+                   "SERVER_NAME": str(host), "SERVER_PORT": str(port), "SERVER_PROTOCOL": version, "REMOTE_ADDR": peer[0],
+                   "CONTENT_TYPE": fields.get("content-type", ""), "CONTENT_LENGTH": str(len(body)),
+                   "wsgi.version": (1, 0), "wsgi.url_scheme": "https" if writer.get_extra_info("sslcontext") else "http",
+                   "wsgi.input": io.BytesIO(body), "wsgi.errors": sys.stderr, "wsgi.multithread": True, "wsgi.multiprocess": False, "wsgi.run_once": False}
+        for name, value in headers:
+            if name in ("content-type", "content-length"): continue
+            key = "HTTP_" + name.upper().replace("-", "_")
+            environ[key] = f"{environ[key]}, {value}" if key in environ else value
+        return environ
+
+    def _call_wsgi(self, environ, keep_alive):
+        # Worker thread: run the Flask app and return the whole response, ready to write.
+        started = []
+        def start_response(status, response_headers, exc_info=None):
+            started[:] = [status, response_headers]
+        result = self.wsgi_app(environ, start_response)
+        try: body = b"".join(result)
+        finally:
+            if hasattr(result, "close"): result.close()
+        status, response_headers = started
+        lines = [f"HTTP/1.1 {status}"]
+        lines += [f"{name}: {value}" for name, value in response_headers if name.lower() not in ("content-length", "connection", "transfer-encoding")]
+        lines += [f"Content-Length: {len(body)}", f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body
+
+    async def _stream(self, writer, fields, query):
+        last_event_id = fields.get("last-event-id") or urllib.parse.parse_qs(query).get("last_event_id", [None])[0]
+        cursor, hello = self.hub.open(last_event_id)
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\nConnection: keep-alive\r\n\r\n" + hello.encode("utf-8"))
+        self.stats["streams"] += 1
+        with self.hub.cond: self.hub.stats["clients"] += 1
+        try:
+            while True:
+                cursor, chunks = self.hub.poll(cursor)
+                if chunks:
+                    writer.write("".join(chunks).encode("utf-8"))
+                    await writer.drain()
+                    continue
+                changed = self.changed
+                try: await asyncio.wait_for(changed.wait(), SSE_KEEPALIVE_S)
+                except asyncio.TimeoutError:
+                    writer.write(b": keepalive\n\n")
+                    await writer.drain()
+        finally:
+            self.stats["streams"] -= 1
+            with self.hub.cond: self.hub.stats["clients"] -= 1
+
+@app.before_request
+def note_first_request():
+    if "first_request" not in startup_timeline: mark_startup("first_request")
+
+@app.route("/health")
+def health():
+    # Readiness for scripts and the dashboard: relays are usable as soon as this answers, voice once "ready".
+    return {"voice": voice_model.state, "voice_error": voice_model.error, "mqtt": bool(client and client.is_connected()), "startup": startup_timeline}
+
+def start_services():
+    global device_room_map, client
+    voice_model.start()
+    command_log.start()
+    state_store.load(state_journal.replay())
+    state_journal.start()
+    atexit.register(state_journal.flush)
+    history.start(device_states)
     device_room_map = load_config("device_room_map.json")
+    mark_startup("config_loaded")
+    get_voice_grammar()
+    ffmpeg_pool.refill()
+    threading.Thread(target=reap_browser_streams, name="browser-streams", daemon=True).start()
     client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
     client.on_connect = on_connect
     client.on_message = on_message
-    client.connect(MQTT_BROKER, MQTT_PORT, 60)
-    
-    scheduler_thread = threading.Thread(target=scheduler_loop, daemon=True)
-    scheduler_thread.start()
+    # Non-blocking: the dashboard comes up even while the broker is still starting, paho retries in the background.
+    client.connect_async(MQTT_BROKER, MQTT_PORT, 60)
 
-    motion_thread = threading.Thread(target=check_motion_timeouts, daemon=True)
-    motion_thread.start()
+    mode_scheduler.reload()
+    mode_scheduler.start()
+    rule_engine.reload()
+    rule_engine.start()
+    config_sync.start()
+
+    motion_timers.start()
     client.loop_start()
 
+def run_hub(debug=False, host="0.0.0.0", port=5000, server="threaded"):
+    # Production by default: one process, no reloader, so the model loads once.
+    # Under the reloader only the child process (WERKZEUG_RUN_MAIN) runs the hub; the parent just watches files.
+    if not debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true": start_services()
+
     ssl_context = None
     if os.path.exists('cert.pem') and os.path.exists('key.pem'):
         ssl_context = ('cert.pem', 'key.pem')
         print("Starting Flask server with HTTPS...")
     else:
         print("Starting Flask server with HTTP...")
-    
-    app.run(host="0.0.0.0", port=5000, debug=True, ssl_context=ssl_context)
\ No newline at end of file
+    mark_startup("serving")
+    if server == "async" and not debug: AsyncHubServer(app, broadcast_hub).run(host, port, ssl_context)
+    else: app.run(host=host, port=port, debug=debug, use_reloader=debug, threaded=True, ssl_context=ssl_context)
+
+if __name__ == "__main__":
+    # --debug (or SMARTHOME_DEBUG=1) for development: reloader and Werkzeug debugger.
+    # --async (or SMARTHOME_SERVER=async): event streams on one asyncio loop instead of a thread per dashboard.
+    run_hub(debug="--debug" in sys.argv or os.environ.get("SMARTHOME_DEBUG") == "1",
+            server="async" if "--async" in sys.argv or os.environ.get("SMARTHOME_SERVER") == "async" else "threaded")
@@ -0,0 +1,2 @@
+"""Benchmarks for the hub. Each bench_*.py runs on its own from the repo root; loadgen.py holds the
+in-process broker and simulated room nodes shared by the end-to-end suite (bench_end_to_end.py)."""
@@ -0,0 +1,118 @@
+"""Node audio on the wire and at the hub: raw PCM chunks vs. sequenced mu-law packets.
+
+  raw    "START" sessions: bare 16-bit PCM chunks, appended in arrival order
+  mulaw  "START:mulaw" sessions: 8-byte header + one mu-law byte per sample, AudioStreamDecoder at the hub
+
+The audio is synthetic speech-like signal (voiced harmonics under a syllable envelope). Reported:
+bytes per room-second on the wire including per-message MQTT overhead, hub CPU per room-second to
+turn chunks into samples and through the full VadAudio path, and how well the audio survives packet
+loss and reordering (SNR against what the node captured, and how far the stream drifts in time).
+
+Run from the repo root: python benchmarks/bench_audio_transport.py [--seconds 20] [--loss 0.05] [--reorder 0.02]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app
+from benchmarks import loadgen
+
+TOPIC = f"{app.MQTT_VOICE_AUDIO_TOPIC}living_room"
+MQTT_OVERHEAD = 2 + 2 + len(TOPIC)    # fixed header with a 2-byte remaining length, topic length, topic (QoS 0)
+
+
+def synthetic_speech(seconds, seed=0):
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(app.SAMPLE_RATE * seconds)) / app.SAMPLE_RATE
+    pitch = 120 + 30 * np.sin(2 * np.pi * 0.7 * t)
+    phase = 2 * np.pi * np.cumsum(pitch) / app.SAMPLE_RATE
+    voiced = sum(np.sin(k * phase) / k for k in range(1, 12))
+    envelope = np.clip(np.sin(2 * np.pi * 2.5 * t), 0, None) ** 2 * (0.4 + 0.6 * (np.sin(2 * np.pi * 0.2 * t) > 0))
+    signal = 6000 * envelope * voiced + rng.normal(0, 60, len(t))
+    return np.clip(signal, -32768, 32767).astype(np.int16)
+
+
+def raw_chunks(pcm):
+    data = pcm.tobytes()
+    return [data[i:i + loadgen.CHUNK_BYTES] for i in range(0, len(data), loadgen.CHUNK_BYTES)]
+
+
+def impair(messages, loss, reorder, seed):
+    # Drop a share of the messages and swap some neighbours, as a congested Wi-Fi link would.
+    rng = random.Random(seed)
+    kept = [m for m in messages if rng.random() >= loss]
+    for i in range(len(kept) - 1):
+        if rng.random() < reorder: kept[i], kept[i + 1] = kept[i + 1], kept[i]
+    return kept
+
+
+def reconstruct(codec, messages):
+    # The samples the hub ends up with, plus the stream decoder's stats.
+    if codec == "raw": return np.frombuffer(b"".join(messages), dtype=np.int16), {}
+    decoder = app.AudioStreamDecoder({})
+    return np.concatenate([samples for m in messages for samples in decoder.decode(m)]), decoder.stats
+
+
+def snr_db(reference, signal):
+    n = min(len(reference), len(signal))
+    ref, err = reference[:n].astype(np.float64), reference[:n].astype(np.float64) - signal[:n]
+    noise = np.sum(err ** 2)
+    return 10 * np.log10(np.sum(ref ** 2) / noise) if noise else float("inf")
+
+
+def cpu_per_room_second(fn, messages, seconds, repeat):
+    t0 = time.process_time()
+    for _ in range(repeat): fn(messages)
+    return (time.process_time() - t0) / (repeat * seconds)
+
+
+def vad_path(codec):
+    def run(messages):
+        vad = app.VadAudio("living_room", streaming=False, codec=None if codec == "raw" else codec)
+        for m in messages: vad.process_chunk(m)
+    return run
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument("--loss", type=float, default=0.05, help="share of audio messages lost")
+    parser.add_argument("--reorder", type=float, default=0.02, help="share of messages swapped with the next one")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    app.CONFIG_PATH = tempfile.mkdtemp(prefix="smarthome-bench-")
+    app.log_command = lambda message, **fields: None
+    app.decode_utterance = lambda room_id, audio_data, speech_end=None, source="esp32": None
+
+    pcm = synthetic_speech(args.seconds)
+    streams = {"raw": raw_chunks(pcm), "mulaw": list(loadgen.audio_packets(pcm.tobytes(), "mulaw"))}
+    print(f"{args.seconds:g} s per room, {loadgen.CHUNK_BYTES // 2} samples per message, {MQTT_OVERHEAD} B MQTT overhead per message")
+
+    for codec, messages in streams.items(): vad_path(codec)(messages[:50])    # warm up webrtcvad and the metrics
+    for codec, messages in streams.items():
+        wire = sum(len(m) + MQTT_OVERHEAD for m in messages) / args.seconds
+        unpack = (lambda ms: [np.frombuffer(m, dtype=np.int16) for m in ms]) if codec == "raw" else (lambda ms: reconstruct("mulaw", ms))
+        unpack_us = cpu_per_room_second(unpack, messages, args.seconds, args.repeat) * 1e6
+        vad_us = cpu_per_room_second(vad_path(codec), messages, args.seconds, args.repeat) * 1e6
+        clean, _ = reconstruct(codec, messages)
+        print(f"{codec:5s}: {wire / 1000:5.1f} kB/s per room on the wire ({len(messages) / args.seconds:.1f} msgs/s); "
+              f"unpack {unpack_us:6.0f} us CPU per room-second, VadAudio path {vad_us:6.0f} us; clean SNR {snr_db(pcm, clean):5.1f} dB")
+
+    print(f"with {args.loss:.0%} loss and {args.reorder:.0%} reordering:")
+    for codec, messages in streams.items():
+        received = impair(messages, args.loss, args.reorder, seed=1)
+        out, stats = reconstruct(codec, received)
+        detail = f"; {stats['packets_lost']} lost, {stats['packets_late']} late, {stats['concealed_ms']} ms concealed" if stats else ""
+        drift = (len(pcm) - len(out)) * 1000 / app.SAMPLE_RATE
+        print(f"{codec:5s}: {len(messages) - len(received)} messages missing, "
+              f"SNR {snr_db(pcm, out):6.1f} dB, stream {drift:5.0f} ms short of real time at the end{detail}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Request latency of browser microphone uploads: ffmpeg spawned per request vs. the new decode path.
+
+Posts a 4 s clip repeatedly through the Flask test client and reports p50/p95 request latency for
+  * legacy   - subprocess.run(ffmpeg) on every request (needs ffmpeg on PATH)
+  * wav      - WAV decoded in-process with NumPy
+  * webm     - compressed upload through the warm ffmpeg pool (needs ffmpeg on PATH)
+  * stream   - the same WAV posted in 250 ms slices to /process_browser_audio_stream
+
+Recognition itself runs on a background thread in every case and is not part of the latency.
+
+Run from the repo root: python benchmarks/bench_browser_audio.py [requests]
+"""
+import io
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app
+
+CLIP_SECONDS = 4
+
+
+def make_wav():
+    samples = bytearray()
+    for i in range(app.SAMPLE_RATE * CLIP_SECONDS):
+        v = int(4000 * math.sin(2 * math.pi * 220 * i / app.SAMPLE_RATE))
+        samples += v.to_bytes(2, "little", signed=True)
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as w:
+        w.setnchannels(1); w.setsampwidth(2); w.setframerate(app.SAMPLE_RATE)
+        w.writeframes(bytes(samples))
+    return buf.getvalue()
+
+
+def percentiles(samples):
+    ordered = sorted(samples)
+    return ordered[len(ordered) // 2] * 1000, ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000
+
+
+def legacy_handler(data):
+    ffmpeg_command = ['ffmpeg', '-i', 'pipe:0', '-af', 'volume=3.0', '-f', 's16le', '-ar', str(app.SAMPLE_RATE), '-ac', '1', 'pipe:1']
+    return subprocess.run(ffmpeg_command, input=data, capture_output=True, check=True).stdout
+
+
+def timed_requests(count, send):
+    latencies = []
+    for i in range(count):
+        t0 = time.perf_counter()
+        send(i)
+        latencies.append(time.perf_counter() - t0)
+    return latencies
+
+
+def main(count=30):
+    count = int(count)
+    app.CONFIG_PATH = tempfile.mkdtemp(prefix="smarthome-bench-")
+    app.log_command = lambda message, **fields: None
+    app.process_voice_command = lambda room_id, audio_data, speech_end=None: None
+    app.decode_pool = app.DecodePool(size=0)
+    app.device_states.clear()
+    app.device_states["bench_room"] = {"wake_word": "jarvis", "relay1": {"label": "Fan", "status": "OFF", "motion_control": False}}
+    wav = make_wav()
+    client = app.app.test_client()
+    with client.session_transaction() as sess: sess["logged_in"] = True
+
+    results = {}
+    have_ffmpeg = shutil.which("ffmpeg") is not None
+    if have_ffmpeg:
+        results["legacy"] = timed_requests(count, lambda i: legacy_handler(wav))
+        webm = subprocess.run(["ffmpeg", "-loglevel", "error", "-f", "wav", "-i", "pipe:0", "-c:a", "libopus", "-f", "webm", "pipe:1"], input=wav, capture_output=True, check=True).stdout
+        app.ffmpeg_pool.refill()
+        time.sleep(0.5)
+        results["webm"] = timed_requests(count, lambda i: client.post("/process_browser_audio?room=bench_room", data=webm, content_type="audio/webm"))
+    else:
+        print("ffmpeg not on PATH: skipping legacy and webm cases")
+    results["wav"] = timed_requests(count, lambda i: client.post("/process_browser_audio?room=bench_room", data=wav, content_type="audio/wav"))
+
+    slice_bytes = app.SAMPLE_RATE * 2 // 4
+    def stream(i):
+        # Only the final request's latency matters to the user: earlier slices upload while they talk.
+        body = wav[44:]
+        slices = [wav[:44] + body[:slice_bytes]] + [body[o:o + slice_bytes] for o in range(slice_bytes, len(body), slice_bytes)]
+        for seq, chunk in enumerate(slices):
+            client.post(f"/process_browser_audio_stream?room=bench_room&session=s{i}&seq={seq}", data=chunk, content_type="audio/wav")
+        t0 = time.perf_counter()
+        client.post(f"/process_browser_audio_stream?room=bench_room&session=s{i}&seq={len(slices)}&final=1", data=b"", content_type="audio/wav")
+        return time.perf_counter() - t0
+    results["stream"] = [stream(i) for i in range(count)]
+
+    for label, latencies in results.items():
+        p50, p95 = percentiles(latencies)
+        print(f"{label:7s}: p50 {p50:7.1f} ms  p95 {p95:7.1f} ms  ({len(latencies)} requests)")
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,107 @@
+"""Command log: append cost vs. the old capped list, /logs query cost vs. scanning every segment, and
+how much of a VAD-heavy burst the per-category limiter keeps off the console and the dashboards.
+
+Every query is checked against a brute-force filter of the full on-disk history.
+
+Run from the repo root: python benchmarks/bench_command_log.py [records] [rooms]
+"""
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app
+
+CATEGORIES = ["VAD", "VAD", "VAD", "VOSK", "VOICE", "EXECUTE", "SKIPPED", "MOTION", "MODE", "LATENCY"]
+
+
+def legacy_log_command(command_log, message):
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    log_entry = f"{timestamp} - {message}"
+    command_log.insert(0, log_entry)
+    if len(command_log) > 100: command_log.pop()
+
+
+def scan_all(log):
+    records = []
+    for segment in log.segments:
+        with open(log._path(segment["file"]), encoding="utf-8") as f: records.extend(app.LogRecord(**json.loads(line)) for line in f)
+    return records
+
+
+def timed(fn, repeat=20):
+    t0 = time.perf_counter()
+    for _ in range(repeat): result = fn()
+    return result, (time.perf_counter() - t0) / repeat * 1000
+
+
+def main(records=150000, rooms=8):
+    records, rooms = int(records), int(rooms)
+    app.CONFIG_PATH = tempfile.mkdtemp(prefix="smarthome-bench-")
+    rng = random.Random(0)
+    room_names = [f"room_{r}" for r in range(rooms)]
+    messages = [(f"[{rng.choice(CATEGORIES)}] event {i}", rng.choice(room_names)) for i in range(records)]
+
+    legacy = []
+    t0 = time.perf_counter()
+    for message, room in messages[:20000]: legacy_log_command(legacy, message)
+    legacy_us = (time.perf_counter() - t0) / 20000 * 1e6
+
+    log = app.CommandLog(flush_interval=3600).start()
+    t0 = time.perf_counter()
+    for i, (message, room) in enumerate(messages):
+        log.append(message, room)
+        if i % 2000 == 1999: log.flush()
+    append_us = (time.perf_counter() - t0) / records * 1e6
+    log.flush()
+    print(f"append: legacy list {legacy_us:.2f} us/record (100 kept, lost on restart), ring + batched disk {append_us:.2f} us/record "
+          f"({len(log.segments)} segments on disk, {log.stats['rotations']} rotations)")
+
+    history = scan_all(log)
+    oldest, newest = history[0].ts, history[-1].ts
+    queries = {
+        "newest 100": dict(),
+        "room, newest 100": dict(room="room_3"),
+        "category MOTION since 90%": dict(category="MOTION", since=oldest + (newest - oldest) * 0.9),
+        "room + VOSK since 50%": dict(room="room_1", category="VOSK", since=oldest + (newest - oldest) * 0.5),
+        "room + MODE window 20-25%": dict(room="room_2", category="MODE", since=oldest + (newest - oldest) * 0.2, until=oldest + (newest - oldest) * 0.25),
+        "unknown room": dict(room="garage"),
+    }
+    ok = True
+    for name, kwargs in queries.items():
+        result, indexed_ms = timed(lambda: log.query(limit=100, **kwargs))
+        _, scan_ms = timed(lambda: scan_all(log), repeat=3)
+        since, until = kwargs.get("since", 0), kwargs.get("until", float("inf"))
+        expected = [r for r in reversed(history) if kwargs.get("room", r.room) == r.room and kwargs.get("category", r.category) == r.category and since <= r.ts <= until][:100]
+        same = [r.seq for r in result] == [r.seq for r in expected]
+        ok &= same
+        print(f"  {name:28s} {len(result):3d} rows  indexed {indexed_ms:7.2f} ms  full scan {scan_ms:7.1f} ms  matches scan: {same}")
+
+    restarted = app.CommandLog().start()
+    resumed = restarted.append("[INFO] after restart")
+    print(f"restart: ring refilled with {len(restarted.ring) - 1} records, numbering resumes at {resumed.seq} (last on disk {history[-1].seq})")
+    ok &= resumed.seq == history[-1].seq + 1
+
+    app.command_log = app.CommandLog()
+    sent = []
+    app.broadcast_update = sent.append
+    app.print = lambda *args, **kwargs: None
+    t0 = time.perf_counter()
+    burst = 0
+    while time.perf_counter() - t0 < 2:
+        app.log_command("[VAD] Speech detected in room_0.", room="room_0")
+        if burst % 50 == 0: app.log_command("[EXECUTE] Fan -> ON", room="room_0")
+        burst += 1
+        time.sleep(0.001)
+    by_category = {}
+    for event in sent: by_category[event["category"]] = by_category.get(event["category"], 0) + 1
+    print(f"2 s VAD burst: {burst} VAD records logged, broadcast {by_category}, {app.command_log.stats['suppressed']} held back")
+    if not ok: sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
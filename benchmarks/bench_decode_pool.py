@@ -0,0 +1,92 @@
+"""Voice decoding under concurrent speech: a thread per utterance in the hub process vs. the decode pool.
+
+1 to N rooms speak at once, each issuing back-to-back commands in real time. For every room
+count this reports the commands acted on, per-second throughput, latency from end of speech
+to action (p50/p95/max), commands acted on later than the staleness limit, and what the pool
+dropped as stale, superseded or over its queue bound.
+
+Run from the repo root: python benchmarks/bench_decode_pool.py [--rooms 8] [--workers 2] [--wav command.wav]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+import wave
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app
+
+
+def load_audio(path, seconds):
+    if not path: return bytes(int(app.SAMPLE_RATE * seconds) * 2)
+    with wave.open(path, "rb") as w: return w.readframes(w.getnframes())
+
+
+def run(rooms, utterances, gap_s, audio):
+    handled, lock = [], threading.Lock()
+    def on_text(room_id, text, speech_end=None, decode_mode="batch", source="esp32"):
+        with lock: handled.append(time.perf_counter() - speech_end)
+    app.handle_voice_text = on_text
+    utterance_s = len(audio) / (app.SAMPLE_RATE * 2)
+    peak_threads = [threading.active_count()]
+    def speaker(room_id):
+        for _ in range(utterances):
+            time.sleep(utterance_s)      # the user talking
+            app.decode_utterance(room_id, audio, time.perf_counter())
+            peak_threads[0] = max(peak_threads[0], threading.active_count())
+            time.sleep(gap_s)
+    speakers = [threading.Thread(target=speaker, args=(f"room_{r}",)) for r in range(rooms)]
+    t0 = time.perf_counter()
+    for s in speakers: s.start()
+    for s in speakers: s.join()
+    deadline = time.perf_counter() + 120
+    expected = rooms * utterances
+    while time.perf_counter() < deadline:
+        stats = app.decode_pool.stats
+        dropped = sum(stats[k] for k in ("dropped_stale", "dropped_superseded", "dropped_full")) if app.decode_pool.size else 0
+        if len(handled) + dropped >= expected: break
+        peak_threads[0] = max(peak_threads[0], threading.active_count())
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - t0
+    latencies = sorted(handled)
+    pick = lambda q: latencies[min(int(len(latencies) * q), len(latencies) - 1)] * 1000 if latencies else float("nan")
+    late = sum(1 for l in latencies if l > app.VOICE_STALE_S)
+    return len(latencies), len(latencies) / elapsed, pick(0.5), pick(0.95), pick(1.0), late, peak_threads[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--rooms", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=app.VOICE_DECODE_WORKERS or 2)
+    parser.add_argument("--utterances", type=int, default=4, help="commands per room")
+    parser.add_argument("--gap", type=float, default=0.5, help="seconds between a room's commands")
+    parser.add_argument("--wav", help="16 kHz mono command recording (default: 1.5 s of silence)")
+    parser.add_argument("--model", default=app.VOSK_MODEL_PATH)
+    args = parser.parse_args()
+    app.CONFIG_PATH = tempfile.mkdtemp(prefix="smarthome-bench-")
+    app.log_command = lambda message, **fields: None
+    app.broadcast_update = lambda data: None
+    app.state_store.load({f"room_{r}": {"relay1": {"label": "Fan", "status": "OFF"}} for r in range(args.rooms)})
+    audio = load_audio(args.wav, 1.5)
+
+    app.voice_model = app.VoiceModel(args.model)
+    app.decode_pool = app.DecodePool(size=0)
+    app.voice_model.get()
+    pool = app.DecodePool(size=args.workers)
+    pool.start(args.model)
+
+    print(f"{len(audio) / 32000:.1f} s utterances, {args.utterances} per room, {args.gap:.1f} s apart; pool of {args.workers} workers, stale after {app.VOICE_STALE_S:g} s")
+    for rooms in sorted({1, 2, 4, args.rooms}):
+        for mode in ("threads", "pool"):
+            app.decode_pool = pool if mode == "pool" else app.DecodePool(size=0)
+            before = dict(pool.stats)
+            count, rate, p50, p95, worst, late, threads = run(rooms, args.utterances, args.gap, audio)
+            dropped = {k.split("_", 1)[1]: pool.stats[k] - before[k] for k in ("dropped_stale", "dropped_superseded", "dropped_full") if pool.stats[k] != before[k]}
+            print(f"{rooms} rooms {mode:7s}: {count:3d} acted on {rate:5.2f}/s  p50 {p50:7.0f} ms  p95 {p95:7.0f} ms  max {worst:7.0f} ms  "
+                  f"{late:2d} acted on after {app.VOICE_STALE_S:g} s  peak threads {threads:3d}  dropped {dropped or '-'}")
+
+
+if __name__ == "__main__":
+    main()
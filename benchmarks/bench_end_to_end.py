@@ -0,0 +1,209 @@
+"""End-to-end hub benchmark against simulated room nodes and SSE dashboards (no network, no hardware).
+
+Scenarios:
+  control  POST /control for random relays; command-to-publish = request until the node receives it
+  status   relays switched at the node (wall switch); status-to-SSE = node publish until every dashboard has it
+  storm    back-to-back modes switching every relay in every room; command-to-publish per relay change
+  voice    a recorded utterance spoken by one node; end-of-speech-to-relay (needs --wav and --label)
+
+Results go to benchmarks/results/<commit>.json so runs can be compared across commits.
+
+Run from the repo root: python benchmarks/bench_end_to_end.py [--rooms N] [--dashboards M] [--compare REF]
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+import wave
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app
+from benchmarks import loadgen
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+def summarize(samples_ms, elapsed_s):
+    ordered = sorted(samples_ms)
+    if not ordered: return {"count": 0}
+    pick = lambda q: round(ordered[min(int(len(ordered) * q), len(ordered) - 1)], 3)
+    return {"count": len(ordered), "per_s": round(len(ordered) / elapsed_s, 1), "p50_ms": pick(0.5), "p95_ms": pick(0.95), "p99_ms": pick(0.99), "max_ms": round(ordered[-1], 3)}
+
+
+class StatusProbe:
+    """Matches status_update events seen by dashboards to the node echo that caused them."""
+    def __init__(self, nodes, dashboards):
+        self.nodes = {node.room: node for node in nodes}
+        self.expected = dashboards
+        self.lock = threading.Lock()
+        self.seen = {}
+        self.samples = []
+
+    def on_event(self, received, data):
+        if data.get("type") != "status_update": return
+        node = self.nodes.get(data["room"])
+        sent = node and node.echoed.get((data["relay"], data["status"]))
+        if sent is None or received < sent: return
+        with self.lock:
+            key = (data["room"], data["relay"], data["status"], sent)
+            self.seen[key] = self.seen.get(key, 0) + 1
+            if self.seen[key] == self.expected: self.samples.append((received - sent) * 1000)
+
+
+def control_scenario(nodes, commands, rate):
+    http = app.app.test_client()
+    with http.session_transaction() as session: session["logged_in"] = True
+    sent_at, samples = {}, []
+    def on_command(node, received, updates):
+        for relay, state in updates.items():
+            started = sent_at.pop((node.room, relay, state), None)
+            if started is not None: samples.append((received - started) * 1000)
+    for node in nodes: node.on_command = on_command
+    rng = random.Random(0)
+    t0 = time.perf_counter()
+    for i in range(commands):
+        node = rng.choice(nodes)
+        relay = rng.choice(list(node.relays))
+        state = "OFF" if app.device_states[node.room][relay]["status"] == "ON" else "ON"
+        sent_at[(node.room, relay, state)] = time.perf_counter()
+        http.post("/control", json={"room": node.room, "relay": relay, "action": state})
+        if rate: time.sleep(1 / rate)
+    loadgen.settle(lambda: not sent_at)
+    for node in nodes: node.on_command = None
+    return summarize(samples, time.perf_counter() - t0)
+
+
+def status_scenario(nodes, probe, changes, rate):
+    # Echoes of hub-sent commands are no-ops in the state store (the dashboards already heard the
+    # command), so this drives node-initiated changes instead.
+    probe.samples.clear()
+    rng = random.Random(1)
+    t0 = time.perf_counter()
+    for i in range(changes):
+        node = rng.choice(nodes)
+        relay = rng.choice(list(node.relays))
+        node.relays[relay] = "OFF" if node.relays[relay] == "ON" else "ON"
+        node.echo_status(relay, node.relays[relay])
+        if rate: time.sleep(1 / rate)
+    loadgen.settle(lambda: len(probe.samples) >= changes, timeout=5)
+    return summarize(probe.samples, time.perf_counter() - t0)
+
+
+def storm_scenario(nodes, modes):
+    sent_at, samples = {}, []
+    lock = threading.Lock()
+    def on_command(node, received, updates):
+        with lock:
+            for relay, state in updates.items():
+                started = sent_at.pop((node.room, relay, state), None)
+                if started is not None: samples.append((received - started) * 1000)
+    for node in nodes: node.on_command = on_command
+    t0 = time.perf_counter()
+    for m in range(modes):
+        state = "ON" if m % 2 == 0 else "OFF"
+        actions = {node.room: {relay: state for relay in node.relays} for node in nodes}
+        started = time.perf_counter()
+        with lock:
+            for room, relays in actions.items():
+                for relay in relays:
+                    # A newer mode supersedes the pending change for the same relay; time from its first request.
+                    sent_at.setdefault((room, relay, state), started)
+        app.execute_mode(f"storm_{m}", {"actions": actions})
+    loadgen.settle(lambda: all(node.relays == {r: state for r in node.relays} for node in nodes), timeout=60)
+    elapsed = time.perf_counter() - t0
+    for node in nodes: node.on_command = None
+    return summarize(samples, elapsed)
+
+
+def voice_scenario(nodes, wav_path, label, runs, codec=None):
+    with wave.open(wav_path, "rb") as w:
+        if w.getframerate() != app.SAMPLE_RATE or w.getnchannels() != 1 or w.getsampwidth() != 2:
+            sys.exit("expected a 16 kHz mono 16-bit WAV")
+        pcm = w.readframes(w.getnframes())
+    node = nodes[0]
+    app.device_states[node.room]["relay1"]["label"] = label
+    app.bump_config_version()
+    app.voice_model.get()
+    app.get_voice_grammar()
+    samples, t0 = [], time.perf_counter()
+    for _ in range(runs):
+        app.device_states[node.room]["relay1"]["status"] = "OFF"
+        node.relays["relay1"] = "OFF"
+        received = []
+        node.on_command = lambda n, at, updates: received.append(at) if updates.get("relay1") == "ON" else None
+        speech_end = node.speak(pcm, codec=codec)
+        if loadgen.settle(lambda: received, timeout=10): samples.append((received[0] - speech_end) * 1000)
+    node.on_command = None
+    return summarize(samples, time.perf_counter() - t0)
+
+
+def commit_id():
+    try:
+        sha = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "diff", "--quiet", "HEAD", "--", "app.py"]).returncode != 0
+        return f"{sha}-dirty" if dirty else sha
+    except (OSError, subprocess.CalledProcessError): return "unknown"
+
+
+def compare(results, ref):
+    path = os.path.join(RESULTS_DIR, f"{ref}.json")
+    if not os.path.exists(path): sys.exit(f"no stored results for {ref} in {RESULTS_DIR}")
+    with open(path, encoding="utf-8") as f: baseline = json.load(f)
+    print(f"\nvs {ref}:")
+    for scenario, stats in results["scenarios"].items():
+        old = baseline["scenarios"].get(scenario, {})
+        for key in ("p50_ms", "p99_ms", "per_s"):
+            if key in stats and old.get(key):
+                print(f"  {scenario:8s} {key:7s} {old[key]:10.2f} -> {stats[key]:10.2f} ({(stats[key] / old[key] - 1) * 100:+.0f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--rooms", type=int, default=8)
+    parser.add_argument("--relays", type=int, default=8)
+    parser.add_argument("--dashboards", type=int, default=10)
+    parser.add_argument("--commands", type=int, default=300)
+    parser.add_argument("--rate", type=float, default=100, help="control requests per second (0 = unpaced)")
+    parser.add_argument("--modes", type=int, default=20)
+    parser.add_argument("--wav", help="16 kHz mono command recording for the voice scenario, starting with the wake word (jarvis)")
+    parser.add_argument("--label", help="relay label the recording names, e.g. Fan")
+    parser.add_argument("--voice-runs", type=int, default=5)
+    parser.add_argument("--codec", choices=sorted(app.AUDIO_CODECS), help="send voice as sequenced packets in this format (default: raw PCM chunks)")
+    parser.add_argument("--compare", metavar="REF", help="stored results to compare against")
+    parser.add_argument("--no-save", action="store_true")
+    args = parser.parse_args()
+
+    broker, nodes = loadgen.start_hub(args.rooms, args.relays)
+    loadgen.settle(lambda: len(app.node_features) == args.rooms)
+    probe = StatusProbe(nodes, args.dashboards)
+    dashboards = [loadgen.Dashboard(probe.on_event) for _ in range(args.dashboards)]
+    for dashboard in dashboards: dashboard.connected.wait()
+    time.sleep(0.2)
+
+    scenarios = {}
+    scenarios["control"] = control_scenario(nodes, args.commands, args.rate)
+    scenarios["status"] = status_scenario(nodes, probe, args.commands, args.rate)
+    scenarios["storm"] = storm_scenario(nodes, args.modes)
+    if args.wav and args.label: scenarios["voice"] = voice_scenario(nodes, args.wav, args.label, args.voice_runs, args.codec)
+    else: print("voice: skipped (pass --wav and --label)")
+
+    for name, stats in scenarios.items():
+        if not stats.get("count"): print(f"{name:8s}: no samples"); continue
+        print(f"{name:8s}: n={stats['count']:5d} {stats['per_s']:8.1f}/s  p50 {stats['p50_ms']:8.2f} ms  p95 {stats['p95_ms']:8.2f} ms  p99 {stats['p99_ms']:8.2f} ms  max {stats['max_ms']:8.2f} ms")
+
+    results = {"commit": commit_id(), "recorded_at": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+               "params": {k: v for k, v in vars(args).items() if k not in ("compare", "no_save")}, "scenarios": scenarios}
+    if not args.no_save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        with open(os.path.join(RESULTS_DIR, f"{results['commit']}.json"), "w", encoding="utf-8") as f: json.dump(results, f, indent=2)
+        print(f"saved to benchmarks/results/{results['commit']}.json")
+    if args.compare: compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
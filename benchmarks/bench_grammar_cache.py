@@ -0,0 +1,60 @@
+"""Voice setup cost per utterance: legacy grammar rebuild vs. cached grammar + recognizer pool.
+
+Run from the repo root: python benchmarks/bench_grammar_cache.py [rooms] [modes] [iterations]
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app
+
+
+def legacy_setup():
+    current_modes = app.load_config("modes.json")
+    vocabulary = set(app.BASE_VOCABULARY)
+    vocabulary.update(app.VOICE_COMMAND_STOP_WORDS)
+    vocabulary.update(m.lower() for m in current_modes)
+    for r_id, devices in app.device_states.items():
+        vocabulary.update(r_id.lower().replace("_", " ").split())
+        for dev_data in devices.values():
+            if isinstance(dev_data, dict) and "label" in dev_data:
+                vocabulary.update(dev_data["label"].lower().split())
+    return app.KaldiRecognizer(app.voice_model.model, app.SAMPLE_RATE, json.dumps(list(vocabulary)))
+
+
+def cached_setup():
+    grammar, _ = app.get_voice_grammar()
+    rec = app.recognizer_pool.acquire(grammar)
+    app.recognizer_pool.release(grammar, rec)
+
+
+def timed(fn, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations): fn()
+    return (time.perf_counter() - start) / iterations * 1000
+
+
+def main(rooms=10, modes=20, iterations=50):
+    app.CONFIG_PATH = tempfile.mkdtemp(prefix="smarthome-bench-")
+    app.device_states.clear()
+    for r in range(rooms):
+        app.device_states[f"room_{r}"] = {"wake_word": "jarvis", **{f"relay{i}": {"label": app.PRESET_DEVICES[i - 1], "status": "OFF", "motion_control": False} for i in range(1, 9)}}
+    app.save_config({f"mode {m}": {"start_time": None, "days": [], "audio_id": None, "actions": {}} for m in range(modes)}, "modes.json")
+    app.bump_config_version()
+    app.decode_pool.size = 0    # recognizers are built in this process, so the model has to live here too
+    app.voice_model.get()
+    cached_setup()
+    time.sleep(0.5)  # let the pool warm-up thread finish
+
+    legacy_ms = timed(legacy_setup, iterations)
+    cached_ms = timed(cached_setup, iterations)
+    print(f"rooms={rooms} modes={modes} iterations={iterations}")
+    print(f"legacy setup : {legacy_ms:8.3f} ms/utterance")
+    print(f"cached setup : {cached_ms:8.3f} ms/utterance ({legacy_ms / max(cached_ms, 1e-9):.0f}x faster)")
+
+
+if __name__ == "__main__":
+    main(*(int(a) for a in sys.argv[1:]))
@@ -0,0 +1,134 @@
+"""A year of relay and motion history: bytes on disk per event and /history latency, rollups vs. raw decoding.
+
+Synthetic data for the year up to now: every relay switches a few times a day (longer ON spells in
+the evening) and every room sees bursts of motion while people are up. Events go through a
+HistoryStore on a simulated clock, flushed every --flush seconds as the hub's thread would. Raw
+records are kept for the whole year here so each query can also be answered the slow way:
+decoding the raw records for the range, which is what a store without rollups would have to do.
+
+Run from the repo root: python benchmarks/bench_history.py [--rooms 10] [--relays 8] [--days 365]
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app
+
+
+def day_events(rng, day_start, rooms, relays):
+    # (ts, kind, room, relay, status) for one day, in time order.
+    events = []
+    for r in range(rooms):
+        room = f"room_{r}"
+        for i in range(1, relays + 1):
+            for _ in range(rng.poisson(4)):
+                on = day_start + rng.uniform(6, 23) * 3600
+                events.append((on, 0, room, f"relay{i}", "ON"))
+                events.append((min(on + rng.exponential(3600), day_start + 86399), 0, room, f"relay{i}", "OFF"))
+        for _ in range(rng.poisson(25)):
+            burst = day_start + rng.uniform(7, 23.5) * 3600
+            events.extend((burst + k * rng.uniform(5, 60), 1, room, None, None) for k in range(rng.integers(1, 12)))
+    events.sort(key=lambda e: e[0])
+    return events
+
+
+def ingest(store, sim, rooms, relays, days, flush_s, seed):
+    rng = np.random.default_rng(seed)
+    end = time.time()
+    start = app.local_day_start(end - days * 86400)
+    next_flush, count = start + flush_s, 0
+    t0 = time.perf_counter()
+    for d in range(days + 1):
+        for ts, kind, room, relay, status in day_events(rng, app.local_day_start(start + d * 86400 + 43200), rooms, relays):
+            if ts >= end: break
+            while ts >= next_flush:
+                sim[0] = next_flush
+                store.flush()
+                next_flush += flush_s
+            sim[0] = ts
+            if kind: store.record_motion(room, ts=ts)
+            else: store.record_status(room, relay, status, ts=ts)
+            count += 1
+    sim[0] = end
+    store.flush()
+    return count, time.perf_counter() - t0, start, end
+
+
+def raw_answer(store, series, since, until, group=None):
+    # Without rollups: decode every raw record in the range, then count and pair up ON/OFF transitions.
+    rows = store._read_raw(since, until)
+    rows = rows[np.isin(rows["series"], np.fromiter(series.values(), dtype=np.uint16))]
+    result = {}
+    for name, sid in series.items():
+        mine = rows[rows["series"] == sid]
+        ts = mine["ts"] + mine["ms"] / 1000
+        on = float(np.sum(np.diff(ts)[mine["value"][:-1] == 1])) if not name.endswith("/motion") else 0.0
+        entry = result[name] = {"events": len(mine), "on_seconds": round(on)}
+        if group == "hour_of_day": entry[group] = np.bincount((ts.astype(np.int64) // 3600) % 24, minlength=24).tolist()
+    return result
+
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        samples.append((time.perf_counter() - t0) * 1000)
+    return statistics.median(samples), result
+
+
+def directory_bytes(path, prefix):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path) if name.startswith(prefix))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--relays", type=int, default=8)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--flush", type=float, default=app.HISTORY_FLUSH_S, help="simulated seconds between batched writes")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    app.CONFIG_PATH = tempfile.mkdtemp(prefix="smarthome-bench-")
+    app.log_command = lambda message, **fields: None
+
+    sim = [time.time() - (args.days + 1) * 86400]
+    store = app.history = app.HistoryStore(clock=lambda: sim[0], raw_days=args.days + 30)
+    store.start()
+    count, elapsed, start, end = ingest(store, sim, args.rooms, args.relays, args.days, args.flush, seed=0)
+    path = store._path()
+    sizes = {kind: directory_bytes(path, kind) for kind in ("raw", "hourly", "daily")}
+    print(f"{count} events over {args.days} days ({args.rooms} rooms x {args.relays} relays + motion), ingested in {elapsed:.1f} s "
+          f"({elapsed / count * 1e6:.1f} us/event); {store.stats['flushes']} raw writes, {store.stats['raw_bytes'] / max(store.stats['flushes'], 1):.0f} B each on average")
+    for kind, size in sizes.items():
+        print(f"  {kind:6s} {size / 1e6:8.2f} MB  {size / count:6.2f} B/event")
+    kept = sizes["hourly"] + sizes["daily"] + count * app.HISTORY_RAW.itemsize * min(app.HISTORY_RAW_DAYS, args.days) / args.days
+    print(f"  on disk with the shipped retention ({app.HISTORY_RAW_DAYS} days raw): ~{kept / 1e6:.2f} MB, {kept / count:.2f} B/event")
+
+    client = app.app.test_client()
+    with client.session_transaction() as session: session["logged_in"] = True
+    week, year = end - 7 * 86400, start
+    queries = [
+        ("AC on this week", f"room=room_0&relay=relay1&since={week}&until={end}", ("room_0", "relay1", week, None)),
+        ("relay daily on-time, year", f"room=room_0&relay=relay1&since={year}&until={end}&resolution=day", ("room_0", "relay1", year, None)),
+        ("hall motion by hour of day, year", f"room=room_1&relay=motion&since={year}&until={end}&resolution=hour&group=hour_of_day", ("room_1", "motion", year, "hour_of_day")),
+        ("whole house daily, year", f"since={year}&until={end}&resolution=day", (None, None, year, None)),
+    ]
+    print(f"/history latency, median of {args.repeat}:")
+    for name, query, (room, relay, since, group) in queries:
+        api_ms, response = timed(lambda: client.get(f"/history?{query}"), args.repeat)
+        series = store.match_series(room, relay)
+        raw_ms, raw = timed(lambda: raw_answer(store, series, since, end, group), args.repeat)
+        body = response.get_json()["series"]
+        agree = all(abs(body[n]["events"] - raw[n]["events"]) <= 1 and abs(body[n]["on_seconds"] - raw[n]["on_seconds"]) <= max(3600, raw[n]["on_seconds"] * 0.01) for n in series)
+        print(f"  {name:34s} rollups {api_ms:8.2f} ms ({len(response.data) / 1000:6.1f} kB)   raw decode {raw_ms:8.2f} ms   totals agree: {agree}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""Cost of the stage instrumentation: per-call overhead of metrics.time()/inc(), enabled vs. disabled,
+and what it adds to the hottest instrumented path (one MQTT audio chunk through handle_audio_message).
+
+Run from the repo root: python benchmarks/bench_metrics_overhead.py [calls]
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app
+from benchmarks.bench_vad_pipeline import CHUNK_BYTES, synthetic_audio
+
+
+def per_call_ns(fn, calls):
+    t0 = time.perf_counter()
+    for _ in range(calls): fn()
+    return (time.perf_counter() - t0) / calls * 1e9
+
+
+def timed_block():
+    with app.metrics.time("bench_stage_seconds", room="bench_room", source="esp32"): pass
+
+
+def main(calls=200000):
+    calls = int(calls)
+    app.CONFIG_PATH = tempfile.mkdtemp(prefix="smarthome-bench-")
+    app.log_command = lambda message, **fields: None
+    app.process_voice_command = lambda *args, **kwargs: None
+    app.decode_pool = app.DecodePool(size=0)
+    audio = synthetic_audio(20, 0)
+    topic = f"{app.MQTT_VOICE_AUDIO_TOPIC}bench_room"
+
+    for enabled in (False, True):
+        app.metrics.enabled = enabled
+        app.vad_processors["bench_room"] = app.VadAudio("bench_room", streaming=False)
+        t0 = time.process_time()
+        for offset in range(0, len(audio), CHUNK_BYTES): app.handle_audio_message(topic, audio[offset:offset + CHUNK_BYTES])
+        cpu = time.process_time() - t0
+        print(f"metrics {'on ' if enabled else 'off'}: time() {per_call_ns(timed_block, calls):6.0f} ns/call, "
+              f"inc() {per_call_ns(lambda: app.metrics.inc('bench_total', room='bench_room'), calls):6.0f} ns/call, "
+              f"audio path {cpu / 20 * 1000:.3f} ms CPU per room-second")
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
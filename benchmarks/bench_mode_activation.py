@@ -0,0 +1,84 @@
+"""Mode activation time against fake room nodes: publish+sleep per relay vs. the paced CommandDispatcher.
+
+Each fake node handles its home/control messages one at a time with a fixed per-message
+cost (relay click, NVS write, status echo), like roomnode-esp32.ino does.
+
+Run from the repo root: python benchmarks/bench_mode_activation.py [rooms] [relays]
+"""
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app
+
+NODE_MESSAGE_COST_S = 0.01
+
+
+class FakeNode:
+    def __init__(self, room):
+        self.room = room
+        self.inbox = queue.Queue()
+        self.applied = {}
+        self.last_applied_at = None
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while True:
+            payload = self.inbox.get()
+            time.sleep(NODE_MESSAGE_COST_S)
+            room, relay, state = payload.split(":", 2)
+            if relay == "BATCH": updates = dict(item.split("=") for item in state.split(","))
+            else: updates = {relay: state}
+            self.applied.update(updates)
+            self.last_applied_at = time.perf_counter()
+
+
+class FakeBroker:
+    def __init__(self, nodes): self.nodes = nodes
+    def publish(self, topic, payload=None, *args, **kwargs):
+        room = payload.split(":", 1)[0]
+        if room in self.nodes: self.nodes[room].inbox.put(payload)
+
+
+def legacy_activation(broker, actions):
+    # execute_mode before batching: one publish per relay, 0.1 s sleep in the caller between them.
+    for room, relays in actions.items():
+        for relay, state in relays.items():
+            broker.publish(app.MQTT_PUB_TOPIC, f"{room}:{relay}:{state}")
+            time.sleep(0.1)
+
+
+def dispatcher_activation(dispatcher, actions):
+    for room, relays in actions.items(): dispatcher.send_relays(room, relays)
+
+
+def measure(label, activate, nodes, expected):
+    start = time.perf_counter()
+    activate()
+    caller_s = time.perf_counter() - start
+    while any(node.applied != expected[room] for room, node in nodes.items()): time.sleep(0.005)
+    done_s = max(node.last_applied_at for node in nodes.values()) - start
+    print(f"{label:24s}: caller blocked {caller_s * 1000:7.1f} ms, all relays applied after {done_s * 1000:7.1f} ms")
+
+
+def main(rooms=6, relays=8):
+    rooms, relays = int(rooms), int(relays)
+    app.CONFIG_PATH = tempfile.mkdtemp(prefix="smarthome-bench-")
+    actions = {f"room_{r}": {f"relay{i}": "ON" for i in range(1, relays + 1)} for r in range(rooms)}
+    print(f"mode with {rooms} rooms x {relays} relays, node cost {NODE_MESSAGE_COST_S * 1000:.0f} ms/message")
+    for label, make in (("legacy publish+sleep", None), ("dispatcher, old firmware", False), ("dispatcher, batch nodes", True)):
+        nodes = {room: FakeNode(room) for room in actions}
+        broker = FakeBroker(nodes)
+        if make is None:
+            measure(label, lambda: legacy_activation(broker, actions), nodes, actions)
+        else:
+            dispatcher = app.CommandDispatcher(publish=broker.publish, supports_batch=lambda room, batch=make: batch)
+            measure(label, lambda: dispatcher_activation(dispatcher, actions), nodes, actions)
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
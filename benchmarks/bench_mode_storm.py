@@ -0,0 +1,116 @@
+"""Overlapping mode storms: the old inline execute_mode vs. the ModeExecutor.
+
+Several callers (think scheduler, voice and dashboard) trigger random modes back to back, some with
+a song. A mode only supersedes runs still in flight in its own rooms, so songs of modes elsewhere play. Reported per engine: how long callers are blocked, messages and songs that reach the
+nodes, how ModeRuns ended, and whether the final hub state and every node match a sequential
+replay of the triggers in the order they were made. Exits non-zero if the executor's do not.
+
+Run from the repo root: python benchmarks/bench_mode_storm.py [--rooms 8] [--callers 3] [--triggers 60]
+"""
+import argparse
+import copy
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app
+from benchmarks import loadgen
+
+
+def legacy_execute_mode(mode_name, mode_data, turn_off_mode=False, on_publish=None, origin="mode"):
+    # execute_mode as it was before the executor: applied and queued on the caller's thread.
+    actions = mode_data.get("actions", {})
+    updates = {room: {relay: {"status": "OFF" if turn_off_mode else state} for relay, state in relays.items()} for room, relays in actions.items()}
+    device_switched = bool(app.state_store.apply(updates, origin, on_sent=on_publish))
+    if not turn_off_mode and mode_data.get("audio_id"):
+        first_room = next(iter(actions), None)
+        if first_room: app.command_dispatcher.send_raw(first_room, f"{first_room}:AUDIO:{mode_data['audio_id']}", delay=3.5 if device_switched else 0, on_sent=on_publish)
+    app.broadcast_update({"type": "voice_feedback", "text": f"Okay, switching to {mode_name} mode"})
+
+
+def make_modes(nodes, count, rooms_per_mode, rng):
+    modes = {}
+    for m in range(count):
+        rooms = rng.sample(nodes, max(1, min(len(nodes), rooms_per_mode)))
+        actions = {node.room: {relay: rng.choice(("ON", "OFF")) for relay in rng.sample(list(node.relays), 4)} for node in rooms}
+        modes[f"mode_{m}"] = {"actions": actions, "audio_id": str(m + 1) if m % 3 == 0 else None}
+    return modes
+
+
+def replay(initial, triggers):
+    states = copy.deepcopy(initial)
+    for mode_data, turn_off in triggers:
+        for room, relays in mode_data["actions"].items():
+            for relay, state in relays.items(): states[room][relay]["status"] = "OFF" if turn_off else state
+    return {room: {relay: value["status"] for relay, value in data.items() if isinstance(value, dict)} for room, data in states.items()}
+
+
+def run(engine, nodes, modes, callers, triggers, gap_s, seed):
+    for node in nodes:
+        node.received.clear()
+        for relay in node.relays: node.relays[relay] = "OFF"
+    app.state_store.load({node.room: {"wake_word": "jarvis", **{relay: {"label": f"Light {relay}", "status": "OFF", "motion_control": False} for relay in node.relays}} for node in nodes})
+    initial = copy.deepcopy(app.device_states)
+    app.mode_executor = app.ModeExecutor()
+    order, order_lock, blocked, runs = [], threading.Lock(), [], []
+
+    def caller(c):
+        rng = random.Random(seed + c)
+        for _ in range(triggers // callers):
+            name = rng.choice(list(modes))
+            turn_off = rng.random() < 0.2
+            with order_lock:
+                t0 = time.perf_counter()
+                if engine == "executor": runs.append(app.execute_mode(name, modes[name], turn_off_mode=turn_off))
+                else: legacy_execute_mode(name, modes[name], turn_off_mode=turn_off)
+                blocked.append((time.perf_counter() - t0) * 1000)
+                order.append((modes[name], turn_off))
+            time.sleep(rng.uniform(0, gap_s))
+
+    threads = [threading.Thread(target=caller, args=(c,)) for c in range(callers)]
+    t0 = time.perf_counter()
+    for t in threads: t.start()
+    for t in threads: t.join()
+    loadgen.settle(lambda: app.command_dispatcher.idle() and all(r.finished.is_set() for r in runs), timeout=30)
+    time.sleep(app.MODE_AUDIO_DELAY_S + 0.5)     # songs still waiting out the relay confirmation sounds
+    elapsed = time.perf_counter() - t0
+
+    expected = replay(initial, order)
+    actual = {room: {relay: value["status"] for relay, value in data.items() if isinstance(value, dict)} for room, data in app.device_states.items()}
+    hub_ok, nodes_ok = actual == expected, all(node.relays == actual[node.room] for node in nodes)
+    messages = [payload for node in nodes for _, payload in node.received]
+    audio = sum(1 for payload in messages if b":AUDIO:" in payload)
+    blocked.sort()
+    outcomes = {}
+    for r in runs: outcomes[r.state] = outcomes.get(r.state, 0) + 1
+    run_ms = sorted(r.elapsed() * 1000 for r in runs if r.state == "done")
+    run_text = f", done runs p50 {run_ms[len(run_ms) // 2]:.0f} ms p95 {run_ms[int(len(run_ms) * 0.95)]:.0f} ms" if run_ms else ""
+    print(f"{engine:8s}: {len(order)} triggers in {elapsed:5.2f} s; caller blocked p50 {blocked[len(blocked) // 2]:.2f} ms max {blocked[-1]:.2f} ms; "
+          f"{len(messages)} node messages, {audio} songs; hub state matches trigger order: {hub_ok}, "
+          f"nodes match hub: {nodes_ok}; runs {outcomes or '-'}{run_text}")
+    return hub_ok and nodes_ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--rooms", type=int, default=8)
+    parser.add_argument("--modes", type=int, default=12)
+    parser.add_argument("--rooms-per-mode", type=int, default=2, help="modes in different rooms do not supersede each other")
+    parser.add_argument("--callers", type=int, default=3)
+    parser.add_argument("--triggers", type=int, default=60)
+    parser.add_argument("--gap", type=float, default=0.05, help="max seconds between one caller's triggers")
+    args = parser.parse_args()
+    broker, nodes = loadgen.start_hub(args.rooms)
+    loadgen.settle(lambda: len(app.node_features) == args.rooms)
+    app.log_command = lambda message, **fields: None
+    modes = make_modes(nodes, args.modes, args.rooms_per_mode, random.Random(0))
+    results = {engine: run(engine, nodes, modes, args.callers, args.triggers, args.gap, seed=1) for engine in ("legacy", "executor")}
+    # The legacy path is only a baseline (under load its node echoes can land out of order); the executor has to be exact.
+    if not results["executor"]: sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""Motion timeout handling for many rooms: legacy 1 s polling scan vs. MotionTimerService.
+
+Uses a fake clock so expiries are deterministic: every room gets PIR triggers for a while,
+then goes quiet (some see motion once more later), and each relay must switch off exactly at its
+own timeout: per-relay overrides, room timeouts and the default. Then the real turn-off is run
+against a touch and a manual switch landing between expiry and on_expire. Exits non-zero on any
+mismatch.
+
+Run from the repo root: python benchmarks/bench_motion_timers.py [rooms] [seconds]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app
+
+
+class FakeClock:
+    def __init__(self): self.now = 0.0
+    def __call__(self): return self.now
+
+
+def build_rooms(count):
+    rng = random.Random(3)
+    app.device_states.clear()
+    for r in range(count):
+        room = {"wake_word": "jarvis", "motion_timeout": rng.choice([None, 30, 60])}
+        for i in range(1, 9):
+            room[f"relay{i}"] = {"label": f"Device {i}", "status": "ON", "motion_control": i <= 3, "motion_timeout": 10 if i == 1 else None}
+        app.device_states[f"room_{r}"] = room
+
+
+def legacy_polling(rooms, seconds):
+    # The old loop on the same workload: every second walk last_motion_time and the relays of expired rooms.
+    last_motion_time = {}
+    timeout = app.MOTION_TIMEOUT.total_seconds()
+    t0 = time.process_time()
+    for second in range(seconds):
+        if second < 60:
+            for r in range(rooms):
+                if (second + r) % 2 == 0: last_motion_time[f"room_{r}"] = second
+        for room_id, last_seen in list(last_motion_time.items()):
+            if second - last_seen > timeout:
+                for relay, data in app.device_states[room_id].items():
+                    if relay.startswith("relay") and data.get("motion_control") and data.get("status") == "ON": pass
+                del last_motion_time[room_id]
+    return time.process_time() - t0
+
+
+def races():
+    # The turn-off against what can happen between a deadline expiring and on_expire running; True if each case holds.
+    app.command_dispatcher = app.CommandDispatcher(interval=0, publish=lambda topic, payload: None)
+    clock = FakeClock()
+    timers = app.MotionTimerService(clock=clock)
+    room, relay = "room_0", "relay1"
+    def expire(between=None):
+        app.state_store.update(room, relay, "user", status="ON")
+        clock.now += 1000
+        timers.touch(room)
+        clock.now += app.motion_timeout_for(room, relay)
+        with timers.cond: expired = timers.pop_expired(clock.now)
+        if between: between()
+        for room_id, relays in expired.items(): app.turn_off_motion_relays(room_id, {r: v for r, v in relays.items() if r == relay}, timers)
+        return app.device_states[room][relay]["status"]
+    def manual_on():
+        app.state_store.update(room, relay, "user", status="OFF")
+        app.state_store.update(room, relay, "user", status="ON")
+    results = {"no interference turns it off": expire() == "OFF",
+               "motion re-arms it in between, stays on": expire(lambda: timers.touch(room)) == "ON",
+               "manual OFF then ON in between, stays on": expire(manual_on) == "ON"}
+    for name, ok in results.items(): print(f"  {name:42s} {'ok' if ok else 'FAILED'}")
+    return all(results.values())
+
+
+def main(rooms=500, seconds=300):
+    rooms, seconds = int(rooms), int(seconds)
+    app.CONFIG_PATH = tempfile.mkdtemp(prefix="smarthome-bench-")
+    app.log_command = lambda message, **fields: None
+    build_rooms(rooms)
+    clock = FakeClock()
+    expired_at = {}
+    timers = app.MotionTimerService(clock=clock, on_expire=lambda room, relays, timers: expired_at.setdefault(room, []).extend((relay, clock.now) for relay in relays))
+
+    t0 = time.process_time()
+    wakeups, touches, last_touch = 0, 0, {}
+    for second in range(seconds):
+        clock.now = float(second)
+        for r in range(rooms):
+            # PIR fires every 2 s for a minute; every fourth room sees motion once more at 66 s, re-arming its relays.
+            if (second < 60 and (second + r) % 2 == 0) or (second == 66 and r % 4 == 0):
+                timers.touch(f"room_{r}")
+                last_touch[f"room_{r}"] = second
+                touches += 1
+        if timers.heap and timers.heap[0][0] <= clock.now:
+            wakeups += 1
+            timers.run_due()
+    heap_cpu = time.process_time() - t0
+
+    # Each motion relay expires exactly once, within the second after last touch + its own timeout.
+    wrong, overrides, rearmed, seen = 0, 0, 0, set()
+    for room, hits in expired_at.items():
+        for relay, at in hits:
+            expected = last_touch[room] + app.motion_timeout_for(room, relay)
+            ok = expected <= at < expected + 1 and (room, relay) not in seen
+            seen.add((room, relay))
+            wrong += not ok
+            overrides += ok and app.device_states[room][relay].get("motion_timeout") is not None
+            rearmed += ok and last_touch[room] == 66
+    wanted = {(room, relay) for room, data in app.device_states.items() for relay, value in data.items()
+              if isinstance(value, dict) and value.get("motion_control") and last_touch.get(room, -1) + app.motion_timeout_for(room, relay) < seconds}
+    missing = len(wanted - seen)
+    print(f"rooms={rooms} simulated={seconds}s")
+    print(f"legacy polling : {seconds} wakeups, {legacy_polling(rooms, seconds) * 1000:.1f} ms CPU, one global {app.MOTION_TIMEOUT.total_seconds():g}s timeout")
+    print(f"timer service  : {wakeups} wakeups, {heap_cpu * 1000:.1f} ms CPU incl. {touches} touches, "
+          f"{len(seen)} relays expired, {wrong} at the wrong time or twice, {missing} never; "
+          f"{overrides} on their per-relay timeout, {rearmed} after re-arming")
+    print("turn-off races:")
+    races_ok = races()
+    if wrong or missing or not overrides or not rearmed or not races_ok: sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
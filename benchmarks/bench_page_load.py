@@ -0,0 +1,138 @@
+"""Dashboard page loads: the server-rendered page vs. a shell hydrated from /api/state.
+
+  rendered  index.html with every room and relay in the HTML (the page as it was before /api/state),
+            rendered again on every load
+  hydrated  a static shell; script.js fetches /api/state (gzip, ETag) and keeps it current from SSE
+
+The old template and script are read from git history. For each house size: bytes and hub time for
+a cold load (nothing cached), a reload with nothing changed (static files and /api/state revalidate
+to 304s) and a reload after --changes relay flips. Load time is modelled on a phone hotspot as
+request round trips plus transfer at --kbps; "hub" is the server time of the requests. Bytes are
+bodies plus response headers; request headers are left out for both.
+
+Run from the repo root: python benchmarks/bench_page_load.py [--rooms 10 30 60] [--kbps 2000] [--rtt 80]
+"""
+import argparse
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LEGACY = {"templates/index.html": "device_states.items()", "static/script.js": "document.querySelectorAll('.relay-toggle')"}
+
+
+def legacy_file(path, needle, ref=None):
+    # The newest committed version of `path` that still has `needle`: HEAD's, or the one before the commit that dropped it.
+    git = lambda *args: subprocess.run(["git", *args], cwd=ROOT, capture_output=True, text=True, check=True).stdout
+    if ref: return git("show", f"{ref}:{path}")
+    text = git("show", f"HEAD:{path}")
+    if needle in text: return text
+    commit = git("log", "-1", "--format=%H", f"-S{needle}", "--", path).strip()
+    if not commit: sys.exit(f"{path}: no commit with {needle!r} in history")
+    return git("show", f"{commit}^:{path}")
+
+
+def header_bytes(response):
+    return len(f"HTTP/1.1 {response.status}\r\n") + sum(len(k) + len(v) + 4 for k, v in response.headers.items()) + 2
+
+
+def fetch(client, url, repeat, headers=None):
+    # (response, bytes on the wire, median hub ms)
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        response = client.get(url, headers=headers or {})
+        samples.append((time.perf_counter() - t0) * 1000)
+    return response, len(response.data) + header_bytes(response), statistics.median(samples)
+
+
+def static_file(client, name, body=None):
+    # (cold bytes, revalidated bytes); `body` stands in for a file that is no longer in the tree.
+    response = client.get(f"/static/{name}")
+    size = header_bytes(response) + (len(body.encode("utf-8")) if body is not None else len(response.data))
+    revalidated = client.get(f"/static/{name}", headers={"If-None-Match": response.headers["ETag"]})
+    return size, header_bytes(revalidated)
+
+
+def modelled_ms(stages, kbps, rtt):
+    # stages: bytes per sequential round trip (requests within a stage run in parallel and share the link).
+    return sum(rtt + size * 8 / kbps for size in stages)
+
+
+def make_house(rooms, relays, rng):
+    states = {f"room_{r}": {"wake_word": "jarvis", **{f"relay{i}": {"label": rng.choice(("Light", "Fan", "AC", "Lamp", "Heater", "TV")) + f" {i}",
+                                                                     "status": rng.choice(("ON", "OFF")), "motion_control": rng.random() < 0.2}
+                                                      for i in range(1, relays + 1)}} for r in range(rooms)}
+    app.device_room_map = {room: f"esp32_{r:08X}" for r, room in enumerate(states) if r % 3}
+    app.state_store.load(states)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--rooms", type=int, nargs="+", default=[10, 30, 60])
+    parser.add_argument("--relays", type=int, default=8)
+    parser.add_argument("--changes", type=int, default=20, help="relay flips between the two reloads")
+    parser.add_argument("--kbps", type=float, default=2000, help="modelled link speed in kbit/s")
+    parser.add_argument("--rtt", type=float, default=80, help="modelled round trip in ms")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--legacy-ref", help="git ref to take the old index.html and script.js from")
+    args = parser.parse_args()
+    app.CONFIG_PATH = tempfile.mkdtemp(prefix="smarthome-bench-")
+    app.log_command = lambda message, **fields: None
+
+    old_index, old_script = (legacy_file(path, needle, args.legacy_ref) for path, needle in LEGACY.items())
+    template = app.app.jinja_env.from_string(old_index)
+    # The old page through the same Flask stack as the new one: its route rendered this with the full state.
+    app.app.add_url_rule("/bench-rendered", "bench_rendered", app.login_required(
+        lambda: template.render(device_states=app.device_states, device_room_map=app.device_room_map, voice_state=app.voice_model.state)))
+    client = app.app.test_client()
+    with client.session_transaction() as session: session["logged_in"] = True
+    gzip = {"Accept-Encoding": "gzip"}
+
+    css, css_304 = static_file(client, "style.css")
+    new_js, js_304 = static_file(client, "script.js")
+    old_js, _ = static_file(client, "script.js", old_script)
+    print(f"static: style.css {css / 1000:.1f} kB, script.js {old_js / 1000:.1f} kB rendered / {new_js / 1000:.1f} kB hydrated, "
+          f"{css_304 + js_304} B to revalidate both; link {args.kbps:g} kbit/s, {args.rtt:g} ms RTT")
+    rng = random.Random(0)
+    for rooms in args.rooms:
+        make_house(rooms, args.relays, rng)
+        page, page_bytes, page_ms = fetch(client, "/bench-rendered", args.repeat)
+        shell, shell_bytes, shell_ms = fetch(client, "/", args.repeat)
+        state, state_bytes, state_ms = fetch(client, "/api/state", args.repeat, gzip)
+        etag = {**gzip, "If-None-Match": state.headers["ETag"]}
+        unchanged, unchanged_bytes, unchanged_ms = fetch(client, "/api/state", args.repeat, etag)
+        assert unchanged.status_code == 304
+        for room, relay in rng.sample([(room, f"relay{i}") for room in app.device_states for i in range(1, args.relays + 1)], args.changes):
+            app.state_store.update(room, relay, "node", status="ON" if app.device_states[room][relay]["status"] == "OFF" else "OFF")
+        changed, changed_bytes, changed_ms = fetch(client, "/api/state", args.repeat, etag)
+        _, after_page_bytes, after_page_ms = fetch(client, "/bench-rendered", args.repeat)
+
+        rows = {
+            "cold": ((page_bytes, page_ms, [page_bytes, css + old_js]),
+                     (shell_bytes + state_bytes, shell_ms + state_ms, [shell_bytes, css + new_js, state_bytes])),
+            "reload, unchanged": ((page_bytes, page_ms, [page_bytes, css_304 + js_304]),
+                                  (shell_bytes + unchanged_bytes, shell_ms + unchanged_ms, [shell_bytes, css_304 + js_304, unchanged_bytes])),
+            f"reload, {args.changes} flips": ((after_page_bytes, after_page_ms, [after_page_bytes, css_304 + js_304]),
+                                              (shell_bytes + changed_bytes, shell_ms + changed_ms, [shell_bytes, css_304 + js_304, changed_bytes])),
+        }
+        print(f"{rooms} rooms x {args.relays} relays: page {page_bytes / 1000:.1f} kB rendered, shell {shell_bytes / 1000:.1f} kB + "
+              f"/api/state {state_bytes / 1000:.1f} kB ({state.headers.get('Content-Encoding') or 'identity'})")
+        for name, results in rows.items():
+            cells = []
+            for label, (dynamic_bytes, hub_ms, stages) in zip(("rendered", "hydrated"), results):
+                total = sum(stages)
+                cells.append(f"{label} {total / 1000:6.1f} kB ({dynamic_bytes / 1000:5.1f} kB dynamic), hub {hub_ms:5.2f} ms, "
+                             f"~{modelled_ms(stages, args.kbps, args.rtt) + hub_ms:4.0f} ms on the link")
+            print(f"  {name:18s} " + "   ".join(cells))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Disk writes and fsyncs for device_states persistence: save-on-every-event vs. StateJournal.
+
+Simulates bursts of home/status echoes (e.g. a mode switching every relay) and counts the
+file writes, bytes and fsyncs each strategy issues, then checks snapshot + journal replay.
+
+Run from the repo root: python benchmarks/bench_persistence.py [rooms] [bursts] [burst_size]
+"""
+import builtins
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app
+
+counters = {"writes": 0, "fsyncs": 0, "bytes": 0}
+real_open, real_fsync = builtins.open, os.fsync
+
+
+def counting_open(path, mode="r", *args, **kwargs):
+    f = real_open(path, mode, *args, **kwargs)
+    if any(m in mode for m in "wa"):
+        counters["writes"] += 1
+        write = f.write
+        def counted_write(data):
+            counters["bytes"] += len(data)
+            return write(data)
+        f.write = counted_write
+    return f
+
+
+def counting_fsync(fd):
+    counters["fsyncs"] += 1
+    return real_fsync(fd)
+
+
+def legacy_save(data, filename):
+    with counting_open(os.path.join(app.CONFIG_PATH, filename), "w", encoding="utf-8") as f: json.dump(data, f, indent=4)
+
+
+def status_bursts(bursts, burst_size, persist):
+    rooms = list(app.device_states)
+    for b in range(bursts):
+        for i in range(burst_size):
+            room, relay = rooms[i % len(rooms)], f"relay{i % 8 + 1}"
+            status = "ON" if (b + i) % 2 else "OFF"
+            app.device_states[room][relay]["status"] = status
+            persist(room, relay, status)
+        time.sleep(0.3)
+
+
+def run(label, bursts, burst_size, persist, finish=lambda: None):
+    for k in counters: counters[k] = 0
+    start = time.perf_counter()
+    status_bursts(bursts, burst_size, persist)
+    finish()
+    elapsed = time.perf_counter() - start
+    print(f"{label:8s}: {counters['writes']:5d} file writes ({counters['writes'] / elapsed:7.1f}/s)  "
+          f"{counters['fsyncs']:4d} fsyncs  {counters['bytes'] / 1024:9.1f} KiB")
+
+
+def main(rooms=6, bursts=10, burst_size=50):
+    app.CONFIG_PATH = tempfile.mkdtemp(prefix="smarthome-bench-")
+    app.open, os.fsync = counting_open, counting_fsync
+    app.device_states.clear()
+    for r in range(int(rooms)):
+        app.device_states[f"room_{r}"] = {"wake_word": "jarvis", **{f"relay{i}": {"label": f"Device {i}", "status": "OFF", "motion_control": False} for i in range(1, 9)}}
+    app.save_config(app.device_states, app.STATE_FILE)
+
+    run("legacy", int(bursts), int(burst_size), lambda room, relay, status: legacy_save(app.device_states, app.STATE_FILE))
+
+    journal = app.StateJournal(debounce=0.1).start()
+    run("journal", int(bursts), int(burst_size), lambda room, relay, status: journal.record(room, relay, status=status), journal.flush)
+    print(f"journal stats: {journal.stats}")
+
+    replayed = app.StateJournal().replay()
+    print("replay matches in-memory state:", replayed == app.device_states)
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,127 @@
+"""Reconnect storm after a hub restart: every node re-announces at once.
+
+  legacy     what the hub did before config sync: nothing for an assigned node on discovery
+  full push  the obvious fix: the room's whole config plus every relay on every discovery
+  versioned  ConfigSync: silent for current nodes, deltas, retained snapshots, only drifted relays
+
+Before the restart a third of the nodes drop off the broker and miss relay commands; a few rooms
+also get a label edit. The hub then restarts (fresh process state, same config on disk, retained
+snapshots still on the broker), the missing nodes come back, and all of them announce together.
+Reported: messages and bytes the nodes receive, hub CPU spent in discovery and config sync, and
+how many nodes still disagree with the hub about their relays once things settle.
+
+Run from the repo root: python benchmarks/bench_reconnect_storm.py [--nodes 40] [--relays 8]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app
+from benchmarks import loadgen
+
+MODES = ("legacy", "full push", "versioned")
+
+
+def naive_discovered(device_id, room, info):
+    app.client.publish(f"{app.MQTT_CONFIG_TOPIC_PREFIX}{device_id}", json.dumps(app.device_states[room]))
+    app.command_dispatcher.send_relays(room, app.relay_states(room))
+
+
+def start_sync(mode):
+    app.config_sync = app.ConfigSync(debounce=0.05).start()
+    if mode != "versioned":
+        app.config_sync.publish_snapshot = lambda device_id, room: None
+        app.config_sync.discovered = naive_discovered if mode == "full push" else (lambda device_id, room, info: None)
+
+
+def connect_hub(broker):
+    app.client = broker.connect(app.on_message, "hub")
+    app.on_connect(app.client, None, None, 0)
+
+
+def inconsistent(nodes):
+    return [node for node in nodes if node.relays != {r: s for r, s in app.relay_states(node.room).items() if r in node.relays}]
+
+
+def run(mode, rooms, relays, offline_share):
+    app.CONFIG_PATH = tempfile.mkdtemp(prefix="smarthome-bench-")
+    broker, nodes = loadgen.LocalBroker(), []
+    states = {}
+    app.device_room_map = {}
+    for r in range(rooms):
+        room, device_id = f"room_{r}", f"esp32_{r:08X}"
+        states[room] = {"wake_word": "jarvis", **{f"relay{i}": {"label": f"Light {r}-{i}", "status": "OFF", "motion_control": False} for i in range(1, relays + 1)}}
+        app.device_room_map[room] = device_id
+        nodes.append(loadgen.SimulatedNode(broker, device_id, room, relays, message_cost_s=0, versioned=mode != "legacy"))
+    app.state_store.load(states)
+    start_sync(mode)
+    connect_hub(broker)
+    for node in nodes: node.announce()
+    loadgen.settle(lambda: mode == "legacy" or all(node.config_version for node in nodes))
+    time.sleep(0.3)
+
+    # A third of the nodes drop off and miss commands; some rooms get a label edited meanwhile.
+    offline = nodes[:int(rooms * offline_share)]
+    for node in offline: node.client.disconnect()
+    for i, node in enumerate(offline):
+        for relay in ("relay1", "relay2"): app.state_store.update(node.room, relay, "user", status="ON")
+        if i % 3 == 0: app.state_store.update(node.room, "relay3", "user", label=f"Lamp {i}")
+    time.sleep(0.5)
+
+    # Hub restart: in-memory sync state is gone, device_states comes back from disk, the broker keeps the retained snapshots.
+    app.client.disconnect()
+    app.node_features.clear()
+    start_sync(mode)
+    hub_cpu = [0.0]
+    handle_discovery, publish_snapshot = app.handle_discovery, app.config_sync.publish_snapshot
+    def timed(fn):
+        def wrapper(*args):
+            t0 = time.thread_time()
+            try: return fn(*args)
+            finally: hub_cpu[0] += time.thread_time() - t0
+        return wrapper
+    app.handle_discovery = timed(handle_discovery)
+    app.config_sync.publish_snapshot = timed(publish_snapshot)
+    connect_hub(broker)
+    time.sleep(0.3)
+
+    for node in nodes: node.config_messages, node.bytes_received, node.received_before = 0, 0, len(node.received)
+    published = broker.stats["published"]
+    t0 = time.perf_counter()
+    for node in offline: node.connect()
+    for node in nodes: node.announce()
+    loadgen.settle(lambda: app.config_sync.stats["discoveries"] >= rooms if mode == "versioned" else len(app.node_features) >= rooms)
+    settled = loadgen.settle(lambda: not inconsistent(nodes), timeout=5)
+    elapsed = time.perf_counter() - t0 if settled else float("nan")
+    time.sleep(0.3)
+    app.handle_discovery = handle_discovery
+
+    messages = sum(node.config_messages + len(node.received) - node.received_before for node in nodes)
+    sent_bytes = sum(node.bytes_received for node in nodes)
+    stale = len(inconsistent(nodes))
+    stats = app.config_sync.stats
+    detail = f"  ({stats['current']} current, {stats['deltas']} deltas, {stats['full']} full, {stats['relay_fixes']} relay fixes, {stats['snapshots']} snapshots)" if mode == "versioned" else ""
+    print(f"{mode:9s}: {messages:4d} msgs {sent_bytes:7d} B to nodes, {broker.stats['published'] - published:4d} broker publishes, "
+          f"hub CPU {hub_cpu[0] * 1000:6.1f} ms, {stale:2d}/{rooms} nodes out of sync, consistent after {elapsed * 1000:6.0f} ms{detail}")
+    for node in nodes: node.client.disconnect()
+    app.client.disconnect()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--nodes", type=int, default=40)
+    parser.add_argument("--relays", type=int, default=8)
+    parser.add_argument("--offline", type=float, default=0.33, help="share of nodes offline before the restart")
+    args = parser.parse_args()
+    app.log_command = lambda message, **fields: None
+    app.broadcast_update = lambda data: None
+    print(f"{args.nodes} nodes x {args.relays} relays, {int(args.nodes * args.offline)} offline across the restart")
+    for mode in MODES: run(mode, args.nodes, args.relays, args.offline)
+
+
+if __name__ == "__main__":
+    main()
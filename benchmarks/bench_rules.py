@@ -0,0 +1,155 @@
+"""Automation rules under a motion storm: the indexed RuleEngine vs. checking every rule per event.
+
+  scan     each event is checked against every rule (what a rule list without an index does)
+  indexed  RuleEngine as shipped: the event's (event, room) bucket plus the any-room rules
+
+1000 rules over the rooms: mostly motion rules for one room (some with a time window, a relay
+condition, debounce or cooldown), status rules, a few any-room rules and time rules. Each engine
+first replays the same event stream synchronously on a simulated clock, so their decisions can be
+compared; then the hub's real path is driven: nodes publish motion on home/motion_trigger as fast
+as they can and the engine's thread keeps up (or not).
+
+Run from the repo root: python benchmarks/bench_rules.py [--rules 1000] [--rooms 40] [--events 20000]
+"""
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app
+from benchmarks import loadgen
+
+WALL_CLOCK = datetime.datetime(2026, 10, 14, 21, 30)    # a Wednesday evening, for the time-window conditions
+
+
+class ScanEngine(app.RuleEngine):
+    def candidates(self, event):
+        if event.rule is not None: return super().candidates(event)
+        matches = [rule for rule in self.rules.values() if rule.trigger["event"] == event.kind and rule.trigger.get("room") in ("*", event.room)]
+        return sorted(matches, key=lambda rule: rule.trigger["room"] == "*")    # the indexed engine's order
+
+
+def make_rules(nodes, count, rng):
+    rules = {}
+    for i in range(count):
+        node, relay = rng.choice(nodes), f"relay{rng.randint(1, len(nodes[0].relays))}"
+        kind = rng.random()
+        if kind < 0.01: trigger = {"event": "motion"}
+        elif kind < 0.03: trigger = {"event": "time", "at": f"{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}"}
+        elif kind < 0.75: trigger = {"event": "motion", "room": node.room}
+        else: trigger = {"event": "status", "room": node.room, "relay": relay, "status": rng.choice(("ON", "OFF"))}
+        conditions = []
+        if rng.random() < 0.4:
+            start = rng.randint(0, 23)
+            conditions.append({"type": "time", "after": f"{start:02d}:00", "before": f"{(start + rng.randint(2, 12)) % 24:02d}:00"})
+        if rng.random() < 0.2: conditions.append({"type": "relay", "room": node.room, "relay": f"relay{rng.randint(1, len(node.relays))}", "status": "OFF"})
+        rules[f"rule_{i}"] = {"trigger": trigger, "conditions": conditions, "actions": [{"type": "relay", "room": node.room, "relay": relay, "status": rng.choice(("ON", "OFF"))}],
+                              "debounce_s": rng.choice((0, 0, 0, 2)), "cooldown_s": rng.choice((0, 10, 30, 60))}
+    return rules
+
+
+def make_events(nodes, count, rng):
+    # Motion is skewed towards a few busy rooms; about one event in five is someone flipping a switch at a node.
+    weights = [1 / (r + 1) for r in range(len(nodes))]
+    events = []
+    for _ in range(count):
+        node = rng.choices(nodes, weights)[0]
+        if rng.random() < 0.2: events.append(("status", node.room, f"relay{rng.randint(1, len(node.relays))}", rng.choice(("ON", "OFF"))))
+        else: events.append(("motion", node.room, None, None))
+    return events
+
+
+def reset_states(nodes):
+    app.state_store.load({node.room: {"wake_word": "jarvis", **{relay: {"label": f"Light {relay}", "status": "OFF", "motion_control": False} for relay in node.relays}} for node in nodes})
+
+
+def replay(engine_class, nodes, rules, events, rate):
+    # Synchronous, on a simulated clock at `rate` events per second: same decisions every run.
+    reset_states(nodes)
+    sim = [0.0]
+    engine = app.rule_engine = engine_class(clock=lambda: sim[0], wall_clock=lambda: WALL_CLOCK)
+    engine.reload(rules)
+    fired = []
+    fire = engine.fire
+    def recording_fire(rule, event, now):
+        result = fire(rule, event, now)
+        if result: fired.append((rule.name, now))
+        return result
+    engine.fire = recording_fire
+    match_s = total_s = 0.0
+    for i, (kind, room, relay, status) in enumerate(events):
+        sim[0] = i / rate
+        # What handle_motion_trigger and handle_status_message do; the flip reaches the engine through the state feed.
+        if kind == "status": app.state_store.update(room, relay, "node", status=status)
+        else: engine.emit("motion", room)
+        # The engine thread's loop, inline: time spent finding and checking candidates, then the whole of it.
+        while engine.events:
+            event = engine.events.popleft()
+            t0 = time.perf_counter()
+            for rule in engine.candidates(event): app.rule_triggered(rule.trigger, event)
+            t1 = time.perf_counter()
+            engine.run_due(event.at)
+            engine.process(event)
+            total_s += time.perf_counter() - t1
+            match_s += t1 - t0
+    engine.run_due(float("inf"))
+    return engine, fired, match_s, total_s
+
+
+def storm(engine_class, nodes, rules, events, timeout):
+    # The real path: MQTT motion messages through the topic router into the engine's own thread.
+    reset_states(nodes)
+    app.rule_engine = engine_class(wall_clock=lambda: WALL_CLOCK)
+    app.rule_engine.reload(rules)
+    app.rule_engine.start()
+    motions = [room for kind, room, _, _ in events if kind == "motion"]
+    by_room = {node.room: node for node in nodes}
+    t0 = time.perf_counter()
+    for room in motions: by_room[room].motion()
+    done = loadgen.settle(lambda: app.rule_engine.stats["events"] + app.rule_engine.stats["dropped"] >= len(motions), timeout=timeout)
+    elapsed = time.perf_counter() - t0
+    return len(motions), elapsed, done, dict(app.rule_engine.stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--rules", type=int, default=1000)
+    parser.add_argument("--rooms", type=int, default=40)
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--rate", type=float, default=200, help="simulated events per second for the replay")
+    args = parser.parse_args()
+    broker, nodes = loadgen.start_hub(args.rooms)
+    loadgen.settle(lambda: len(app.node_features) == args.rooms)
+    app.log_command = lambda message, **fields: None
+    rng = random.Random(0)
+    rules = make_rules(nodes, args.rules, rng)
+    events = make_events(nodes, args.events, rng)
+    motions = sum(1 for kind, *_ in events if kind == "motion")
+    print(f"{args.rules} rules over {args.rooms} rooms, {len(events)} events ({motions} motion, {len(events) - motions} switch flips) at {args.rate:g}/s simulated")
+
+    # Nodes off the broker for the replays: their status echoes would race the replay and make it nondeterministic.
+    for node in nodes: node.client.disconnect()
+    decisions = {}
+    for name, engine_class in (("scan", ScanEngine), ("indexed", app.RuleEngine)):
+        engine, fired, match_s, total_s = replay(engine_class, nodes, rules, events, args.rate)
+        decisions[name] = fired
+        stats = engine.stats
+        examined = len(engine.rules) if engine_class is ScanEngine else stats["candidates"] / stats["events"]
+        print(f"{name:8s}: match {match_s / stats['events'] * 1e6:7.2f} us/event ({examined:6.1f} rules examined), "
+              f"with actions {total_s / stats['events'] * 1e6:7.2f} us/event; {stats['events']} events, {stats['fired']} fired, "
+              f"{stats['cooling_down']} in cooldown, {stats['debounced']} debounced, {stats['conditions_false']} failed conditions")
+    print(f"same rules fired at the same times: {decisions['scan'] == decisions['indexed']}")
+    for node in nodes: node.connect()
+
+    for name, engine_class in (("scan", ScanEngine), ("indexed", app.RuleEngine)):
+        sent, elapsed, done, stats = storm(engine_class, nodes, rules, events, timeout=60)
+        print(f"{name:8s} storm: {sent} motion messages in {elapsed:5.2f} s ({sent / elapsed:7.0f}/s){'' if done else ' (timed out)'}; "
+              f"{stats['events']} matched, {stats['dropped']} dropped, {stats['fired']} fired")
+        app.rule_engine.reload({})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""Mode scheduling cost: legacy per-minute scan of modes.json vs. the heap-based ModeScheduler.
+
+Simulates one day minute by minute with a fake clock, then a forward clock jump
+(as /sync_time can cause) to check missed fires are caught up.
+
+Run from the repo root: python benchmarks/bench_scheduler.py [modes]
+"""
+import datetime
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app
+
+DAYS = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+
+
+def synthetic_modes(count):
+    rng = random.Random(7)
+    return {f"mode {i}": {"start_time": f"{rng.randrange(24):02d}:{rng.randrange(60):02d}", "days": rng.sample(DAYS, rng.randint(1, 7)), "audio_id": None, "actions": {}} for i in range(count)}
+
+
+def legacy_day(start):
+    fires = 0
+    for minute in range(24 * 60):
+        now = start + datetime.timedelta(minutes=minute)
+        current_time_str = now.strftime("%H:%M")
+        for name, data in app.load_config("modes.json").items():
+            if data.get("start_time") == current_time_str and now.strftime("%a") in data.get("days", []): fires += 1
+    return fires
+
+
+def main(count=2000):
+    app.CONFIG_PATH = tempfile.mkdtemp(prefix="smarthome-bench-")
+    app.log_command = lambda message, **fields: None
+    modes = synthetic_modes(int(count))
+    app.save_config(modes, "modes.json")
+    start = datetime.datetime(2026, 1, 5, 0, 0)
+
+    t0 = time.perf_counter()
+    legacy_fires = legacy_day(start)
+    legacy_s = time.perf_counter() - t0
+
+    fired = []
+    scheduler = app.ModeScheduler(clock=lambda: start, dispatch=lambda name, data: fired.append(name))
+    t0 = time.perf_counter()
+    scheduler.reload(modes)
+    with scheduler.cond:
+        scheduler.run_due(start - datetime.timedelta(seconds=1))
+        rebuild_ms = (time.perf_counter() - t0) * 1000
+        for minute in range(24 * 60): scheduler.run_due(start + datetime.timedelta(minutes=minute))
+    heap_s = time.perf_counter() - t0
+
+    print(f"modes={count}")
+    print(f"legacy scan : {legacy_fires:5d} fires, {legacy_s * 1000:9.1f} ms of CPU per simulated day")
+    print(f"heap        : {len(fired):5d} fires, {heap_s * 1000:9.1f} ms per simulated day (rebuild {rebuild_ms:.1f} ms)")
+
+    fired.clear()
+    jump_from = start + datetime.timedelta(days=1)
+    with scheduler.cond: scheduler.run_due(jump_from + datetime.timedelta(minutes=7))
+    expected = sum(1 for d in modes.values() for m in range(0, 8)
+                   if d["start_time"] == (jump_from + datetime.timedelta(minutes=m)).strftime("%H:%M") and jump_from.strftime("%a") in d["days"])
+    print(f"clock jump +7 min: caught up {len(fired)} of {expected} missed fires")
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
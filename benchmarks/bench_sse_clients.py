@@ -0,0 +1,127 @@
+"""Hundreds of idle dashboards: memory, threads and event fan-out latency, Werkzeug threaded vs. AsyncHubServer.
+
+The hub runs in a child process against the in-process broker and simulated nodes (loadgen). This
+process opens N /status-stream connections that just sit there, reads the server's RSS and thread
+count, then flips relays through POST /control and times how long each status_update takes to
+reach every dashboard.
+
+Run from the repo root: python benchmarks/bench_sse_clients.py [--clients N] [--toggles K]
+"""
+import argparse
+import asyncio
+import http.cookiejar
+import json
+import os
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DRIVER = """
+import sys
+sys.path.insert(0, {root!r})
+import app
+from benchmarks import loadgen
+loadgen.start_hub(4)
+if {mode!r} == "threaded":
+    from werkzeug.serving import make_server
+    make_server("127.0.0.1", {port}, app.app, threaded=True).serve_forever()
+else: app.AsyncHubServer(app.app, app.broadcast_hub).run("127.0.0.1", {port})
+"""
+
+
+def proc_status(pid):
+    with open(f"/proc/{pid}/status") as f: fields = dict(line.split(":", 1) for line in f)
+    return int(fields["VmRSS"].split()[0]) / 1024, int(fields["Threads"])
+
+
+def login(base):
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+    deadline = time.perf_counter() + 30
+    while True:
+        try:
+            opener.open(f"{base}/login", urllib.parse.urlencode({"username": "test1", "password": "t1"}).encode(), timeout=2)
+            return opener
+        except (urllib.error.URLError, ConnectionError):
+            if time.perf_counter() > deadline: raise
+            time.sleep(0.1)
+
+
+class Dashboard:
+    def __init__(self, port, on_event):
+        self.port = port
+        self.on_event = on_event
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection("127.0.0.1", self.port)
+        self.writer.write(b"GET /status-stream HTTP/1.1\r\nHost: localhost\r\nAccept: text/event-stream\r\n\r\n")
+        await self.writer.drain()
+        while (await self.reader.readline()) not in (b"\r\n", b""): pass
+
+    async def listen(self):
+        while True:
+            line = await self.reader.readline()
+            if not line: return
+            if line.startswith(b"data: "): self.on_event(time.perf_counter(), json.loads(line[6:]))
+
+
+async def measure(mode, port, clients, toggles):
+    script = DRIVER.format(root=REPO_ROOT, mode=mode, port=port)
+    proc = subprocess.Popen([sys.executable, "-c", script], cwd=REPO_ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        base = f"http://127.0.0.1:{port}"
+        opener = await asyncio.to_thread(login, base)
+        await asyncio.sleep(0.5)
+        rss0, threads0 = proc_status(proc.pid)
+
+        pending, samples = {}, []
+        def on_event(received, data):
+            if data.get("type") != "status_update": return
+            key = (data["relay"], data["status"])
+            if key in pending:
+                sent, remaining = pending[key]
+                samples.append((received - sent) * 1000)
+                pending[key] = (sent, remaining - 1)
+        dashboards = [Dashboard(port, on_event) for _ in range(clients)]
+        for start in range(0, clients, 50): await asyncio.gather(*(d.connect() for d in dashboards[start:start + 50]))
+        listeners = [asyncio.create_task(d.listen()) for d in dashboards]
+        await asyncio.sleep(2)
+        rss1, threads1 = proc_status(proc.pid)
+
+        fanout = []
+        for i in range(toggles):
+            key = ("relay1", "ON" if i % 2 == 0 else "OFF")
+            body = json.dumps({"room": "room_0", "relay": key[0], "action": key[1]}).encode()
+            request = urllib.request.Request(f"{base}/control", body, {"Content-Type": "application/json"})
+            pending[key] = (time.perf_counter(), clients)
+            await asyncio.to_thread(opener.open, request, None, 5)
+            deadline = time.perf_counter() + 10
+            while pending[key][1] > 0 and time.perf_counter() < deadline: await asyncio.sleep(0.001)
+            fanout.append((time.perf_counter() - pending.pop(key)[0]) * 1000)
+        for task in listeners: task.cancel()
+        for d in dashboards: d.writer.close()
+    finally:
+        proc.terminate()
+        proc.wait(5)
+    samples.sort()
+    pick = lambda q: samples[min(int(len(samples) * q), len(samples) - 1)] if samples else float("nan")
+    print(f"{mode:8s}: {clients} idle clients +{rss1 - rss0:6.1f} MiB RSS ({(rss1 - rss0) * 1024 / clients:5.1f} KiB each), "
+          f"threads {threads0} -> {threads1}; delivery p50 {pick(0.5):6.2f} ms p99 {pick(0.99):6.2f} ms, "
+          f"all {clients} reached in {sorted(fanout)[len(fanout) // 2]:6.2f} ms (median of {toggles})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--clients", type=int, default=500)
+    parser.add_argument("--toggles", type=int, default=20)
+    parser.add_argument("--port", type=int, default=5078)
+    args = parser.parse_args()
+    for mode in ("threaded", "async"): asyncio.run(measure(mode, args.port, args.clients, args.toggles))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""SSE fan-out to many dashboards: per-client queue + json.dumps vs. the shared BroadcastHub ring.
+
+Simulates N dashboard connections (a share of them slow) receiving a burst of status updates and
+checks that every client ends up with the true relay state.
+
+Run from the repo root: python benchmarks/bench_sse_fanout.py [clients] [events] [slow_share]
+"""
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app
+
+ROOMS, RELAYS = 6, 8
+
+
+def event(i):
+    return {"type": "status_update", "room": f"room_{i % ROOMS}", "relay": f"relay{i % RELAYS + 1}", "status": "ON" if (i // 7) % 2 else "OFF"}
+
+
+def apply(view, data):
+    if data["type"] == "status_update": view[(data["room"], data["relay"])] = data["status"]
+    elif data["type"] == "snapshot":
+        for room, relays in data["states"].items():
+            for relay, status in relays.items(): view[(room, relay)] = status
+
+
+def legacy(clients, events, slow):
+    subscribers, views, encodes, dropped = [], [], [0], [0]
+    done = threading.Event()
+    def client(q, view, is_slow):
+        while True:
+            try: data = q.get(timeout=0.5)
+            except queue.Empty:
+                if done.is_set(): return
+                continue
+            encodes[0] += 1
+            apply(view, json.loads(json.dumps(data)))
+            if is_slow: time.sleep(0.002)
+    threads = []
+    for c in range(clients):
+        q, view = queue.Queue(maxsize=100), {}
+        subscribers.append(q); views.append(view)
+        threads.append(threading.Thread(target=client, args=(q, view, c < slow), daemon=True))
+    for t in threads: t.start()
+    t0 = time.perf_counter()
+    for i in range(events):
+        dead = []
+        for q in subscribers:
+            try: q.put_nowait(event(i))
+            except queue.Full: dead.append(q)
+        for q in dead:
+            subscribers.remove(q); dropped[0] += 1
+    publish_s = time.perf_counter() - t0
+    done.set()
+    for t in threads: t.join()
+    return publish_s, encodes[0], views, f"{dropped[0]} clients dropped"
+
+
+def hub_run(clients, events, slow):
+    hub = app.BroadcastHub()
+    views, stop = [], threading.Event()
+    def client(cursor, view, is_slow):
+        while not stop.is_set() or cursor < hub.seq:
+            cursor, chunks = hub.read(cursor, timeout=0.2)
+            for chunk in chunks:
+                if chunk.startswith(":"): continue
+                apply(view, json.loads(chunk.split("data: ", 1)[1]))
+                if is_slow: time.sleep(0.002)
+    threads = []
+    for c in range(clients):
+        view = {}
+        views.append(view)
+        threads.append(threading.Thread(target=client, args=(hub.cursor_for(), view, c < slow), daemon=True))
+    for t in threads: t.start()
+    t0 = time.perf_counter()
+    for i in range(events): hub.publish(event(i))
+    publish_s = time.perf_counter() - t0
+    stop.set()
+    for t in threads: t.join()
+    return publish_s, hub.stats["published"], views, f"stats {hub.stats}"
+
+
+def main(clients=200, events=2000, slow_share=0.1):
+    clients, events = int(clients), int(events)
+    slow = int(clients * float(slow_share))
+    truth = {}
+    for i in range(events): apply(truth, event(i))
+    app.device_states.clear()
+    for (room, relay), status in truth.items(): app.device_states.setdefault(room, {})[relay] = {"label": relay, "status": status}
+    print(f"{clients} clients ({slow} slow), {events} status events")
+    for label, run in (("legacy queues", legacy), ("broadcast hub", hub_run)):
+        cpu0 = time.process_time()
+        publish_s, encodes, views, extra = run(clients, events, slow)
+        cpu = time.process_time() - cpu0
+        stale = sum(1 for v in views if v != truth)
+        print(f"{label:14s}: publish {publish_s * 1000:7.1f} ms, {encodes:7d} json encodes, CPU {cpu:5.2f} s, "
+              f"{stale} clients with stale state; {extra}")
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
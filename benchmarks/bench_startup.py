@@ -0,0 +1,93 @@
+"""Cold start: time until the dashboard answers and until voice is ready, old startup vs. new.
+
+  legacy  load the Vosk model in-process before anything else, then run under the debug reloader (the
+          model and every service start twice: once in the watcher process, once in the server child)
+  fast    run_hub() as shipped: one process, model loading in the background
+
+Each run is a fresh interpreter with an empty temp config; the clock starts when the process is
+spawned. "first 200" is the first successful GET /login, "voice ready" the first /health reporting it.
+
+Run from the repo root: python benchmarks/bench_startup.py [--runs N] [--model PATH]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DRIVERS = {
+    "legacy": """
+import sys
+sys.path.insert(0, {root!r})
+import app
+if __name__ == "__main__":
+    app.CONFIG_PATH, app.voice_model.path = {config!r}, {model!r}
+    app.decode_pool = app.DecodePool(size=0)
+    app.voice_model.get()
+    app.start_services()
+    app.app.run(host="127.0.0.1", port={port}, debug=True)
+""",
+    "fast": """
+import sys
+sys.path.insert(0, {root!r})
+import app
+if __name__ == "__main__":   # decode workers are spawned and re-import this script
+    app.CONFIG_PATH, app.voice_model.path = {config!r}, {model!r}
+    app.run_hub(host="127.0.0.1", port={port})
+""",
+}
+
+
+def get(url):
+    try:
+        with urllib.request.urlopen(url, timeout=1) as response: return response.status, response.read()
+    except (urllib.error.URLError, ConnectionError, OSError): return None, None
+
+
+def run_once(mode, port, model_path, timeout):
+    config = tempfile.mkdtemp(prefix="smarthome-bench-")
+    script = os.path.join(config, "driver.py")
+    with open(script, "w", encoding="utf-8") as f: f.write(DRIVERS[mode].format(root=REPO_ROOT, config=config, model=model_path, port=port))
+    t0 = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, script], cwd=REPO_ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    first_ok = voice_ready = None
+    try:
+        while time.perf_counter() - t0 < timeout and proc.poll() is None:
+            if first_ok is None and get(f"http://127.0.0.1:{port}/login")[0] == 200: first_ok = time.perf_counter() - t0
+            if first_ok is not None:
+                status, body = get(f"http://127.0.0.1:{port}/health")
+                if status == 200 and json.loads(body)["voice"] != "warming_up":
+                    voice_ready = time.perf_counter() - t0
+                    break
+            time.sleep(0.01)
+    finally:
+        proc.terminate()
+        try: proc.wait(5)
+        except subprocess.TimeoutExpired: proc.kill()
+    return first_ok, voice_ready
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--model", default=os.path.join(REPO_ROOT, "vosk-model-small-en-in-0.4"))
+    parser.add_argument("--port", type=int, default=5077)
+    parser.add_argument("--timeout", type=float, default=120)
+    args = parser.parse_args()
+
+    for mode in ("legacy", "fast"):
+        results = [run_once(mode, args.port, args.model, args.timeout) for _ in range(args.runs)]
+        first = sorted(r[0] for r in results if r[0] is not None)
+        ready = sorted(r[1] for r in results if r[1] is not None)
+        median = lambda xs: f"{xs[len(xs) // 2]:6.2f} s" if xs else "   n/a  "
+        print(f"{mode:7s}: first 200 {median(first)}   voice ready {median(ready)}   ({args.runs} runs, median)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""Concurrency stress for DeviceStateStore and its change feed.
+
+Writer threads hammer the store the way the hub does: /control requests, node status echoes, mode
+batches across every room, voice toggles (compare-and-set) and motion expiries, while the journal
+snapshots concurrently. Afterwards it checks that:
+  - every room's changes reached the feed in strictly increasing version order,
+  - an SSE client replaying the broadcast ring ends up with the store's state,
+  - snapshot + journal replay reproduces the store's state,
+  - the last command sent to each relay matches the store unless a node echo had the final word,
+  - no writer thread or change-feed subscriber raised.
+Exits non-zero if any check fails.
+
+Run from the repo root: python benchmarks/bench_state_store.py [rooms] [threads] [ops_per_thread]
+"""
+import collections
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app
+
+RELAYS = 8
+
+
+def build_rooms(rooms):
+    return {f"room_{r}": {"wake_word": "jarvis", **{f"relay{i}": {"label": f"Light {r}-{i}", "status": "OFF", "motion_control": i % 2 == 0} for i in range(1, RELAYS + 1)}} for r in range(rooms)}
+
+
+def writer(seed, rooms, ops, counts, errors):
+    try: write(seed, rooms, ops, counts)
+    except Exception as e: errors.append(f"writer {seed}: {e!r}")
+
+
+def write(seed, rooms, ops, counts):
+    rng = random.Random(seed)
+    for _ in range(ops):
+        room, relay = rng.choice(rooms), f"relay{rng.randint(1, RELAYS)}"
+        kind = rng.choice(("control", "control", "node", "mode", "toggle", "motion"))
+        if kind == "control": app.state_store.update(room, relay, "user", status=rng.choice(("ON", "OFF")))
+        elif kind == "node": app.state_store.update(room, relay, "node", status=rng.choice(("ON", "OFF")))
+        elif kind == "mode":
+            state = rng.choice(("ON", "OFF"))
+            app.state_store.apply({r: {f"relay{i}": {"status": state} for i in range(1, RELAYS + 1)} for r in rooms}, "mode")
+        elif kind == "toggle":
+            version = app.state_store.version_of(room, relay)
+            current = app.device_states[room][relay]["status"]
+            if app.state_store.update(room, relay, "voice", expect_version=version, status="OFF" if current == "ON" else "ON") is None: counts["cas_conflicts"] += 1
+        else: app.turn_off_motion_relays(room, {relay: app.state_store.version_of(room, relay)}, app.motion_timers)
+        counts[kind] += 1
+
+
+def main(rooms=6, threads=8, ops=3000):
+    rooms, threads, ops = int(rooms), int(threads), int(ops)
+    app.CONFIG_PATH = tempfile.mkdtemp(prefix="smarthome-bench-")
+    app.log_command = lambda message, **fields: None
+    app.broadcast_hub = app.BroadcastHub(ring_size=10 ** 7)
+
+    sent = {}
+    app.command_dispatcher = app.CommandDispatcher(interval=0, publish=lambda topic, payload: None)
+    def record_send(room, changes, on_sent=None):
+        for relay, state in changes.items(): sent[(room, relay)] = state
+    app.command_dispatcher.send_relays = record_send
+
+    feed_versions = collections.defaultdict(list)
+    last_origin = {}
+    @app.state_store.subscribe
+    def audit(changes, on_sent):
+        for change in changes:
+            feed_versions[change.room].append(change.version)
+            if change.relay and "status" in change.fields: last_origin[(change.room, change.relay)] = change.origin
+
+    # The store only prints a failing subscriber and carries on; here it counts as a failed check.
+    errors = []
+    def checked(fn):
+        def run(changes, on_sent):
+            try: fn(changes, on_sent)
+            except Exception as e:
+                errors.append(f"subscriber {fn.__name__}: {e!r}")
+                raise
+        run.__name__ = fn.__name__
+        return run
+    app.state_store.subscribers[:] = [checked(fn) for fn in app.state_store.subscribers]
+
+    app.state_store.load(build_rooms(rooms))
+    app.state_journal.debounce = 0.01
+    app.state_journal.start()
+    room_names = list(app.device_states)
+    counts = collections.Counter()
+    cursor = app.broadcast_hub.cursor_for()
+
+    workers = [threading.Thread(target=writer, args=(seed, room_names, ops, counts, errors)) for seed in range(threads)]
+    stop = threading.Event()
+    def snapshotter():
+        while not stop.is_set():
+            app.state_journal.request_snapshot()
+            time.sleep(0.005)
+    snap_thread = threading.Thread(target=snapshotter)
+    t0 = time.perf_counter()
+    snap_thread.start()
+    for w in workers: w.start()
+    for w in workers: w.join()
+    elapsed = time.perf_counter() - t0
+    stop.set()
+    snap_thread.join()
+    app.state_journal.flush()
+
+    truth = {(room, relay): data["status"] for room, devices in app.device_states.items() for relay, data in devices.items() if relay.startswith("relay")}
+    ordered = all(v == sorted(set(v)) for v in feed_versions.values())
+
+    view = {}
+    _, chunks = app.broadcast_hub.read(cursor, timeout=0)
+    for chunk in chunks:
+        data = json.loads(chunk.split("data: ", 1)[1])
+        if data["type"] == "status_update": view[(data["room"], data["relay"])] = data["status"]
+    sse_ok = all(view.get(key, "OFF") == status for key, status in truth.items())
+
+    app.state_store.load({})
+    replayed = app.state_journal.replay()
+    replay_ok = all(replayed[room][relay]["status"] == status for (room, relay), status in truth.items())
+    dispatch_ok = all(sent.get(key, "OFF") == status for key, status in truth.items() if last_origin.get(key, "user") != "node")
+
+    stats = app.state_store.stats
+    print(f"{sum(counts[k] for k in ('control', 'node', 'mode', 'toggle', 'motion'))} ops from {threads} threads on {rooms} rooms in {elapsed:.2f} s: "
+          f"{stats['writes']} writes, {stats['noops']} no-ops, {stats['conflicts']} CAS conflicts, {stats['writes'] / elapsed:.0f} writes/s")
+    print(f"feed in version order per room: {ordered}")
+    print(f"SSE replay matches store:       {sse_ok}")
+    print(f"journal replay matches store:   {replay_ok} ({app.state_journal.stats['snapshots']} snapshots taken under load)")
+    print(f"last MQTT command matches store: {dispatch_ok}")
+    print(f"no writer or subscriber errors: {not errors}")
+    for error in errors[:5]: print(f"  {error}")
+    if errors or not (ordered and sse_ok and replay_ok and dispatch_ok): sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,98 @@
+"""Control-plane latency under an audio flood: everything on paho's network thread vs. the TopicRouter.
+
+A producer replays room audio at `speed` times real time (speed=0: as fast as the simulated socket
+buffer accepts it), while a status echo arrives every few milliseconds. It reports how long each
+status waits before its handler has run. The router hands audio to its lanes and runs status inline,
+so it should match the inline path on status latency while taking the audio work off the network thread.
+
+Run from the repo root: python benchmarks/bench_topic_router.py [rooms] [seconds] [speed]
+"""
+import collections
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app
+
+CHUNK_BYTES = 1024
+SOCKET_BUFFER = 1000        # messages the broker connection can hold before the producer blocks
+STATUS_INTERVAL_S = 0.005
+
+
+def percentile(ordered, q):
+    return ordered[min(int(len(ordered) * q), len(ordered) - 1)] if ordered else float("nan")
+
+
+def run(rooms, seconds, speed, dispatch):
+    audio = (np.random.default_rng(0).normal(0, 400, CHUNK_BYTES // 2)).astype(np.int16).tobytes()
+    sent_at, latencies = collections.deque(), []
+    handle_status = app.handle_status_message
+
+    def timed_status(topic, payload):
+        handle_status(topic, payload)
+        latencies.append((time.perf_counter() - sent_at.popleft()) * 1000)
+    app.handle_status_message = timed_status
+
+    socket = queue.Queue(SOCKET_BUFFER)
+    def network_thread():
+        while True:
+            item = socket.get()
+            if item is None: return
+            dispatch(*item)
+    net = threading.Thread(target=network_thread)
+    net.start()
+
+    for r in range(rooms): socket.put((f"{app.MQTT_VOICE_COMMAND_TOPIC}room_{r}", b"START"))
+    chunk_s = CHUNK_BYTES / 2 / app.SAMPLE_RATE / speed if speed else 0
+    t0 = next_status = next_chunk = time.perf_counter()
+    chunks = 0
+    while time.perf_counter() - t0 < seconds:
+        if time.perf_counter() >= next_chunk:
+            next_chunk += chunk_s
+            for r in range(rooms): socket.put((f"{app.MQTT_VOICE_AUDIO_TOPIC}room_{r}", audio))
+            chunks += rooms
+        if time.perf_counter() >= next_status:
+            next_status += STATUS_INTERVAL_S
+            sent_at.append(time.perf_counter())
+            socket.put((app.MQTT_STATUS_TOPIC, b"room_0:relay1:ON" if len(latencies) % 2 else b"room_0:relay1:OFF"))
+    socket.put(None)
+    net.join()
+    deadline = time.perf_counter() + 5
+    while sent_at and time.perf_counter() < deadline: time.sleep(0.01)
+    app.handle_status_message = handle_status
+    return chunks, sorted(latencies)
+
+
+def inline(topic, payload):
+    # The old on_message: every handler runs right on the network thread.
+    route = app.topic_router.classify(topic)
+    if route: route[2](topic, payload)
+
+
+def main(rooms=8, seconds=3, speed=40):
+    rooms, seconds, speed = int(rooms), float(seconds), float(speed)
+    app.CONFIG_PATH = tempfile.mkdtemp(prefix="smarthome-bench-")
+    app.log_command = lambda message, **fields: None
+    app.broadcast_update = lambda data: None
+    app.process_voice_command = lambda *args, **kwargs: None
+    app.decode_pool = app.DecodePool(size=0)
+    app.VOICE_STREAMING = False
+    app.state_store.load({"room_0": {"relay1": {"label": "Light", "status": "OFF"}}})
+
+    for label, dispatch in (("inline", inline), ("router", app.topic_router.route)):
+        chunks, lat = run(rooms, seconds, speed, dispatch)
+        print(f"{label:6s}: {chunks / seconds:8.0f} audio msgs/s, status latency p50 {percentile(lat, 0.5):7.2f} ms"
+              f"  p99 {percentile(lat, 0.99):7.2f} ms  max {lat[-1] if lat else float('nan'):7.2f} ms ({len(lat)} statuses)")
+    summary = app.topic_router.summary()
+    dropped = sum(lane["dropped"] for name, lane in summary["lanes"].items() if name.startswith("audio:"))
+    print(f"router: {dropped} audio chunks shed by drop_oldest, {summary['inline']} messages handled inline ({summary['inline_errors']} errors)")
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
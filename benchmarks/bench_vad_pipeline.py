@@ -0,0 +1,98 @@
+"""CPU per room-second of streamed audio: the old bytearray/audioop VadAudio loop vs. the NumPy framing engine.
+
+Streams synthetic room audio (mostly background hiss with a few speech-like bursts) in the
+1024-byte chunks the ESP32 nodes publish and measures process CPU time per second of audio
+(best of REPEAT runs, the two loops interleaved).
+
+Run from the repo root: python benchmarks/bench_vad_pipeline.py [rooms] [seconds] [chunk_bytes]
+"""
+import os
+import sys
+import tempfile
+import time
+import warnings
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app
+
+CHUNK_BYTES = 1024
+REPEAT = 5                  # best of: one process, one core, so single runs swing by a third
+
+
+def synthetic_audio(seconds, seed):
+    rng = np.random.default_rng(seed)
+    t = np.arange(seconds * app.SAMPLE_RATE) / app.SAMPLE_RATE
+    audio = rng.normal(0, 15, len(t))
+    for start in range(2, seconds - 1, 6):
+        # 1.2 s voiced burst: harmonics of a wandering pitch, amplitude-modulated like syllables
+        idx = slice(start * app.SAMPLE_RATE, int((start + 1.2) * app.SAMPLE_RATE))
+        pitch = 140 + 30 * np.sin(2 * np.pi * 0.7 * t[idx])
+        phase = 2 * np.pi * np.cumsum(pitch) / app.SAMPLE_RATE
+        envelope = 0.5 + 0.5 * np.sin(2 * np.pi * 4 * t[idx]) ** 2
+        audio[idx] += 1500 * envelope * sum(np.sin(k * phase) / k for k in range(1, 6))
+    return np.clip(audio, -32768, 32767).astype(np.int16).tobytes()
+
+
+class LegacyVad:
+    # VadAudio.process_chunk as it was: audioop gain, bytearray slicing, per-frame VAD.
+    def __init__(self):
+        import webrtcvad
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", DeprecationWarning)
+            import audioop
+        self.mul = audioop.mul
+        self.vad = webrtcvad.Vad(1)
+        self.buffer = bytearray()
+        self.frame_size = 960
+        self.speech_frames = 0
+
+    def process_chunk(self, chunk):
+        chunk = self.mul(chunk, 2, 4)
+        self.buffer.extend(chunk)
+        while len(self.buffer) >= self.frame_size:
+            frame = self.buffer[:self.frame_size]
+            del self.buffer[:self.frame_size]
+            if self.vad.is_speech(bytes(frame), app.SAMPLE_RATE): self.speech_frames += 1
+
+
+def run(make, streams, chunk_bytes=CHUNK_BYTES):
+    processors = [make() for _ in streams]
+    t0 = time.process_time()
+    for offset in range(0, len(streams[0]), chunk_bytes):
+        for proc, audio in zip(processors, streams): proc.process_chunk(audio[offset:offset + chunk_bytes])
+    return time.process_time() - t0, processors
+
+
+def main(rooms=8, seconds=30, chunk_bytes=CHUNK_BYTES):
+    rooms, seconds, chunk_bytes = int(rooms), int(seconds), int(chunk_bytes)
+    app.CONFIG_PATH = tempfile.mkdtemp(prefix="smarthome-bench-")
+    app.log_command = lambda message, **fields: None
+    app.process_voice_command = lambda *args, **kwargs: None
+    app.decode_pool = app.DecodePool(size=0)
+    streams = [synthetic_audio(seconds, seed) for seed in range(rooms)]
+    room_seconds = rooms * seconds
+
+    engines = {"legacy": LegacyVad, "numpy": lambda: app.VadAudio("bench_room", streaming=False)}
+    try: LegacyVad()
+    except ImportError:
+        print("audioop not available (Python 3.13+): skipping the legacy loop")
+        engines.pop("legacy")
+    results = {}
+    for _ in range(REPEAT):
+        for label, make in engines.items():
+            result = run(make, streams, chunk_bytes)
+            if label not in results or result[0] < results[label][0]: results[label] = result
+
+    for label, (cpu, processors) in results.items():
+        line = f"{label:6s}: {cpu / room_seconds * 1000:6.2f} ms CPU per room-second ({rooms} rooms x {seconds} s, {chunk_bytes} B chunks)"
+        if label == "numpy":
+            frames = sum(p.stats["frames"] for p in processors)
+            gated = sum(p.stats["gated"] for p in processors)
+            line += f", {gated / max(frames, 1):.0%} of frames skipped by the energy gate"
+        print(line)
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,63 @@
+"""End-of-speech -> MQTT publish latency for batch vs. streaming Vosk decoding.
+
+Feeds a recorded command (16 kHz mono 16-bit WAV) through VadAudio at real-time pace,
+the way a room node streams it, and reports the latency each decode mode records. The
+room's wake word is "jarvis", so the recording should start with it (the wake word filter
+drops it otherwise).
+
+Run from the repo root: python benchmarks/bench_voice_latency.py command.wav "Fan" [runs]
+"""
+import os
+import sys
+import tempfile
+import time
+import wave
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app
+
+CHUNK_BYTES = 1024
+
+
+class RecordingClient:
+    def __init__(self): self.published = []
+    def publish(self, topic, payload=None, *args, **kwargs): self.published.append((time.perf_counter(), topic, payload))
+
+
+def read_pcm(path):
+    with wave.open(path, "rb") as w:
+        if w.getframerate() != app.SAMPLE_RATE or w.getnchannels() != 1 or w.getsampwidth() != 2:
+            sys.exit("expected a 16 kHz mono 16-bit WAV")
+        return w.readframes(w.getnframes())
+
+
+def run_once(pcm, streaming):
+    vad = app.VadAudio("bench_room", aggressiveness=1, streaming=streaming)
+    app.device_states["bench_room"]["relay1"]["status"] = "OFF"
+    audio = pcm + bytes(app.SAMPLE_RATE * 2)  # one second of trailing silence closes the segment
+    chunk_seconds = CHUNK_BYTES / (app.SAMPLE_RATE * 2)
+    for i in range(0, len(audio), CHUNK_BYTES):
+        vad.process_chunk(audio[i:i + CHUNK_BYTES])
+        time.sleep(chunk_seconds)
+    time.sleep(1.0)
+
+
+def main(wav_path, label, runs=5):
+    app.CONFIG_PATH = tempfile.mkdtemp(prefix="smarthome-bench-")
+    app.client = RecordingClient()
+    app.log_command = lambda message, **fields: None
+    app.device_states.clear()
+    app.device_states["bench_room"] = {"wake_word": "jarvis", "relay1": {"label": label, "status": "OFF", "motion_control": False}}
+    app.bump_config_version()
+    app.voice_model.get()
+    app.get_voice_grammar()
+    pcm = read_pcm(wav_path)
+    for streaming in (False, True):
+        for _ in range(int(runs)): run_once(pcm, streaming)
+    for decode_mode, stats in app.voice_latency_summary().items():
+        print(f"{decode_mode:9s}: n={stats['count']} p50={stats['p50_ms']:.0f} ms max={stats['max_ms']:.0f} ms")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3: sys.exit(__doc__)
+    main(*sys.argv[1:])
@@ -0,0 +1,104 @@
+"""Voice device/mode matching: per-pair thefuzz loop vs. the precomputed VoiceMatcher index.
+
+Replays a regression corpus of commands against both and fails if any same-room result differs,
+then times both on a home with 100+ relay labels.
+
+Run from the repo root: python benchmarks/bench_voice_matching.py [rooms]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app
+from thefuzz import fuzz
+
+CUSTOM_LABELS = ["Bedside Lamp", "Ceiling Fan", "Night Light", "Geyser", "Exhaust Fan", "Study Lamp", "Water Pump", "Tube Light"]
+MODES = ["Party", "Movie Night", "Good Morning", "Sleep", "Dinner Time"]
+CORPUS = [
+    "turn on the fan", "fan", "fan off", "switch off main light", "main light", "television on", "tv", "televison on",
+    "air conditioner on", "turn off air con", "ac", "internet", "home theater on", "cofee maker", "coffee maker off",
+    "speaker", "please turn on the speaker", "bedside lamp", "lamp", "ceiling fan on", "night light off", "geyser on",
+    "exhaust", "study lamp off", "water pump", "tube light on", "light", "lights off", "the", "turn on", "jarvis fan",
+    "party mode", "activate party mode", "movie night", "good morning", "sleep mode off", "dinner", "stop party",
+    "main", "theater", "conditioner", "pump on", "turn on device", "kill the fan", "open the tv", "start coffee maker",
+]
+
+
+def legacy_match_devices(text, room_devices):
+    # find_matching_devices_fuzzy as it was before the index.
+    text_lower = text.lower()
+    cleaned_text = " ".join(word for word in text_lower.split() if word not in app.VOICE_COMMAND_STOP_WORDS)
+    if not cleaned_text: return []
+    matching_devices = []
+    for relay, info in room_devices.items():
+        if relay.startswith("relay") and "label" in info:
+            label_lower = info["label"].lower()
+            current_score = 0
+            is_short = len(cleaned_text) <= 3
+            if cleaned_text.replace(" ", "") == label_lower.replace(" ", ""): current_score = 100
+            elif not is_short:
+                current_score = max(fuzz.token_set_ratio(cleaned_text, label_lower), fuzz.token_sort_ratio(cleaned_text, label_lower))
+            elif is_short:
+                if cleaned_text in label_lower.split(): current_score = 100
+                else: current_score = fuzz.token_sort_ratio(cleaned_text, label_lower)
+            if current_score >= app.FUZZY_MATCH_CONFIDENCE_THRESHOLD: matching_devices.append((relay, current_score))
+    if matching_devices: matching_devices.sort(key=lambda x: x[1], reverse=True)
+    return matching_devices
+
+
+def legacy_match_mode(command_text, modes):
+    best_mode, best_score = None, 0
+    for name in modes:
+        score = fuzz.partial_ratio(name.lower(), command_text)
+        if score > 85 and score > best_score: best_score, best_mode = score, name
+    return best_mode
+
+
+def build_home(rooms):
+    labels = app.PRESET_DEVICES + CUSTOM_LABELS
+    app.device_states.clear()
+    for r in range(rooms):
+        app.device_states[f"room_{r}"] = {"wake_word": "jarvis", **{f"relay{i}": {"label": labels[(r * 3 + i) % len(labels)], "status": "OFF", "motion_control": False} for i in range(1, 9)}}
+    app.device_states["kitchen"] = {"wake_word": "jarvis", "relay1": {"label": "Fan", "status": "OFF"}, "relay2": {"label": "Exhaust Fan", "status": "OFF"}}
+    app.device_states["bedroom"] = {"wake_word": "jarvis", "relay1": {"label": "Main Light", "status": "OFF"}, "relay2": {"label": "Fan", "status": "OFF"}}
+
+
+def main(rooms=14):
+    build_home(int(rooms))
+    modes = {name: {} for name in MODES}
+    app.voice_matcher.rebuild(modes)
+    labels = sum(1 for d in app.device_states.values() for k in d if k.startswith("relay"))
+
+    mismatches = 0
+    for room in app.device_states:
+        for command in CORPUS:
+            if legacy_match_devices(command, app.device_states[room]) != app.voice_matcher.match_room(command, room):
+                mismatches += 1
+                print(f"MISMATCH devices room={room} command={command!r}")
+            if legacy_match_mode(command, modes) != app.voice_matcher.match_mode(command):
+                mismatches += 1
+                print(f"MISMATCH mode command={command!r}")
+    print(f"regression corpus: {len(CORPUS)} commands x {len(app.device_states)} rooms, {mismatches} mismatches")
+    print(f"cross-room: 'kitchen fan' from bedroom -> {app.voice_matcher.match_devices('turn on the kitchen fan', 'bedroom')}")
+
+    iterations = 20
+    t0 = time.perf_counter()
+    for _ in range(iterations):
+        for command in CORPUS:
+            for room in app.device_states: legacy_match_devices(command, app.device_states[room])
+            legacy_match_mode(command, modes)
+    legacy_s = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for _ in range(iterations):
+        for command in CORPUS:
+            for room in app.device_states: app.voice_matcher.match_room(command, room)
+            app.voice_matcher.match_mode(command)
+    index_s = time.perf_counter() - t0
+    calls = iterations * len(CORPUS) * len(app.device_states)
+    print(f"{labels} labels: legacy {legacy_s / calls * 1e6:7.1f} us/room-match, index {index_s / calls * 1e6:7.1f} us/room-match")
+    if mismatches: sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
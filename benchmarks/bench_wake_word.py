@@ -0,0 +1,102 @@
+"""Wake word pre-filter on a recorded corpus: decode CPU with and without the spotter, and what it rejected.
+
+The corpus is a directory of 16 kHz mono WAV segments (what VadAudio would hand to the decoder)
+plus transcripts.json, {"file.wav": "what was said"}. Segments whose transcript starts with the
+room's wake word are commands; everything else (TV, conversation, music) should be dropped.
+Each segment goes through open_decoder() as a streaming utterance, in-process or through the
+decode pool, and the CPU of the hub plus its decode workers is measured per pass.
+
+Run from the repo root: python benchmarks/bench_wake_word.py --corpus DIR [--workers 0] [--sensitivity 0.5]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import wave
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app
+from benchmarks import loadgen
+
+FRAME_BYTES = 960    # one 30 ms VAD frame
+
+
+def load_corpus(path):
+    with open(os.path.join(path, "transcripts.json"), encoding="utf-8") as f: transcripts = json.load(f)
+    corpus = []
+    for name, text in sorted(transcripts.items()):
+        with wave.open(os.path.join(path, name), "rb") as w:
+            if w.getframerate() != app.SAMPLE_RATE or w.getnchannels() != 1 or w.getsampwidth() != 2: sys.exit(f"{name}: expected 16 kHz mono 16-bit")
+            corpus.append((name, text, w.readframes(w.getnframes())))
+    return corpus
+
+
+def cpu_seconds():
+    # This process plus the decode workers (children still running, so os.times() would not count them).
+    total = time.process_time()
+    for worker in app.decode_pool.workers:
+        with open(f"/proc/{worker['process'].pid}/stat") as f: fields = f.read().rsplit(")", 1)[1].split()
+        total += (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    return total
+
+
+def run(corpus, room, enabled):
+    app.WAKE_WORD_FILTER = enabled
+    heard, lock = {}, threading.Lock()
+    def on_text(room_id, text, speech_end=None, decode_mode="batch", source="esp32"):
+        with lock: heard[speech_end] = text
+    app.handle_voice_text = on_text
+    before = dict(app.wake_word_stats)
+    done = lambda: len(heard) + app.wake_word_stats["rejected"] - before["rejected"]
+    cpu0, t0 = cpu_seconds(), time.perf_counter()
+    for i, (name, text, pcm) in enumerate(corpus):
+        decoder = app.open_decoder(room)
+        for start in range(0, len(pcm), FRAME_BYTES): decoder.feed(pcm[start:start + FRAME_BYTES])
+        decoder.finish(i)
+        # One segment at a time, as a single room would produce them.
+        loadgen.settle(lambda: done() > i, timeout=60)
+    cpu, elapsed = cpu_seconds() - cpu0, time.perf_counter() - t0
+    stats = {key: app.wake_word_stats[key] - before[key] for key in before}
+    return heard, cpu, elapsed, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--corpus", required=True)
+    parser.add_argument("--wake-word", default="jarvis")
+    parser.add_argument("--sensitivity", type=float, default=app.WAKE_WORD_SENSITIVITY)
+    parser.add_argument("--workers", type=int, default=0, help="decode pool size (0 = decode in this process)")
+    parser.add_argument("--model", default=app.VOSK_MODEL_PATH)
+    args = parser.parse_args()
+    app.CONFIG_PATH = tempfile.mkdtemp(prefix="smarthome-bench-")
+    app.log_command = lambda message, **fields: None
+    app.broadcast_update = lambda data: None
+    room = "living_room"
+    app.state_store.load({room: {"wake_word": args.wake_word, "wake_word_sensitivity": args.sensitivity, "relay1": {"label": "Fan", "status": "OFF"}}})
+    corpus = load_corpus(args.corpus)
+    commands = {i for i, (_, text, _) in enumerate(corpus) if text.lower().split()[:len(args.wake_word.split())] == args.wake_word.lower().split()}
+
+    app.voice_model = app.VoiceModel(args.model)
+    app.decode_pool = app.DecodePool(size=args.workers)
+    if args.workers: app.decode_pool.start(args.model)
+    else: app.voice_model.get()
+    audio_s = sum(len(pcm) for _, _, pcm in corpus) / (app.SAMPLE_RATE * 2)
+    print(f"{len(corpus)} segments, {audio_s:.0f} s of audio, {len(commands)} start with '{args.wake_word}'; "
+          f"{'decode pool of ' + str(args.workers) if args.workers else 'in-process decoding'}, sensitivity {args.sensitivity:g}")
+
+    results = {}
+    for enabled in (False, True):
+        heard, cpu, elapsed, stats = run(corpus, room, enabled)
+        results[enabled] = cpu
+        decoded = set(heard)
+        print(f"filter {'on ' if enabled else 'off'}: decode CPU {cpu:6.2f} s ({cpu / audio_s * 100:5.1f}% of real time), {elapsed:6.2f} s wall; "
+              f"{len(decoded)} segments fully decoded, {stats['rejected']} rejected ({stats['spotter_cpu_s']:.2f} s spotter CPU); "
+              f"commands kept {len(decoded & commands)}/{len(commands)}, non-commands decoded {len(decoded - commands)}/{len(corpus) - len(commands)}")
+    print(f"CPU saved by the filter: {results[False] - results[True]:.2f} s ({(1 - results[True] / results[False]) * 100:.0f}%)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+"""Synthetic load for the hub: an in-process MQTT broker stand-in, simulated room nodes and SSE dashboards.
+
+Nothing here touches the network. LocalBroker implements the slice of MQTT the hub and the room nodes
+use (publish, subscribe with + and # wildcards, retained messages) and gives every client its own
+delivery thread, the way paho runs on_message on its network thread. SimulatedNode speaks the same
+topic protocol as roomnode-esp32.ino.
+"""
+import json
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app
+
+CHUNK_BYTES = 1024              # what the node's I2S loop publishes per audio message
+NODE_MESSAGE_COST_S = 0.002     # relay click + NVS write on the ESP32, per control message
+
+
+def mulaw_encode(samples):
+    # G.711 mu-law, what roomnode-esp32.ino's linearToMulaw() produces.
+    s = np.asarray(samples).astype(np.int32)
+    magnitude = np.minimum(np.abs(s), 32635) + 0x84
+    exponent = np.clip(np.floor(np.log2(magnitude)).astype(np.int32) - 7, 0, 7)
+    mantissa = (magnitude >> (exponent + 3)) & 0x0F
+    return (~(np.where(s < 0, 0x80, 0) | (exponent << 4) | mantissa) & 0xFF).astype(np.uint8)
+
+
+def audio_packets(pcm, codec="mulaw", chunk_bytes=CHUNK_BYTES):
+    # The sequenced packets a node sends in a "START:<codec>" session, one per chunk_bytes of PCM read from I2S.
+    samples = np.frombuffer(pcm, dtype=np.int16)
+    step = chunk_bytes // 2
+    for seq, start in enumerate(range(0, len(samples), step)):
+        chunk = samples[start:start + step]
+        payload = mulaw_encode(chunk).tobytes() if codec == "mulaw" else chunk.tobytes()
+        yield app.AUDIO_HEADER.pack(app.AUDIO_CODECS[codec], 0, seq % 65536, start % 2 ** 32) + payload
+
+
+class Message:
+    """What paho hands to on_message."""
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+def topic_matches(pattern, topic):
+    pattern_parts, topic_parts = pattern.split("/"), topic.split("/")
+    for i, part in enumerate(pattern_parts):
+        if part == "#": return True
+        if i >= len(topic_parts) or (part != "+" and part != topic_parts[i]): return False
+    return len(pattern_parts) == len(topic_parts)
+
+
+class LocalBroker:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients = []
+        self.retained = {}
+        self.stats = {"published": 0, "delivered": 0}
+
+    def connect(self, on_message, name="client"):
+        client = BrokerClient(self, on_message, name)
+        with self.lock: self.clients.append(client)
+        return client
+
+    def publish(self, topic, payload, retain=False):
+        if isinstance(payload, str): payload = payload.encode("utf-8")
+        with self.lock:
+            self.stats["published"] += 1
+            if retain:
+                if payload: self.retained[topic] = payload
+                else: self.retained.pop(topic, None)
+            targets = [c for c in self.clients if any(topic_matches(p, topic) for p in c.subscriptions)]
+            self.stats["delivered"] += len(targets)
+        for client in targets: client.inbox.put(Message(topic, payload))
+
+    def subscribe(self, client, pattern):
+        with self.lock:
+            client.subscriptions.append(pattern)
+            retained = [(t, p) for t, p in self.retained.items() if topic_matches(pattern, t)]
+        for topic, payload in retained: client.inbox.put(Message(topic, payload))
+
+
+class BrokerClient:
+    """Duck-types the parts of paho.mqtt.client.Client the hub calls."""
+    def __init__(self, broker, on_message, name):
+        self.broker = broker
+        self.on_message = on_message
+        self.name = name
+        self.subscriptions = []
+        self.inbox = queue.Queue()
+        threading.Thread(target=self._loop, name=f"broker-{name}", daemon=True).start()
+
+    def subscribe(self, topic, qos=0): self.broker.subscribe(self, topic)
+
+    def publish(self, topic, payload=None, qos=0, retain=False): self.broker.publish(topic, payload or b"", retain)
+
+    def disconnect(self):
+        with self.broker.lock: self.broker.clients.remove(self)
+
+    def is_connected(self): return True
+
+    def _loop(self):
+        while True:
+            msg = self.inbox.get()
+            try: self.on_message(self, None, msg)
+            except Exception as e: print(f"[{self.name}] on_message error: {e}")
+
+
+class SimulatedNode:
+    """One room node: discovery, relay control with status echoes, versioned config, voice sessions and motion triggers.
+
+    versioned=False announces the way nodes did before config sync (no version, no relay mask).
+    """
+    def __init__(self, broker, device_id, room, relays=8, message_cost_s=NODE_MESSAGE_COST_S, versioned=True):
+        self.device_id = device_id
+        self.room = room
+        self.relays = {f"relay{i}": "OFF" for i in range(1, relays + 1)}
+        self.message_cost_s = message_cost_s
+        self.versioned = versioned
+        self.config_version = None
+        self.config_topic = f"{app.MQTT_CONFIG_TOPIC_PREFIX}{device_id}"
+        self.received = []          # (perf_counter, payload) for every home/control message meant for this room
+        self.echoed = {}            # (relay, state) -> perf_counter of the latest status echo
+        self.config_messages = 0
+        self.bytes_received = 0     # control messages for this room plus config payloads
+        self.on_command = None
+        self.broker = broker
+        self.connect()
+
+    def connect(self):
+        self.client = self.broker.connect(self._on_message, self.device_id)
+        for topic in (app.MQTT_PUB_TOPIC, app.MQTT_ASSIGNMENT_TOPIC, self.config_topic): self.client.subscribe(topic)
+        if self.versioned and self.config_version is None: self.client.subscribe(self.config_topic + app.CONFIG_SNAPSHOT_SUFFIX)
+
+    def announce(self):
+        doc = {"device_id": self.device_id, "type": "esp32_relay", "relay_count": len(self.relays), "features": ["batch"]}
+        if self.versioned:
+            if self.config_version: doc["config_version"] = self.config_version
+            doc["relays"] = "".join("1" if self.relays.get(f"relay{i}") == "ON" else "0" for i in range(1, 9))
+        self.client.publish(app.MQTT_DISCOVERY_TOPIC, json.dumps(doc))
+
+    def _on_config(self, topic, payload):
+        self.config_messages += 1
+        self.bytes_received += len(payload)
+        doc = json.loads(payload) if payload else {}
+        if doc.get("action") == "reset":
+            self.relays = {relay: "OFF" for relay in self.relays}
+            self.config_version = None
+            return
+        if not self.versioned or "v" not in doc:
+            return
+        if "base" in doc:
+            if doc["base"] == self.config_version: self.config_version = doc["v"]
+            else: self.announce()
+            return
+        for relay, state in doc.get("state", {}).items():
+            if relay in self.relays and self.relays[relay] != state:
+                self.relays[relay] = state
+                self.echo_status(relay, state)
+        self.config_version = doc["v"]
+
+    def _on_message(self, client, userdata, msg):
+        if client is not self.client: return      # a connection dropped by disconnect()
+        if msg.topic.startswith(self.config_topic):
+            self._on_config(msg.topic, msg.payload)
+            return
+        if msg.topic == app.MQTT_ASSIGNMENT_TOPIC:
+            doc = json.loads(msg.payload)
+            if doc.get("device_id") == self.device_id: self.room = doc["room_name"]
+            return
+        if msg.topic != app.MQTT_PUB_TOPIC: return
+        room, relay, state = msg.payload.decode("utf-8").split(":", 2)
+        if room != self.room: return
+        now = time.perf_counter()
+        self.received.append((now, msg.payload))
+        self.bytes_received += len(msg.payload)
+        if relay == "AUDIO": return
+        updates = dict(item.split("=", 1) for item in state.split(",")) if relay == "BATCH" else {relay: state}
+        time.sleep(self.message_cost_s)
+        for name, new_state in updates.items():
+            if name not in self.relays: continue
+            self.relays[name] = new_state
+            self.echo_status(name, new_state)
+        if self.on_command: self.on_command(self, now, updates)
+
+    def echo_status(self, relay, state):
+        self.echoed[(relay, state)] = time.perf_counter()
+        self.client.publish(app.MQTT_STATUS_TOPIC, f"{self.room}:{relay}:{state}")
+
+    def motion(self): self.client.publish(app.MQTT_TRIGGER_TOPIC, self.room)
+
+    def speak(self, pcm, trailing_silence_s=1.0, realtime=True, codec=None):
+        # START, real-time paced PCM chunks, trailing silence so the hub's VAD closes the segment, END.
+        # Returns the perf_counter at which the last chunk of actual speech went out.
+        chunk_s = CHUNK_BYTES / (app.SAMPLE_RATE * 2)
+        self.client.publish(f"{app.MQTT_VOICE_COMMAND_TOPIC}{self.room}", f"START:{codec}" if codec else "START")
+        audio = pcm + bytes(int(app.SAMPLE_RATE * trailing_silence_s) * 2)
+        packets = audio_packets(audio, codec) if codec else None
+        speech_end = None
+        for i in range(0, len(audio), CHUNK_BYTES):
+            self.client.publish(f"{app.MQTT_VOICE_AUDIO_TOPIC}{self.room}", next(packets) if packets else audio[i:i + CHUNK_BYTES])
+            if i + CHUNK_BYTES >= len(pcm) and speech_end is None: speech_end = time.perf_counter()
+            if realtime: time.sleep(chunk_s)
+        self.client.publish(f"{app.MQTT_VOICE_COMMAND_TOPIC}{self.room}", "END")
+        return speech_end
+
+
+class Dashboard:
+    """An SSE subscriber reading /status-stream through Flask's test client, i.e. the real route."""
+    def __init__(self, on_event):
+        self.on_event = on_event
+        self.events = 0
+        self.connected = threading.Event()
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def _loop(self):
+        test_client = app.app.test_client()
+        with test_client.session_transaction() as session: session["logged_in"] = True
+        # The test client pulls the first chunk before returning, so this blocks until the first event.
+        self.connected.set()
+        response = test_client.get("/status-stream", buffered=False)
+        for chunk in response.response:
+            received = time.perf_counter()
+            for line in (chunk.decode("utf-8") if isinstance(chunk, bytes) else chunk).splitlines():
+                if not line.startswith("data: "): continue
+                self.events += 1
+                self.on_event(received, json.loads(line[6:]))
+
+
+def start_hub(rooms, relays=8, quiet=True):
+    """Points the app at a fresh temp config and a LocalBroker; returns (broker, nodes)."""
+    app.CONFIG_PATH = tempfile.mkdtemp(prefix="smarthome-bench-")
+    if quiet: app.log_command = lambda message, **fields: app.broadcast_update({"type": "log", "log": message})
+    broker = LocalBroker()
+    states = {}
+    app.device_room_map = {}
+    nodes = []
+    for r in range(rooms):
+        room, device_id = f"room_{r}", f"esp32_{r:08X}"
+        states[room] = {"wake_word": "jarvis"}
+        for i in range(1, relays + 1):
+            states[room][f"relay{i}"] = {"label": f"Light {r}-{i}", "status": "OFF", "motion_control": False}
+        app.device_room_map[room] = device_id
+        nodes.append(SimulatedNode(broker, device_id, room, relays))
+    app.state_store.load(states)
+    app.client = broker.connect(app.on_message, "hub")
+    app.on_connect(app.client, None, None, 0)
+    for node in nodes: node.announce()
+    app.bump_config_version()
+    return broker, nodes
+
+
+def settle(predicate, timeout=10.0, poll=0.005):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if predicate(): return True
+        time.sleep(poll)
+    return False
@@ -20,6 +20,12 @@ const int relayPins[8] = {16, 17, 18, 19, 21, 22, 23, 25};
 #define I2S_WS 26
 #define SAMPLE_RATE 16000
 #define CHUNK_BUFFER_SIZE 1024 
+// 0: raw 16-bit PCM chunks, which every hub understands (the default)
+// 1: "START:mulaw" sessions, 8-byte header (codec, 0, seq, timestamp) + mu-law: half the Wi-Fi traffic and
+//    loss/reorder tolerant, but only for hubs that know the sequenced format; opt in per node (-DAUDIO_MULAW=1)
+#ifndef AUDIO_MULAW
+#define AUDIO_MULAW 0
+#endif
 
 // --- MQTT Topics ---
 const char* mqtt_control_topic = "home/control";
@@ -43,6 +49,9 @@ Preferences preferences;
 char device_id[20] = "";
 char room_id[20] = "unassigned";
 char config_topic[50] = "";
+char snapshot_topic[60] = "";
+char config_version[12] = "";   // version of the hub config this node holds ("" = never synced)
+bool relayState[8] = {false};
 unsigned long lastDiscoveryTime = 0;
 bool roomAssigned = false;
 
@@ -50,6 +59,8 @@ bool roomAssigned = false;
 unsigned long lastTriggerTime = 0;
 const unsigned long TRIGGER_COOLDOWN = 2000;
 void sendDiscoveryMessage();
+void startVoiceSession();
+bool applyRelay(const char* room, int relayNum, bool newState);
 void i2s_install();
 void i2s_setpin();
 
@@ -62,9 +73,9 @@ void reconnect() {
       client.subscribe(mqtt_control_topic);
       client.subscribe(mqtt_assignment_topic);
       client.subscribe(config_topic);
-      if (roomAssigned) {
-        client.publish((String(mqtt_voice_command_topic) + room_id).c_str(), "START");
-      }
+      // Never synced: take the retained snapshot straight from the broker; afterwards the hub sends deltas.
+      if (config_version[0] == '\0') client.subscribe(snapshot_topic);
+      if (roomAssigned) startVoiceSession();
     } else {
       Serial.print("Failed rc="); Serial.print(client.state());
       Serial.println(" Retry in 5s");
@@ -73,6 +84,29 @@ void reconnect() {
   }
 }
 
+// --- AUDIO TRANSPORT ---
+uint16_t audioSeq = 0;
+uint32_t audioTimestamp = 0;   // samples since START; the hub spots lost chunks from jumps in it
+
+void startVoiceSession() {
+  audioSeq = 0;
+  audioTimestamp = 0;
+  client.publish((String(mqtt_voice_command_topic) + room_id).c_str(), AUDIO_MULAW ? "START:mulaw" : "START");
+}
+
+uint8_t linearToMulaw(int16_t pcm) {
+  // G.711 mu-law
+  int32_t sample = pcm;
+  uint8_t sign = 0;
+  if (sample < 0) { sample = -sample; sign = 0x80; }
+  if (sample > 32635) sample = 32635;
+  sample += 0x84;
+  uint8_t exponent = 7;
+  for (int32_t mask = 0x4000; (sample & mask) == 0 && exponent > 0; mask >>= 1) exponent--;
+  uint8_t mantissa = (sample >> (exponent + 3)) & 0x0F;
+  return ~(sign | (exponent << 4) | mantissa);
+}
+
 // --- AUDIO SENDING WITH GAIN BOOST ---
 void send_audio_chunk() {
     size_t bytes_read = 0;
@@ -90,19 +124,58 @@ void send_audio_chunk() {
         }
         
         String audio_topic = String(mqtt_voice_audio_topic) + room_id;
+#if AUDIO_MULAW
+        size_t samples = bytes_read / 2;
+        uint8_t packet[8 + CHUNK_BUFFER_SIZE / 2];
+        packet[0] = 1; packet[1] = 0;
+        packet[2] = audioSeq & 0xFF; packet[3] = audioSeq >> 8;
+        for (int b = 0; b < 4; b++) packet[4 + b] = (audioTimestamp >> (8 * b)) & 0xFF;
+        for (size_t i = 0; i < samples; i++) packet[8 + i] = linearToMulaw(raw_buffer[i]);
+        client.publish(audio_topic.c_str(), packet, 8 + samples);
+        // Advanced even if the publish failed, so the gap shows up at the hub.
+        audioSeq++;
+        audioTimestamp += samples;
+#else
         client.publish(audio_topic.c_str(), (uint8_t*)raw_buffer, bytes_read);
+#endif
     }
 }
 
+void storeConfigVersion(const char* v) {
+    strncpy(config_version, v ? v : "", sizeof(config_version) - 1);
+    config_version[sizeof(config_version) - 1] = '\0';
+    preferences.putString("cfg_v", config_version);
+}
+
 void handleConfig(byte* payload, unsigned int length) {
     JsonDocument doc;
-    deserializeJson(doc, payload, length);
+    if (deserializeJson(doc, payload, length) != DeserializationError::Ok) return;
     if (doc["action"] == "reset") {
         for (int i = 0; i < 8; i++) {
             digitalWrite(relayPins[i], ACTIVE_LOW ? HIGH : LOW);
             preferences.putBool(("relay" + String(i)).c_str(), false);
+            relayState[i] = false;
         }
+        storeConfigVersion("");
+        return;
+    }
+    const char* v = doc["v"];
+    if (!v) return;
+    // --- DELTA: {"v", "base", "set"} only applies on top of the version we hold ---
+    if (doc["base"].is<const char*>()) {
+        if (strcmp(doc["base"], config_version) == 0) storeConfigVersion(v);
+        else sendDiscoveryMessage();   // out of step: announce our version and the hub resends
+        return;
+    }
+    // --- FULL: {"v", "config", "state"}, pushed by the hub or replayed from the retained snapshot ---
+    JsonObject state = doc["state"];
+    for (JsonPair kv : state) {
+        int relayNum = atoi(kv.key().c_str() + 5);   // "relayN"
+        bool on = (strcmp(kv.value().as<const char*>(), "ON") == 0);
+        if (relayNum >= 1 && relayNum <= 8 && relayState[relayNum - 1] != on) applyRelay(room_id, relayNum, on);
     }
+    storeConfigVersion(v);
+    client.unsubscribe(snapshot_topic);
 }
 
 void generateDeviceId() {
@@ -110,6 +183,7 @@ void generateDeviceId() {
   for(int i=0; i<17; i=i+8) chipId |= ((ESP.getEfuseMac() >> (40 - i)) & 0xff) << i;
   snprintf(device_id, sizeof(device_id), "esp32_%08X", chipId);
   snprintf(config_topic, sizeof(config_topic), "%s%s", mqtt_config_topic_prefix, device_id);
+  snprintf(snapshot_topic, sizeof(snapshot_topic), "%s/snapshot", config_topic);
 }
 
 void sendDiscoveryMessage() {
@@ -117,11 +191,31 @@ void sendDiscoveryMessage() {
   doc["device_id"] = device_id;
   doc["type"] = "esp32_relay";
   doc["relay_count"] = 8;
-  char jsonBuffer[128];
+  JsonArray features = doc["features"].to<JsonArray>();
+  features.add("batch");
+  // Lets the hub stay silent when we are current, and re-send only relay commands we missed while offline.
+  if (config_version[0] != '\0') doc["config_version"] = config_version;
+  char relays[9];
+  for (int i = 0; i < 8; i++) relays[i] = relayState[i] ? '1' : '0';
+  relays[8] = '\0';
+  doc["relays"] = relays;
+  char jsonBuffer[256];
   serializeJson(doc, jsonBuffer);
   client.publish(mqtt_discovery_topic, jsonBuffer);
 }
 
+bool applyRelay(const char* room, int relayNum, bool newState) {
+  if (relayNum < 1 || relayNum > 8) return false;
+  digitalWrite(relayPins[relayNum - 1], newState ? (ACTIVE_LOW ? LOW : HIGH) : (ACTIVE_LOW ? HIGH : LOW));
+  preferences.putBool(("relay" + String(relayNum - 1)).c_str(), newState);
+  relayState[relayNum - 1] = newState;
+
+  char status_payload[50];
+  snprintf(status_payload, sizeof(status_payload), "%s:relay%d:%s", room, relayNum, newState ? "ON" : "OFF");
+  client.publish(mqtt_status_topic, status_payload);
+  return true;
+}
+
 void processControlMessage(const char* room, const char* relay, const char* state) {
   if (!room || !relay || !state || strcmp(room, room_id) != 0) return;
   
@@ -137,17 +231,28 @@ void processControlMessage(const char* room, const char* relay, const char* stat
   }
   // -----------------------------
 
+  // --- BATCH: "room:BATCH:relay1=ON,relay3=OFF" ---
+  if (strcmp(relay, "BATCH") == 0) {
+    char list[160];
+    strncpy(list, state, sizeof(list) - 1);
+    list[sizeof(list) - 1] = '\0';
+    bool anyOn = false, anyChanged = false;
+    char* save = NULL;
+    for (char* item = strtok_r(list, ",", &save); item; item = strtok_r(NULL, ",", &save)) {
+      char* eq = strchr(item, '=');
+      if (!eq || strncmp(item, "relay", 5) != 0) continue;
+      *eq = '\0';
+      int relayNum = atoi(item + 5);
+      bool newState = (strcmp(eq + 1, "ON") == 0);
+      if (applyRelay(room, relayNum, newState)) { anyChanged = true; anyOn |= newState; }
+    }
+    if (anyChanged) mp3.playFolder(1, anyOn ? 1 : 2);
+    return;
+  }
+
   if (strncmp(relay, "relay", 5) == 0) {
-    int relayNum = atoi(relay + 5);
-    if (relayNum >= 1 && relayNum <= 8) {
-      bool newState = (strcmp(state, "ON") == 0);
-      digitalWrite(relayPins[relayNum - 1], newState ? (ACTIVE_LOW ? LOW : HIGH) : (ACTIVE_LOW ? HIGH : LOW));
-      preferences.putBool(("relay" + String(relayNum - 1)).c_str(), newState);
-      
-      char status_payload[50];
-      snprintf(status_payload, sizeof(status_payload), "%s:%s:%s", room, relay, state);
-      client.publish(mqtt_status_topic, status_payload);
-      
+    bool newState = (strcmp(state, "ON") == 0);
+    if (applyRelay(room, atoi(relay + 5), newState)) {
       // Play System Sounds from Folder 01
       // Turned ON -> Folder 01/001.mp3
       // Turned OFF -> Folder 01/002.mp3
@@ -157,7 +262,7 @@ void processControlMessage(const char* room, const char* relay, const char* stat
 }
 
 void callback(char* topic, byte* payload, unsigned int length) {
-  if (strcmp(topic, config_topic) == 0) { handleConfig(payload, length);
+  if (strcmp(topic, config_topic) == 0 || strcmp(topic, snapshot_topic) == 0) { handleConfig(payload, length);
     return; }
   
   char msg[length + 1];
@@ -174,7 +279,7 @@ void callback(char* topic, byte* payload, unsigned int length) {
       roomAssigned = (strcmp(room_id, "unassigned") != 0);
       
       if(roomAssigned && !was_assigned) {
-          client.publish((String(mqtt_voice_command_topic) + room_id).c_str(), "START");
+          startVoiceSession();
           Serial.println("[VOICE] Room assigned. Start audio.");
           // Play Bind Sound -> Folder 01/004.mp3
           mp3.playFolder(1, 4);
@@ -231,9 +336,12 @@ void setup() {
   preferences.getString("room_name", room_id, sizeof(room_id));
   roomAssigned = (strcmp(room_id, "unassigned") != 0);
   
+  preferences.getString("cfg_v", config_version, sizeof(config_version));
+  
   for (int i = 0; i < 8; i++) {
     pinMode(relayPins[i], OUTPUT);
-    digitalWrite(relayPins[i], preferences.getBool(("relay" + String(i)).c_str(), false) ? (ACTIVE_LOW ? LOW : HIGH) : (ACTIVE_LOW ? HIGH : LOW));
+    relayState[i] = preferences.getBool(("relay" + String(i)).c_str(), false);
+    digitalWrite(relayPins[i], relayState[i] ? (ACTIVE_LOW ? LOW : HIGH) : (ACTIVE_LOW ? HIGH : LOW));
   }
   
   pinMode(PIR_PIN, INPUT_PULLUP);
@@ -74,59 +74,88 @@ document.addEventListener('DOMContentLoaded', () => {
             }).catch(console.error);
         };
 
-        document.querySelectorAll('.relay-toggle').forEach(toggle => {
-            toggle.addEventListener('change', function() {
-                sendCommand({ 
-                    room: this.dataset.room, 
-                    relay: this.dataset.relay, 
-                    action: this.checked ? 'ON' : 'OFF' 
-                });
+        const panel = document.getElementById('control-panel');
+
+        // Delegated, so rooms rendered later need no wiring of their own.
+        panel.addEventListener('change', (e) => {
+            const toggle = e.target.closest('.relay-toggle');
+            if (!toggle) return;
+            sendCommand({ 
+                room: toggle.dataset.room, 
+                relay: toggle.dataset.relay, 
+                action: toggle.checked ? 'ON' : 'OFF' 
             });
         });
 
-        document.querySelectorAll('.motion-icon').forEach(icon => {
-            icon.addEventListener('click', function() {
-                const room = this.dataset.room;
-                const relay = this.dataset.relay;
-                const isActive = this.classList.contains('active');
-                this.classList.toggle('active');
+        panel.addEventListener('click', (e) => {
+            const icon = e.target.closest('.motion-icon');
+            if (icon) {
+                const room = icon.dataset.room;
+                const relay = icon.dataset.relay;
+                const isActive = icon.classList.contains('active');
+                icon.classList.toggle('active');
                 sendCommand({ room, relay, motion_control: !isActive });
-            });
+                return;
+            }
+            const close = e.target.closest('.close-modal');
+            if (close) return closeRoomModal(close.dataset.room);
+            if (e.target.closest('.modal-content')) return;
+            const module = e.target.closest('.room-module');
+            if (module) openRoomModal(module.dataset.room);
         });
 
-        const micButtons = document.querySelectorAll('.push-to-talk');
-        micButtons.forEach(btn => {
+        // The hub serves relays before the speech model has loaded; keep the mics idle until it has.
+        let voiceState = document.body.dataset.voiceState || 'ready';
+        function setVoiceState(state) {
+            voiceState = state;
+            document.querySelectorAll('.mic-status').forEach(status => {
+                if (!status.dataset.idleText) status.dataset.idleText = status.innerHTML;
+                status.innerHTML = state === 'ready' ? status.dataset.idleText
+                    : state === 'warming_up' ? 'Voice warming up...' : 'Voice unavailable';
+            });
+            document.querySelectorAll('.push-to-talk').forEach(btn => btn.classList.toggle('disabled', state !== 'ready'));
+        }
+        if (voiceState !== 'ready') setVoiceState(voiceState);
+
+        function bindMic(btn) {
             let mediaRecorder;
-            let audioChunks = [];
             let isRecording = false;
             const micWrapper = btn.closest('.mic-wrapper');
             const micStatus = micWrapper.querySelector('.mic-status');
 
             btn.addEventListener('click', async (e) => {
                 e.stopPropagation();
-                if (isRecording) return; 
+                if (isRecording || voiceState !== 'ready') return; 
 
                 const roomName = btn.dataset.room;
 
                 try {
                     const stream = await navigator.mediaDevices.getUserMedia({ audio: true });
                     mediaRecorder = new MediaRecorder(stream);
-                    audioChunks = [];
-                    
-                    mediaRecorder.ondataavailable = e => audioChunks.push(e.data);
+
+                    // Stream 250 ms slices to the hub so it decodes while we are still recording.
+                    const session = `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+                    const streamUrl = `/process_browser_audio_stream?room=${encodeURIComponent(roomName)}&session=${session}`;
+                    const contentType = mediaRecorder.mimeType || 'application/octet-stream';
+                    let seq = 0;
+                    let uploads = Promise.resolve();
+                    const postSlice = (body, final) => {
+                        const url = `${streamUrl}&seq=${seq++}${final ? '&final=1' : ''}`;
+                        uploads = uploads.then(() => fetch(url, { method: 'POST', headers: { 'Content-Type': contentType }, body }))
+                                         .catch(console.error);
+                    };
+
+                    mediaRecorder.ondataavailable = e => { if (e.data.size) postSlice(e.data, false); };
                     
                     mediaRecorder.onstop = () => {
-                        const blob = new Blob(audioChunks);
-                        fetch(`/process_browser_audio?room=${encodeURIComponent(roomName)}`, { 
-                            method: 'POST', body: blob 
-                        });
+                        postSlice(new Blob([]), true);
                         btn.classList.remove('listening');
                         if(micStatus) micStatus.innerHTML = `Tap to Speak`;
                         isRecording = false;
                         stream.getTracks().forEach(track => track.stop());
                     };
 
-                    mediaRecorder.start();
+                    mediaRecorder.start(250);
                     isRecording = true;
                     btn.classList.add('listening');
                     if(micStatus) micStatus.innerHTML = 'Listening...';
@@ -139,7 +168,7 @@ document.addEventListener('DOMContentLoaded', () => {
                     alert("Microphone access denied."); 
                 }
             });
-        });
+        }
 
         let availableVoices = [];
         function loadVoices() { availableVoices = window.speechSynthesis.getVoices(); }
@@ -158,18 +187,159 @@ document.addEventListener('DOMContentLoaded', () => {
             }
         }
 
-        function setupEventSource() {
-            const eventSource = new EventSource("/status-stream");
-            eventSource.onmessage = (e) => {
+        // --- Rooms: rendered from /api/state, kept current from /status-stream ---
+        const MIC_SVG = '<svg viewBox="0 0 24 24"><path d="M12 14c1.66 0 3-1.34 3-3V5c0-1.66-1.34-3-3-3S9 3.34 9 5v6c0 1.66 1.34 3 3 3z"/><path d="M17 11c0 2.76-2.24 5-5 5s-5-2.24-5-5H5c0 3.53 2.61 6.43 6 6.92V21h2v-3.08c3.39-.49 6-3.39 6-6.92h-2z"/></svg>';
+        const MOTION_PATH = '<path d="M13.49 5.48c1.1 0 2-.9 2-2s-.9-2-2-2-2 .9-2 2 .9 2 2 2zm-3.6 13.9l1-4.4 2.1 2v6h2v-7.5l-2.1-2 .6-3c1.3 1.5 3.3 2.5 5.5 2.5v-2c-1.9 0-3.5-1-4.3-2.4l-1-1.6c-.4-.6-1-1-1.7-1-.3 0-.5.1-.8.1l-5.2 2.2v4.7h2v-3.4l1.8-.7-1.6 8.1-4.9-1-.4 2 7.7 1.6z"/>';
+        const esc = (text) => String(text ?? '').replace(/[&<>"']/g, c => ({ '&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;' }[c]));
+        const title = (room) => room.replace(/_/g, ' ').replace(/\S+/g, w => w[0].toUpperCase() + w.slice(1).toLowerCase());
+
+        function deviceList(room, relays) {
+            return '<div class="device-list">' + Object.entries(relays).map(([relay, data]) => `
+                <div class="device-item">
+                    <span>${esc(data.label)}</span>
+                    <div class="controls">
+                        <svg class="motion-icon ${data.motion_control ? 'active' : ''}" id="motion-${esc(room)}-${esc(relay)}"
+                             data-room="${esc(room)}" data-relay="${esc(relay)}" viewBox="0 0 24 24">${MOTION_PATH}</svg>
+                        <label class="switch">
+                            <input type="checkbox" class="relay-toggle" id="switch-${esc(room)}-${esc(relay)}"
+                                   data-room="${esc(room)}" data-relay="${esc(relay)}" ${data.status === 'ON' ? 'checked' : ''}>
+                            <span class="slider"></span>
+                        </label>
+                    </div>
+                </div>`).join('') + '</div>';
+        }
+
+        function singleRoom(room, data) {
+            return `
+            <h3 class="text-center reveal" style="margin-bottom:10px;">${esc(title(room))}</h3>
+            <div class="mic-wrapper reveal" style="text-align:center; margin-bottom: 40px; margin-top: 0;">
+                <button class="btn-mic push-to-talk" data-room="${esc(room)}" title="Voice Command">${MIC_SVG}</button>
+                <div class="mic-status" style="margin-top:10px; font-size:14px; opacity:0.8;">Tap to Speak</div>
+            </div>
+            <div class="card-container"><div class="room-card reveal">${deviceList(room, data.relays)}</div></div>`;
+        }
+
+        function roomModule(room, data) {
+            return `
+                <div class="room-module" data-room="${esc(room)}">
+                    <div class="status-badge ${data.bound ? 'bound' : ''}" title="${data.bound ? 'Hardware Connected' : 'No Hardware Bound'}"></div>
+                    <div style="font-size: 40px; margin-bottom: 10px;">🏠</div>
+                    <h3>${esc(title(room))}</h3>
+                    <p style="opacity: 0.6; font-size: 0.9em;">Tap to Control</p>
+                </div>
+                <div id="modal-${esc(room)}" class="modal-overlay">
+                    <div class="modal-content">
+                        <span class="close-modal" data-room="${esc(room)}">&times;</span>
+                        <h2 class="text-center" style="margin-bottom: 5px;">${esc(title(room))}</h2>
+                        <p class="text-center" style="font-size:0.9em; opacity:0.7; margin-bottom:20px;">
+                            Status: ${data.bound ? '<span style="color:var(--primary);">Hardware Connected</span>' : 'Offline'}
+                        </p>
+                        <div class="mic-wrapper" style="text-align:center; margin: 20px 0;">
+                            <button class="btn-mic push-to-talk" data-room="${esc(room)}">${MIC_SVG}</button>
+                            <div class="mic-status" style="margin-top:5px; font-size:12px;">Tap to Command ${esc(title(room))}</div>
+                        </div>
+                        ${deviceList(room, data.relays)}
+                    </div>
+                </div>`;
+        }
+
+        function render() {
+            const open = panel.querySelector('.modal-overlay.active');
+            const rooms = Object.entries(state.rooms);
+            panel.innerHTML = rooms.length === 1 ? singleRoom(...rooms[0]) : `
+            <h3 class="text-center reveal" style="margin-bottom:20px;">Smart Dashboard</h3>
+            <div class="dashboard-grid reveal">${rooms.map(([room, data]) => roomModule(room, data)).join('')}</div>`;
+            panel.querySelectorAll('.push-to-talk').forEach(bindMic);
+            panel.querySelectorAll('.reveal').forEach(el => observer.observe(el));
+            if (voiceState !== 'ready') setVoiceState(voiceState);
+            const reopen = open && document.getElementById(open.id);
+            if (reopen) reopen.classList.add('active');
+        }
+
+        // The full snapshot is revalidated with its ETag, kept across page loads: an unchanged house costs a 304.
+        // Version and event id come from the headers, so a 304 still says where to resume the stream from.
+        let state = null;
+        let roomVersions = {};
+        let eventSource = null;
+        async function loadState() {
+            let cached = null;
+            try { cached = JSON.parse(localStorage.getItem('state_snapshot')); } catch (err) {}
+            const res = await fetch('/api/state', { cache: 'no-store', headers: cached ? { 'If-None-Match': cached.etag } : {} });
+            if (res.status === 304 && cached) {
+                state = cached.body;
+            } else if (res.ok) {
+                state = await res.json();
+                try { localStorage.setItem('state_snapshot', JSON.stringify({ etag: res.headers.get('ETag'), body: state })); } catch (err) {}
+            } else {
+                throw new Error(`/api/state: ${res.status}`);
+            }
+            state.version = Number(res.headers.get('X-State-Version'));
+            state.event_id = res.headers.get('X-Event-Id');
+            roomVersions = {};
+        }
+
+        async function loadRoom(room) {
+            const res = await fetch(`/api/state?room=${encodeURIComponent(room)}`, { cache: 'no-store' });
+            if (!res.ok) return;
+            const slice = await res.json();
+            if (slice.rooms[room]) state.rooms[room] = slice.rooms[room];
+            else delete state.rooms[room];
+            roomVersions[room] = slice.version;
+            render();
+        }
+
+        // Only events newer than what the snapshot (or the room's slice) already shows are applied.
+        const isNew = (data) => !data.version || data.version > (roomVersions[data.room] ?? state.version);
+
+        function setSwitch(room, relay, status) {
+            const el = document.getElementById(`switch-${room}-${relay}`);
+            if (el) el.checked = (status === 'ON');
+            const relays = state.rooms[room] && state.rooms[room].relays;
+            if (relays && relays[relay]) relays[relay].status = status;
+        }
+
+        function setMotion(room, relay, enabled) {
+            const el = document.getElementById(`motion-${room}-${relay}`);
+            if (el) el.classList.toggle('active', enabled);
+            const relays = state.rooms[room] && state.rooms[room].relays;
+            if (relays && relays[relay]) relays[relay].motion_control = enabled;
+        }
+
+        async function resync() {
+            // A gap in the stream (hub restarted, or we fell out of its buffer): refetch, re-render, resume from there.
+            if (eventSource) eventSource.close();
+            eventSource = null;
+            try {
+                await loadState();
+                render();
+                setupEventSource(state.event_id);
+            } catch (err) {
+                console.error(err);
+                setTimeout(resync, 3000);
+            }
+        }
+
+        function setupEventSource(lastEventId) {
+            const source = eventSource = new EventSource(`/status-stream?last_event_id=${encodeURIComponent(lastEventId)}`);
+            source.onmessage = (e) => {
+                if (e.lastEventId) lastEventId = e.lastEventId;
                 const data = JSON.parse(e.data);
-                if (data.type === 'status_update') {
-                    const el = document.getElementById(`switch-${data.room}-${data.relay}`);
-                    if (el) el.checked = (data.status === 'ON');
+                if (data.type === 'hello' && (data.boot !== state.boot || !data.resumed)) return resync();
+                if (data.type === 'snapshot') return resync();
+                if (data.type === 'status_update' && isNew(data)) setSwitch(data.room, data.relay, data.status);
+                if (data.type === 'motion_update' && isNew(data)) setMotion(data.room, data.relay, data.motion_control);
+                if (data.type === 'room_update' && isNew(data)) {
+                    if (data.change === 'edit') loadRoom(data.room);
+                    else resync();
                 }
                 if (data.type === 'voice_feedback') speakText(data.text);
+                if (data.type === 'voice_status') setVoiceState(data.state);
+            };
+            source.onerror = (e) => {
+                source.close();
+                if (eventSource === source) setTimeout(() => setupEventSource(lastEventId), 3000);
             };
-            eventSource.onerror = (e) => { eventSource.close(); setTimeout(setupEventSource, 3000); };
         }
-        setupEventSource();
+        resync();
     }
 });
\ No newline at end of file